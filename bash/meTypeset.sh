@@ -6,7 +6,7 @@ _meTypeset()
     prev="${COMP_WORDS[COMP_CWORD-1]}"
 
     if [ $COMP_CWORD -eq 1 ]; then
-        COMPREPLY=( $( compgen -W ' tei docx doc odt docxextracted other bibscan' -- $cur) )
+        COMPREPLY=( $( compgen -W ' tei docx doc odt docxextracted other bibscan batch' -- $cur) )
 	else
 		case $prev in
 			--agression)
@@ -34,7 +34,7 @@ _meTypeset()
 				elif [ $COMP_CWORD -eq 3 ]; then
 					COMPREPLY=( $(compgen -d ${cur}) )
 				elif [ $COMP_CWORD -ge 4 ]; then
-					COMPREPLY=( $(compgen -W '-a --aggression --chain -c --clean -d --debug -h --help -i --identifiers --interactive -m --metadata --nogit --noimageprocessing --nolink --nometa --purenlm --puretei --prettytei -p --proprietary -s --settings -v --version -z --zotero' -- $cur) )
+					COMPREPLY=( $(compgen -W '-a --aggression --chain -c --clean -d --debug -h --help -i --identifiers --interactive -m --metadata --nocache --nogit --noimageprocessing --nolink --nometa --purenlm --puretei --prettytei --profile -p --proprietary --resume-from -s --settings -v --version -z --zotero' -- $cur) )
 				fi
 			;;
 		esac
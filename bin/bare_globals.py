@@ -11,6 +11,9 @@ from lxml import *
 import os
 import docopt
 from settingsconfiguration import Settings
+from documentsession import DocumentSession
+from profiler import Profiler
+from identifiers import Identifiers
 
 
 class GV (Debuggable):
@@ -25,6 +28,15 @@ class GV (Debuggable):
         self.used_list_method = False
         self.used_square_reference_method = False
 
+        # the live NLM tree shared by all modules
+        self.session = DocumentSession(self)
+
+        # per-stage timings, written alongside the input with --profile
+        self.profiler = Profiler(self, self.args.get('--profile', False))
+
+        # the IDs given to elements, derived from the input document so that re-runs give the same IDs
+        self.identifiers = Identifiers(self)
+
         # read the configuration
         self.settings_file_path = 'default'
         self.tei_file_path = None
@@ -0,0 +1,230 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that converts a folder (or a manifest file listing documents, one per line) with a pool of worker processes.
+
+1.) Works out the input type of each document from its extension and gives it its own folder under the output root
+2.) Converts the documents in a multiprocessing pool; each worker process keeps its Saxon worker, parsed settings and
+    other warm resources from one document to the next
+3.) Isolates failures: a document that raises or calls fatal_error is recorded and the batch carries on
+4.) Writes a summary manifest (manifest.json) to the output root
+"""
+
+import json
+import multiprocessing
+import multiprocessing.util
+import os
+import time
+import traceback
+from debug import Debuggable
+from debug import Debug
+from settingsconfiguration import Settings
+
+# the saxon worker and office listeners of this (pool) process, reused by every document it converts
+saxon_worker = None
+office_listeners = None
+teardown_registered = False
+
+input_types = {'.doc': 'doc', '.docx': 'docx', '.odt': 'odt', '.xml': 'tei'}
+commands = ['doc', 'docx', 'docxextracted', 'odt', 'other', 'tei', 'bibscan', 'batch']
+
+
+def stop_worker_resources():
+    """
+    Stops the saxon worker and office listeners of this process
+    """
+    if saxon_worker is not None:
+        saxon_worker.stop()
+
+    if office_listeners is not None:
+        office_listeners.stop()
+
+
+def register_teardown():
+    """
+    Stops the resources of a pool worker when the worker exits. Pool workers leave through os._exit, so the atexit
+    handlers of the listeners never run there (and, in sessions of their own, the office processes would outlive the
+    batch); multiprocessing's own finalizers do run.
+    """
+    global teardown_registered
+
+    if not teardown_registered and multiprocessing.parent_process() is not None:
+        multiprocessing.util.Finalize(None, stop_worker_resources, exitpriority=10)
+        teardown_registered = True
+
+
+def convert_document(job):
+    """
+    Converts a single document inside a pool worker
+    @param job: a tuple of the command line arguments for this document, its input path, its output folder and the
+    settings file path and registry loaded by the parent process
+    @return: a manifest entry for the document
+    """
+    global saxon_worker
+    global office_listeners
+
+    args, input_file, output_folder, settings = job
+
+    # the registry is inherited from the parent rather than re-parsed in every worker
+    Settings.registries.setdefault(*settings)
+
+    entry = {'input': input_file, 'output': output_folder, 'type': None, 'status': 'failed', 'error': None}
+    start = time.time()
+
+    for command in commands:
+        if args[command]:
+            entry['type'] = command
+
+    try:
+        from meTypeset import MeTypeset
+
+        register_teardown()
+
+        me_typeset_instance = MeTypeset(args)
+
+        if hasattr(me_typeset_instance.gv, 'saxon'):
+            if saxon_worker is None:
+                saxon_worker = me_typeset_instance.gv.saxon
+            else:
+                saxon_worker.attach(me_typeset_instance.gv)
+
+        if hasattr(me_typeset_instance.gv, 'office'):
+            if office_listeners is None:
+                office_listeners = me_typeset_instance.gv.office
+            else:
+                office_listeners.attach(me_typeset_instance.gv)
+
+        me_typeset_instance.run()
+
+        if args['--puretei']:
+            expected_output = me_typeset_instance.gv.tei_file_path
+        else:
+            expected_output = me_typeset_instance.gv.nlm_file_path
+
+        if os.path.isfile(expected_output):
+            entry['status'] = 'converted'
+        else:
+            entry['error'] = u'No output was produced at {0}'.format(expected_output)
+
+    except SystemExit:
+        entry['error'] = 'Fatal error (see the log for this document)'
+    except Exception:
+        entry['error'] = traceback.format_exc()
+
+    entry['seconds'] = round(time.time() - start, 3)
+
+    return entry
+
+
+class BatchConverter(Debuggable):
+    def __init__(self, args):
+        self.args = args
+        self.debug = Debug()
+
+        if self.args['--debug']:
+            self.debug.enable_debug(True)
+
+        self.input = self.args['<input>'].strip()
+        self.output_root = self.args['<output_folder>'].strip()
+        self.jobs = int(self.args['--jobs'])
+        Debuggable.__init__(self, 'Batch Converter')
+
+        settings_file = Settings.get_settings_file(self, Settings.setup_settings_file(self.args))
+        self.settings = (settings_file, Settings.load_registry(settings_file))
+
+    def list_documents(self):
+        """
+        Lists the documents to convert, either every file in the input folder or every line of a manifest file
+        @return: a sorted list of paths
+        """
+        if os.path.isdir(self.input):
+            documents = [os.path.join(self.input, name) for name in os.listdir(self.input)
+                         if os.path.isfile(os.path.join(self.input, name)) and not name.startswith('.')]
+        else:
+            base = os.path.dirname(os.path.abspath(self.input))
+
+            with open(self.input, 'r') as manifest:
+                documents = [os.path.join(base, line.strip()) for line in manifest
+                             if line.strip() != '' and not line.strip().startswith('#')]
+
+        return sorted(documents)
+
+    def create_job(self, input_file, used_names):
+        name = os.path.splitext(os.path.basename(input_file))[0]
+
+        # two inputs that only differ by extension get separate output folders
+        output_name = name
+        count = 1
+
+        while output_name in used_names:
+            count += 1
+            output_name = u'{0}_{1}'.format(name, count)
+
+        used_names.add(output_name)
+
+        args = dict(self.args)
+
+        for command in commands:
+            args[command] = False
+
+        args[input_types.get(os.path.splitext(input_file)[1].lower(), 'other')] = True
+        args['<input>'] = input_file
+        args['<output_folder>'] = os.path.join(self.output_root, output_name)
+
+        # there is nobody to answer prompts in a batch
+        args['--interactive'] = False
+
+        return args, input_file, args['<output_folder>'], self.settings
+
+    def run(self):
+        documents = self.list_documents()
+
+        if not os.path.isdir(self.output_root):
+            os.makedirs(self.output_root)
+
+        used_names = set()
+        jobs = [self.create_job(document, used_names) for document in documents]
+
+        self.debug.print_(self, u'Converting {0} document(s) with {1} worker(s)'.format(len(jobs), self.jobs))
+
+        start = time.time()
+        entries = []
+
+        if self.jobs > 1:
+            pool = multiprocessing.Pool(self.jobs)
+
+            try:
+                for entry in pool.imap_unordered(convert_document, jobs):
+                    entries.append(entry)
+                    self.report(entry, len(entries), len(jobs))
+            finally:
+                pool.close()
+                pool.join()
+        else:
+            for job in jobs:
+                entry = convert_document(job)
+                entries.append(entry)
+                self.report(entry, len(entries), len(jobs))
+
+        stop_worker_resources()
+
+        entries = sorted(entries, key=lambda item: item['input'])
+        converted = len([entry for entry in entries if entry['status'] == 'converted'])
+
+        summary = {'input': self.input, 'output': self.output_root, 'jobs': self.jobs,
+                   'documents': len(entries), 'converted': converted, 'failed': len(entries) - converted,
+                   'seconds': round(time.time() - start, 3), 'results': entries}
+
+        manifest_path = os.path.join(self.output_root, 'manifest.json')
+
+        with open(manifest_path, 'w') as manifest:
+            json.dump(summary, manifest, indent=4)
+
+        self.debug.print_(self, u'Converted {0} of {1} document(s) in {2}s. Manifest written to {3}'.format(
+            converted, len(entries), summary['seconds'], manifest_path))
+
+        return summary
+
+    def report(self, entry, done, total):
+        self.debug.print_(self, u'[{0}/{1}] {2}: {3}'.format(done, total, entry['input'], entry['status']))
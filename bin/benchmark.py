@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+"""benchmark.py: times meTypeset's modules over the test corpus and compares the timings with a stored baseline
+
+Usage:
+    benchmark.py run [options]
+
+Options:
+    -b, --baseline <baseline_file>                  Compare with (or, with --save, write) this baseline file
+    --corpus <corpus_folder>                        Folder of test documents (defaults to the tests folder)
+    -d, --debug                                     Enable debug output
+    --floor <seconds>                               Ignore regressions smaller than this [default: 0.01]
+    --full                                          Also time the full pipeline over the docx fixtures (needs Java)
+    --headings <counts>                             Comma separated numbers of headings of the heading stress documents
+    -h, --help                                      Show this screen.
+    -o, --output <output_file>                      Write the results to this file
+    -r, --repeat <repeat>                           Runs of each measurement (the fastest is kept) [default: 3]
+    --save                                          Write the results to the baseline file
+    --scale <factors>                               Comma separated sizes of the synthetic documents [default: 1,10]
+    -t, --threshold <percent>                       Fail on a slowdown of more than this percentage [default: 25]
+    -v, --version                                   Show version.
+"""
+
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that benchmarks meTypeset
+
+1.) Runs the TEI modules (SizeClassifier, ListClassifier, BibliographyClassifier...) in pipeline order over TEI
+    fixtures and synthetic TEI documents, timing each module in isolation
+2.) Runs the NLM modules (ReferenceLinker, CaptionClassifier, IdGenerator...) over the NLM fixtures of the corpus and
+    over scaled-up copies of them
+3.) Optionally times the SizeClassifier over stress documents of thousands of sections whose headings step up and
+    down through five sizes (--headings)
+4.) Optionally times the full pipeline over every docx fixture
+5.) Keeps the fastest of --repeat runs of each measurement, compares it with the baseline and exits with status 1 if
+    any measurement is slower by more than --threshold percent (and by more than --floor seconds), if a measurement in
+    the baseline was not taken or if any module raised an error
+"""
+
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+import traceback
+from docopt import docopt
+from lxml import etree
+from debug import Debug
+from debug import Debuggable
+from settingsconfiguration import Settings
+
+# the root elements of the corpus's NLM and TEI fixtures (other .xml files, such as settings files, are skipped)
+nlm_root = 'article'
+tei_root = '{http://www.tei-c.org/ns/1.0}TEI'
+
+tei_header = u'<?xml version="1.0" encoding="UTF-8"?><TEI xmlns="http://www.tei-c.org/ns/1.0"><teiHeader><fileDesc>' \
+             u'<titleStmt><title type="main"/></titleStmt><publicationStmt><p>unknown</p></publicationStmt>' \
+             u'<sourceDesc><p>Synthetic benchmark document</p></sourceDesc></fileDesc></teiHeader><text><body><div>'
+
+tei_footer = u'</div></body></text></TEI>'
+
+
+class Benchmark(Debuggable):
+    def __init__(self, args):
+        self.args = args
+        self.debug = Debug()
+
+        if self.args['--debug']:
+            self.debug.enable_debug(True)
+
+        Debuggable.__init__(self, 'Benchmark')
+
+        # locates the installation (and sets $METYPESET) as meTypeset.py does
+        Settings.get_settings_file(self, None)
+
+        self.corpus = self.args['--corpus'] or os.path.join(os.environ['METYPESET'], 'tests')
+        self.repeat = int(self.args['--repeat'])
+        self.scales = [int(scale) for scale in self.args['--scale'].split(',')]
+        self.headings = [int(count) for count in self.args['--headings'].split(',')] if self.args['--headings'] else []
+
+        if self.args['--baseline'] and not self.args['--save'] and not os.path.isfile(self.args['--baseline']):
+            self.debug.fatal_error(self, u'Baseline {0} does not exist (use --save to write it)'.format(
+                self.args['--baseline']))
+
+        self.work_folder = tempfile.mkdtemp(prefix='metypeset-benchmark-')
+        self.timings = {}
+        self.errors = {}
+
+    @staticmethod
+    def synthetic_tei(scale):
+        """
+        Builds a TEI document of the kind that the DOCX transform produces, with sized headings, styled headings,
+        dashed and numbered lists, citations and a reference list
+        @param scale: the number of sections
+        @return: the document as a string
+        """
+        parts = [tei_header]
+
+        for section in range(scale):
+            parts.append(u'<p><hi meTypesetSize="20">Section {0}</hi></p>'.format(section))
+            parts.append(u'<p>An opening paragraph that cites (Smith 2004; Jones 1999, p. 12) and [{0}].</p>'.format(
+                section + 1))
+            parts.append(u'<p rend="heading 2">A styled heading {0}</p>'.format(section))
+            parts.append(u'<p>Text with <hi rend="italic">italics</hi> and a footnote marker.<hi rend="superscript">'
+                         u'{0}</hi></p>'.format(section + 1))
+            parts.append(u'<p><hi meTypesetSize="16">A smaller heading<lb/>over two lines</hi></p>')
+            parts.append(u'<p>- a dashed list item</p><p>- another dashed list item</p>')
+            parts.append(u'<p>1. a numbered item</p><p>2. a second numbered item</p>')
+            parts.append(u'<p>A closing paragraph with a <ref target="http://example.org/{0}">link</ref>.</p>'.format(
+                section))
+
+        parts.append(u'<p><hi meTypesetSize="20">References</hi></p>')
+
+        for reference in range(scale * 3):
+            parts.append(u'<p>Author{0}, A. ({1}). A Title of a Work. London: Publisher.</p>'.format(
+                reference, 1950 + reference % 60))
+
+        parts.append(tei_footer)
+
+        return u''.join(parts)
+
+    @staticmethod
+    def synthetic_headings(count):
+        """
+        Builds a TEI document of flat sections with sized headings that go down one size at a time and come back up by
+        any number of sizes, as the nesting of headings by size sees them
+        @param count: the number of headings
+        @return: the document as a string
+        """
+        sizes = ['24', '20', '18', '16', '14']
+        generator = random.Random(count)
+        level = 0
+        parts = [tei_header, u'<head meTypesetSize="28">A Title</head><p>An abstract.</p>']
+
+        for heading in range(count):
+            parts.append(u'</div><div><head meTypesetSize="{0}">Heading {1}</head>'
+                         u'<p>The text of section {1}.</p>'.format(sizes[level], heading))
+
+            choice = generator.random()
+
+            if choice < 0.4 and level < len(sizes) - 1:
+                level += 1
+            elif choice > 0.7:
+                level = generator.randint(0, level)
+
+        parts.append(tei_footer)
+
+        return u''.join(parts)
+
+    @staticmethod
+    def scale_document(source, destination, scale, body_xpath, namespaces=None):
+        """
+        Writes a copy of a document with the children of its body repeated
+        @param source: the document to scale
+        @param destination: the path to write the scaled copy to
+        @param scale: how many times to repeat the body
+        @param body_xpath: an XPath expression that selects the body
+        @param namespaces: a namespace map for the XPath expression
+        """
+        parser = etree.XMLParser(resolve_entities=False, load_dtd=False, no_network=True)
+        tree = etree.parse(source, parser)
+
+        for body in tree.xpath(body_xpath, namespaces=namespaces):
+            children = list(body)
+
+            for copy in range(scale - 1):
+                for child in children:
+                    body.append(etree.fromstring(etree.tostring(child)))
+
+        tree.write(destination, xml_declaration=True, encoding='UTF-8')
+
+    @staticmethod
+    def root_tag(path):
+        """
+        Reads the tag of a document's root element
+        @param path: the document
+        @return: the tag, or None if the document is not well-formed XML
+        """
+        try:
+            for event, element in etree.iterparse(path, events=('start',), resolve_entities=False, load_dtd=False,
+                                                  no_network=True):
+                return element.tag
+        except etree.XMLSyntaxError:
+            return None
+
+    def documents(self):
+        """
+        Writes the benchmark inputs to the work folder
+        @return: a tuple of lists of (name, path) for TEI inputs, NLM inputs and heading stress inputs
+        """
+        tei_documents = []
+        nlm_documents = []
+        heading_documents = []
+
+        for name in sorted(os.listdir(self.corpus)):
+            path = os.path.join(self.corpus, name)
+
+            if not name.endswith('.xml') or not os.path.isfile(path):
+                continue
+
+            root = self.root_tag(path)
+
+            if root == nlm_root:
+                nlm_documents.append((name, path))
+            elif root == tei_root:
+                tei_documents.append((name, path))
+
+        # only the NLM fixtures that this corpus actually holds are scaled
+        corpus_nlm = list(nlm_documents)
+
+        for scale in self.scales:
+            path = os.path.join(self.work_folder, u'synthetic-{0}.xml'.format(scale))
+
+            with open(path, 'w') as synthetic:
+                synthetic.write(self.synthetic_tei(scale))
+
+            tei_documents.append((u'synthetic x{0}'.format(scale), path))
+
+            if scale > 1:
+                for name, source in corpus_nlm:
+                    scaled = os.path.join(self.work_folder, u'{0}-{1}'.format(scale, name))
+                    self.scale_document(source, scaled, scale, '/article/body')
+                    nlm_documents.append((u'{0} x{1}'.format(name, scale), scaled))
+
+        for count in self.headings:
+            path = os.path.join(self.work_folder, u'headings-{0}.xml'.format(count))
+
+            with open(path, 'w') as synthetic:
+                synthetic.write(self.synthetic_headings(count))
+
+            heading_documents.append((u'headings x{0}'.format(count), path))
+
+        return tei_documents, nlm_documents, heading_documents
+
+    def output_folder(self):
+        # meTypeset refuses to write into a folder that already exists
+        return os.path.join(tempfile.mkdtemp(dir=self.work_folder), 'out')
+
+    def tei_stages(self, path):
+        from meTypeset import MeTypeset, DocxToTei, SizeClassifier, BibliographyAddins, ListClassifier, \
+            BibliographyClassifier, TeiManipulate, Metadata
+        import meTypeset
+
+        args = docopt(meTypeset.__doc__, argv=['tei', path, self.output_folder()])
+        gv = MeTypeset(args).gv
+
+        def setup():
+            gv.mk_dir(gv.output_folder_path)
+            DocxToTei(gv).run(False, False, tei=True)
+
+        return gv, [('setup', setup),
+                    ('Metadata', lambda: Metadata(gv).pre_clean()),
+                    ('SizeClassifier', lambda: SizeClassifier(gv).run()),
+                    ('BibliographyAddins', lambda: BibliographyAddins(gv).run()),
+                    ('ListClassifier', lambda: ListClassifier(gv).run()),
+                    ('BibliographyClassifier', lambda: BibliographyClassifier(gv).run()),
+                    ('TeiManipulate', lambda: TeiManipulate(gv).run())]
+
+    def heading_stages(self, path):
+        gv, stages = self.tei_stages(path)
+
+        return gv, [(stage, method) for stage, method in stages if stage in ['setup', 'SizeClassifier']]
+
+    def nlm_stages(self, path):
+        from bare_globals import GV
+        from teitonlm import TeiToNlm
+        from nlmmanipulate import NlmManipulate
+        from referencelinker import ReferenceLinker
+        from captionclassifier import CaptionClassifier
+        from idgenerator import IdGenerator
+        from complianceenforcer import ComplianceEnforcer
+        import nlmprocessor
+
+        # the NLM modules rewrite their input, so they run over a copy
+        copy = os.path.join(tempfile.mkdtemp(dir=self.work_folder), os.path.basename(path))
+        shutil.copy2(path, copy)
+
+        gv = GV(docopt(nlmprocessor.__doc__, argv=['process', copy]))
+
+        def reference_linker():
+            linker = ReferenceLinker(gv)
+            linker.run(False)
+            linker.cleanup()
+
+        def caption_classifier():
+            classifier = CaptionClassifier(gv)
+            classifier.run_tables()
+            classifier.run_graphics()
+            classifier.run_ext_link_compliance()
+
+        return gv, [('TeiToNlm', lambda: TeiToNlm(gv).run(True, False)),
+                    ('ReferenceLinker', reference_linker),
+                    ('CaptionClassifier', caption_classifier),
+                    ('NlmManipulate', lambda: NlmManipulate(gv).final_clean()),
+                    ('IdGenerator', lambda: IdGenerator(gv).run()),
+                    ('ComplianceEnforcer', lambda: ComplianceEnforcer(gv).run())]
+
+    def record(self, key, seconds):
+        if key not in self.timings or seconds < self.timings[key]:
+            self.timings[key] = seconds
+
+    def time_stages(self, name, stages_factory, path):
+        """
+        Runs a sequence of modules over a fresh copy of a document and times each one, including its commit point
+        @param name: the name of the document in the results
+        @param stages_factory: a method that returns the GV and a list of (module name, callable) for a document; a
+        stage named setup is run but not timed
+        @param path: the path to the document
+        """
+        for run in range(self.repeat):
+            gv, stages = stages_factory(path)
+
+            for stage, method in stages:
+                key = u'{0} / {1}'.format(name, stage)
+                start = time.time()
+
+                try:
+                    method()
+                    gv.session.commit(self)
+                except SystemExit:
+                    self.errors[key] = 'Fatal error'
+                    continue
+                except Exception:
+                    self.errors[key] = traceback.format_exc().strip().split('\n')[-1]
+                    continue
+
+                if stage != 'setup':
+                    self.record(key, time.time() - start)
+
+    def time_pipeline(self, name, path):
+        from meTypeset import MeTypeset
+        import meTypeset
+
+        key = u'{0} / pipeline'.format(name)
+
+        for run in range(self.repeat):
+            output = self.output_folder()
+            args = docopt(meTypeset.__doc__, argv=['docx', path, output])
+            start = time.time()
+
+            try:
+                MeTypeset(args).run()
+            except SystemExit:
+                self.errors[key] = 'Fatal error'
+                return
+            except Exception:
+                self.errors[key] = traceback.format_exc().strip().split('\n')[-1]
+                return
+
+            if not os.path.isfile(os.path.join(output, 'nlm', 'out.xml')):
+                self.errors[key] = 'No NLM output'
+                return
+
+            self.record(key, time.time() - start)
+
+    def compare(self, baseline):
+        """
+        Compares the timings with a baseline
+        @param baseline: the timings of a previous run
+        @return: a list of the keys that regressed, that are in the baseline but were not timed or that raised an error
+        """
+        threshold = float(self.args['--threshold'])
+        floor = float(self.args['--floor'])
+        regressions = []
+
+        for key in sorted(self.timings):
+            if key not in baseline:
+                self.debug.print_(self, u'{0}: {1:.4f}s (new)'.format(key, self.timings[key]))
+                continue
+
+            seconds = self.timings[key]
+            before = baseline[key]
+            change = (seconds - before) / before * 100 if before > 0 else 0
+            regressed = change > threshold and seconds - before > floor
+
+            if regressed:
+                regressions.append(key)
+
+            self.debug.print_(self, u'{0}: {1:.4f}s (baseline {2:.4f}s, {3:+.1f}%){4}'.format(
+                key, seconds, before, change, ' REGRESSION' if regressed else ''))
+
+        # a measurement that crashed or disappeared is a failure, not a skipped comparison
+        for key in sorted(set(baseline) - set(self.timings)):
+            self.debug.print_(self, u'{0}: in the baseline but not timed MISSING'.format(key))
+            regressions.append(key)
+
+        for key in sorted(self.errors):
+            if key not in regressions:
+                regressions.append(key)
+
+        return regressions
+
+    def run(self):
+        tei_documents, nlm_documents, heading_documents = self.documents()
+
+        try:
+            for name, path in tei_documents:
+                self.debug.print_(self, u'Timing TEI modules over {0}'.format(name))
+                self.time_stages(name, self.tei_stages, path)
+
+            for name, path in nlm_documents:
+                self.debug.print_(self, u'Timing NLM modules over {0}'.format(name))
+                self.time_stages(name, self.nlm_stages, path)
+
+            for name, path in heading_documents:
+                self.debug.print_(self, u'Timing heading nesting over {0}'.format(name))
+                self.time_stages(name, self.heading_stages, path)
+
+            if self.args['--full']:
+                for name in sorted(os.listdir(self.corpus)):
+                    if name.endswith('.docx'):
+                        self.debug.print_(self, u'Timing the full pipeline over {0}'.format(name))
+                        self.time_pipeline(name, os.path.join(self.corpus, name))
+        finally:
+            shutil.rmtree(self.work_folder, ignore_errors=True)
+
+        for key in sorted(self.errors):
+            self.debug.print_(self, u'{0}: not timed ({1})'.format(key, self.errors[key]))
+
+        results = {'python': platform.python_version(), 'machine': platform.machine(), 'repeat': self.repeat,
+                   'scales': self.scales, 'headings': self.headings, 'timings': self.timings, 'errors': self.errors}
+
+        if self.args['--output']:
+            with open(self.args['--output'], 'w') as output:
+                json.dump(results, output, indent=4, sort_keys=True)
+
+        baseline_file = self.args['--baseline']
+
+        if baseline_file and self.args['--save']:
+            with open(baseline_file, 'w') as baseline:
+                json.dump(results, baseline, indent=4, sort_keys=True)
+
+            self.debug.print_(self, u'Wrote {0} timing(s) to baseline {1}'.format(len(self.timings), baseline_file))
+
+            if len(self.errors) > 0:
+                self.debug.print_(self, u'{0} measurement(s) raised an error'.format(len(self.errors)))
+                return False
+
+            return True
+
+        baseline = {}
+
+        if baseline_file:
+            with open(baseline_file, 'r') as baseline_json:
+                baseline = json.load(baseline_json)['timings']
+
+        regressions = self.compare(baseline)
+
+        if len(regressions) > 0:
+            self.debug.print_(self, u'{0} measurement(s) regressed by more than {1}%, were not timed or raised an '
+                                    u'error'.format(len(regressions), self.args['--threshold']))
+            return False
+
+        return True
+
+
+def main():
+    args = docopt(__doc__, version='meTypeset 0.1')
+
+    if not Benchmark(args).run():
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -122,11 +122,11 @@ class OtherHandler(Debuggable):
         tei_manipulator = TeiManipulate(self.gv)
         object_list = tei_manipulator.get_object_list('//*', ' ADDIN', u'addin')
 
-        drop = self.gv.settings.get_setting('drop-unknown-addins', self)
+        drop = self.gv.settings.get_boolean('drop-unknown-addins', self)
 
         tei_manipulator.drop_addin('//*', ' ADDIN', 'EndNote',
                                    'hi', 'unknown_addin_text', self, u'addin',
-                                   drop == 'True')
+                                   drop)
 
         if len(object_list) > 0:
             self.debug.print_debug(self, u'Handled {0} unknown addin tags'.format(len(object_list)))
@@ -150,8 +150,7 @@ class BibliographyAddins(Debuggable):
         """
         Run the procedure to process different types of bibliography
         """
-        if int(self.gv.settings.args['--aggression']) < int(self.gv.settings.get_setting('bibliographyaddins', self,
-                                                                                         domain='aggression')):
+        if int(self.gv.settings.args['--aggression']) < self.gv.settings.get_aggression('bibliographyaddins', self):
             self.debug.print_debug(self, u'Aggression level too low: exiting module.')
             return
 
@@ -25,7 +25,6 @@ A class that assists with bibliography classification.
 """
 
 from debug import Debuggable
-import codecs
 
 
 class BibliographyClassifier(Debuggable):
@@ -39,19 +38,13 @@ class BibliographyClassifier(Debuggable):
         self.debug.print_debug(self, u'Using linguistic cue method to classify bibliography')
         language_list = self.gv.settings.get_setting('reference-languages', self).split(',')
 
-        for language in language_list:
-            with codecs.open('{0}/language/ref_marker_{1}.txt'.format(self.gv.script_dir, language),
-                             encoding='utf-8') as lang_file:
-                lines = lang_file.read().split('\n')
+        # every cue of every language is matched in one pass, with the earlier language and line winning
+        cues = Manipulate.get_cue_priorities(self.gv.script_dir, language_list)
 
-                for line in lines:
-                    if line.strip() != '':
-                        if manipulate.find_references_from_cue(line, tree):
-                            return True
+        return manipulate.find_references_from_cue(cues, tree)
 
     def run(self):
-        if int(self.gv.settings.args['--aggression']) < int(self.gv.settings.get_setting('bibliographyclassifier', self,
-                                                                                         domain='aggression')):
+        if int(self.gv.settings.args['--aggression']) < self.gv.settings.get_aggression('bibliographyclassifier', self):
             self.debug.print_debug(self, u'Aggression level less than 4: exiting module.')
             return
 
@@ -172,5 +165,7 @@ def main():
     if args['confirm']:
         bc_instance.run_prompt(args['--interactive'])
 
+    bare_gv.session.commit(bc_instance)
+
 if __name__ == '__main__':
     main()
\ No newline at end of file
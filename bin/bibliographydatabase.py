@@ -339,6 +339,9 @@ class JournalArticle():
         return ret
 
 class BibliographyDatabase(Debuggable):
+    # each opened Zotero library, keyed by its path; a library re-indexes when its database's mtime changes
+    zotero_libraries = {}
+
     def __init__(self, global_variables):
         Debuggable.__init__(self, 'Bibliography Database')
         self.gv = global_variables
@@ -348,7 +351,16 @@ class BibliographyDatabase(Debuggable):
 
     def process_zotero(self):
         from zotero import libzotero
-        zotero = libzotero.LibZotero(self.gv.settings.get_setting(u'zotero', self), self.gv)
+        zotero_path = self.gv.settings.get_setting(u'zotero', self)
+
+        if zotero_path in BibliographyDatabase.zotero_libraries:
+            # the library re-indexes itself if the database has changed since it was opened
+            zotero = BibliographyDatabase.zotero_libraries[zotero_path]
+            zotero.gv = self.gv
+            zotero.debug = self.gv.debug
+        else:
+            zotero = libzotero.LibZotero(zotero_path, self.gv)
+            BibliographyDatabase.zotero_libraries[zotero_path] = zotero
 
         manipulate = NlmManipulate(self.gv)
         master_tree = manipulate.load_dom_tree()
@@ -18,7 +18,6 @@ from bare_globals import GV
 from debug import Debuggable
 from nlmmanipulate import NlmManipulate
 from lxml import etree
-import uuid
 import re
 import editdistance
 
@@ -207,7 +206,7 @@ class CaptionClassifier(Debuggable):
                     graphic.tail = graphic.tail.replace(caption, '')
 
                 if not 'id' in graphic.attrib:
-                    graphic.attrib['id'] = u'ID{0}'.format(uuid.uuid4())
+                    graphic.attrib['id'] = self.gv.identifiers.new_id(self)
 
                 graphic_titles.append(title)
                 graphic_ids.append(graphic.attrib['id'])
@@ -216,8 +215,7 @@ class CaptionClassifier(Debuggable):
 
         self.link(graphic_ids, graphic_titles, paragraphs, 'fig')
 
-        tree.write(self.gv.nlm_file_path)
-        tree.write(self.gv.nlm_temp_file_path)
+        manipulate.save_tree(tree)
 
     def run_graphics(self):
         # images are hard to handle because Word/OO puts them in different places
@@ -291,7 +289,7 @@ class CaptionClassifier(Debuggable):
                     graphic.tail = graphic.tail.replace(caption, '')
 
                 if not 'id' in graphic.attrib:
-                    graphic.attrib['id'] = u'ID{0}'.format(uuid.uuid4())
+                    graphic.attrib['id'] = self.gv.identifiers.new_id(self)
 
                 graphic_titles.append(title)
                 graphic_ids.append(graphic.attrib['id'])
@@ -300,8 +298,7 @@ class CaptionClassifier(Debuggable):
 
         self.link(graphic_ids, graphic_titles, paragraphs, 'fig')
 
-        tree.write(self.gv.nlm_file_path)
-        tree.write(self.gv.nlm_temp_file_path)
+        manipulate.save_tree(tree)
 
         self.run_graphics_sibling()
 
@@ -432,7 +429,7 @@ class CaptionClassifier(Debuggable):
                 table.insert(1, caption_element)
 
                 if not 'id' in table.attrib:
-                    table.attrib['id'] = u'ID{0}'.format(uuid.uuid4())
+                    table.attrib['id'] = self.gv.identifiers.new_id(self)
 
                 table_titles.append(title)
                 table_ids.append(table.attrib['id'])
@@ -504,8 +501,7 @@ class CaptionClassifier(Debuggable):
 
         self.link(table_ids, table_titles, paragraphs, 'table')
 
-        tree.write(self.gv.nlm_file_path)
-        tree.write(self.gv.nlm_temp_file_path)
+        manipulate.save_tree(tree)
 
 
     def run_ext_link_compliance(self):
@@ -521,8 +517,7 @@ class CaptionClassifier(Debuggable):
             parent = link_parent.getparent()
             parent.insert(parent.index(link_parent)+1, link)
 
-        tree.write(self.gv.nlm_file_path)
-        tree.write(self.gv.nlm_temp_file_path)
+        manipulate.save_tree(tree)
 
 
 def main():
@@ -543,5 +538,7 @@ def main():
     if args['all'] or args['enforce']:
         table_classifier_instance.run_ext_link_compliance()
 
+    bare_gv.session.commit(table_classifier_instance)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,136 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that checkpoints each stage of a meTypeset run so that a failed or slow run can be restarted part way through
+with --resume-from.
+
+1.) After each stage's commit point, copies the TEI and NLM files into output_folder/checkpoints/NN-stage along with
+    a state file holding the GV flags (used_list_method, used_square_reference_method...) and run values. This is only
+    done with stage-checkpoints set in the settings or with debug output on.
+2.) On --resume-from <stage>, restores the files and flags of the last checkpoint before that stage and removes the
+    folders that the resumed stages create, so that the run continues in the output folder of the earlier run
+"""
+
+import json
+import os
+import shutil
+from debug import Debuggable
+
+# the stages of run_modules in order; --resume-from takes one of these names
+stages = ['docxtotei', 'metadata', 'sizeclassifier', 'bibliographyaddins', 'listclassifier',
+          'bibliographyclassifier', 'teimanipulate', 'teitonlm', 'fusereferences', 'referencelinker',
+          'captionclassifier', 'doublep', 'metadatamerge', 'bibliographydatabase', 'finalclean', 'idgenerator',
+          'xslchain', 'complianceenforcer']
+
+# the GV attributes that later stages read from earlier ones
+flags = ['used_list_method', 'used_square_reference_method', 'input_file_path', 'tei_file_path']
+
+# the output folders that a stage creates with mk_dir (which fails if the folder exists)
+created_folders = {'teitonlm': 'nlm_folder_path', 'xslchain': 'xsl_folder_path'}
+
+
+class Checkpoints(Debuggable):
+    def __init__(self, gv):
+        self.gv = gv
+        self.debug = self.gv.debug
+        self.folder = os.path.join(self.gv.output_folder_path, 'checkpoints')
+        # copying every document at every stage costs I/O, so checkpoints are only taken when asked for or debugging
+        self.enabled = self.gv.settings.get_boolean('stage-checkpoints', self) or self.debug.debug
+        self.resume_index = 0
+        self.values = {}
+        Debuggable.__init__(self, 'Checkpoints')
+
+    def should_run(self, stage):
+        """
+        @param stage: the name of a stage
+        @return: False if the stage comes before the stage that this run resumes from
+        """
+        return stages.index(stage) >= self.resume_index
+
+    def documents(self):
+        return [self.gv.tei_file_path, self.gv.nlm_file_path, self.gv.nlm_temp_file_path]
+
+    def commit(self, stage, module):
+        """
+        Commits a module's work to the document session and checkpoints the stage
+        @param stage: the name of the stage
+        @param module: the module whose work is committed
+        """
+        self.gv.session.commit(module, stage)
+        self.save(stage)
+
+    def save(self, stage):
+        if not self.enabled:
+            return
+
+        checkpoint = os.path.join(self.folder, u'{0:02d}-{1}'.format(stages.index(stage), stage))
+
+        if os.path.isdir(checkpoint):
+            shutil.rmtree(checkpoint)
+
+        os.makedirs(checkpoint)
+
+        state = {'stage': stage, 'flags': {}, 'values': self.values, 'documents': {}}
+
+        for flag in flags:
+            state['flags'][flag] = getattr(self.gv, flag)
+
+        for number, document in enumerate(self.documents()):
+            if os.path.isfile(document):
+                name = u'{0}-{1}'.format(number, os.path.basename(document))
+                shutil.copy2(document, os.path.join(checkpoint, name))
+                state['documents'][name] = os.path.relpath(document, self.gv.output_folder_path)
+
+        with open(os.path.join(checkpoint, 'state.json'), 'w') as state_file:
+            json.dump(state, state_file, indent=4)
+
+        self.debug.print_debug(self, u'Checkpointed stage {0}'.format(stage))
+
+    def resume(self, stage):
+        """
+        Restores the output folder to the state it was in before a stage ran
+        @param stage: the name of the stage to resume from
+        """
+        if stage not in stages:
+            self.debug.fatal_error(self, u'Unknown stage {0}. Stages are: {1}'.format(stage, u', '.join(stages)))
+
+        self.resume_index = stages.index(stage)
+
+        checkpoint = None
+
+        for index in range(self.resume_index - 1, -1, -1):
+            candidate = os.path.join(self.folder, u'{0:02d}-{1}'.format(index, stages[index]))
+
+            if os.path.isfile(os.path.join(candidate, 'state.json')):
+                checkpoint = candidate
+                break
+
+        if checkpoint is None:
+            self.debug.fatal_error(self, u'There is no checkpoint before stage {0} in {1}'.format(stage, self.folder))
+
+        with open(os.path.join(checkpoint, 'state.json'), 'r') as state_file:
+            state = json.load(state_file)
+
+        for flag, value in state['flags'].items():
+            setattr(self.gv, flag, value)
+
+        self.values = state['values']
+
+        for document in self.documents():
+            if os.path.isfile(document):
+                os.remove(document)
+
+        for name, document in state['documents'].items():
+            shutil.copy2(os.path.join(checkpoint, name), os.path.join(self.gv.output_folder_path, document))
+
+        for created_stage, folder in created_folders.items():
+            if stages.index(created_stage) >= self.resume_index and os.path.isdir(getattr(self.gv, folder)):
+                shutil.rmtree(getattr(self.gv, folder))
+
+        # carry on appending to the error log of the earlier run
+        if os.path.isdir(self.gv.error_folder_path):
+            self.debug.has_run = True
+
+        self.debug.print_(self, u'Resuming from stage {0} using the checkpoint of stage {1}'.format(stage,
+                                                                                                state['stage']))
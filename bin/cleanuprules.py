@@ -0,0 +1,94 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that applies a set of cleanup rules to a document in one traversal of its tree, in place of a separate XPath
+pass (and save) for each kind of cleanup.
+
+1.) Each rule has a selector (the tags that it applies to, or None for every element, and optionally an XPath test
+    that is evaluated with the element as its context) and an action that is called with each matching element
+2.) One walk of the tree visits every element after its descendants and applies the matching rules in the order in
+    which they were added; rules added with before_children=True are applied when the element is entered instead, so
+    that they see the elements in the order that a //tag XPath would return them
+3.) The rules are matched against the element's current tag, and no further rule is applied to an element once an
+    action has removed it from the tree
+4.) The tree is saved once, after the walk
+"""
+
+from lxml import etree
+from debug import Debuggable
+
+
+class CleanupRule(object):
+    def __init__(self, name, tags, action, test, before_children):
+        self.name = name
+        self.tags = None if tags is None else set([tags] if isinstance(tags, str) else tags)
+        self.action = action
+        self.test = None if test is None else etree.XPath(test)
+        self.before_children = before_children
+        self.count = 0
+
+    def matches(self, element):
+        if self.tags is not None and element.tag not in self.tags:
+            return False
+
+        return self.test is None or bool(self.test(element))
+
+
+class CleanupRules(Debuggable):
+    def __init__(self, manipulate):
+        self.manipulate = manipulate
+        self.debug = manipulate.debug
+        self.rules = []
+        Debuggable.__init__(self, 'Cleanup Rules')
+
+    def add(self, name, tags, action, test=None, before_children=False):
+        """
+        Adds a rule to the set
+        @param name: a description of what the rule changes, for the debug output
+        @param tags: a tag or a list of tags that the rule applies to, or None for every element
+        @param action: a function that is called with each matching element and returns True if it changed it
+        @param test: an XPath expression that must be true with the element as its context (e.g. "parent::sec"), or None
+        @param before_children: True to apply the rule when the element is entered, before its descendants are visited
+        """
+        self.rules.append(CleanupRule(name, tags, action, test, before_children))
+
+    def apply(self, element, rules, root):
+        for rule in rules:
+            if rule.matches(element) and rule.action(element):
+                rule.count += 1
+
+                if element is not root and element.getparent() is None:
+                    return
+
+    def run(self):
+        tree = self.manipulate.load_dom_tree()
+        root = tree.getroot()
+
+        entering = [rule for rule in self.rules if rule.before_children]
+        leaving = [rule for rule in self.rules if not rule.before_children]
+
+        events = [event for event, rules in [('start', entering), ('end', leaving)] if len(rules) > 0]
+
+        # when every rule names its tags, the walk only stops at elements that have one of them
+        tags = None
+
+        if len([rule for rule in self.rules if rule.tags is None]) == 0:
+            tags = set()
+
+            for rule in self.rules:
+                tags.update(rule.tags)
+
+            tags = list(tags)
+
+        # the walk is taken before any rule runs, so actions may move and remove elements freely
+        walk = [(event, element) for event, element in etree.iterwalk(root, events=events, tag=tags)
+                if isinstance(element.tag, str)]
+
+        for event, element in walk:
+            self.apply(element, entering if event == 'start' else leaving, root)
+
+        self.manipulate.save_tree(tree)
+
+        for rule in self.rules:
+            self.debug.print_debug(self, u'{0}: {1} element(s)'.format(rule.name, rule.count))
@@ -3,6 +3,7 @@ __email__ = "martin@martineve.com"
 
 from debug import Debuggable
 from nlmmanipulate import *
+from cleanuprules import CleanupRules
 
 
 class ComplianceEnforcer(Debuggable):
@@ -11,44 +12,41 @@ class ComplianceEnforcer(Debuggable):
         self.debug = self.gv.debug
         Debuggable.__init__(self, 'Compliance Enforcer')
 
-    def run(self):
-        manipulate = NlmManipulate(self.gv)
-
-        self.debug.print_debug(self, u'Removing meTypeset specific attributes and tags')
-
-        tree = manipulate.load_dom_tree()
+    @staticmethod
+    def remove_attribute(element, attribute):
+        if attribute not in element.attrib:
+            return False
 
-        render_attributes = tree.xpath('//*[@meTypesetRender]')
+        del element.attrib[attribute]
 
-        for attribute in render_attributes:
-            del attribute.attrib['meTypesetRender']
+        return True
 
-        manipulate.save_tree(tree)
-        self.debug.print_debug(self, u'Removing {0} meTypesetRender attributes'.format(len(render_attributes)))
+    @staticmethod
+    def remove_unlinked_xref(xref):
+        if 'rid' in xref.attrib and (xref.attrib['rid'] == 'TO_LINK' or xref.attrib['rid'] == 'TO_LINK_NUMBER'):
+            xref.tag = 'REMOVE'
+            etree.strip_tags(xref.getparent(), 'REMOVE')
 
-        reflist_attributes = tree.xpath('//*[@reflist]')
+            return True
 
-        for attribute in  reflist_attributes:
-            del attribute.attrib['reflist']
+        return False
 
-        manipulate.save_tree(tree)
-        self.debug.print_debug(self, u'Removing {0} reflist attributes'.format(len(reflist_attributes)))
+    @staticmethod
+    def remove_tag(element):
+        element.tag = 'REMOVE'
+        etree.strip_tags(element.getparent(), 'REMOVE')
 
-        unlinked_xrefs = tree.xpath('//xref')
+        return True
 
-        for xref in unlinked_xrefs:
-            if 'rid' in xref.attrib and (xref.attrib['rid'] == 'TO_LINK' or xref.attrib['rid'] == 'TO_LINK_NUMBER'):
-                xref.tag = 'REMOVE'
-                etree.strip_tags(xref.getparent(), 'REMOVE')
-
-        manipulate.save_tree(tree)
-        self.debug.print_debug(self, u'Removing {0} unlinked xref elements'.format(len(unlinked_xrefs)))
-
-        mis_nested_xrefs = tree.xpath('//ext-link/xref')
+    def run(self):
+        manipulate = NlmManipulate(self.gv)
 
-        for tag in mis_nested_xrefs:
-            tag.tag = 'REMOVE'
+        self.debug.print_debug(self, u'Removing meTypeset specific attributes and tags')
 
-        etree.strip_tags(tree, 'REMOVE')
-        manipulate.save_tree(tree)
-        self.debug.print_debug(self, u'Removing {0} mis-nested ext-link/xref tags'.format(len(mis_nested_xrefs)))
+        rules = CleanupRules(manipulate)
+        rules.add(u'Removed meTypesetRender attributes', None,
+                  lambda element: self.remove_attribute(element, 'meTypesetRender'))
+        rules.add(u'Removed reflist attributes', None, lambda element: self.remove_attribute(element, 'reflist'))
+        rules.add(u'Removed unlinked xref elements', 'xref', self.remove_unlinked_xref)
+        rules.add(u'Removed mis-nested ext-link/xref tags', 'xref', self.remove_tag, 'parent::ext-link')
+        rules.run()
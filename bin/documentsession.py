@@ -0,0 +1,201 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that holds the live DOM trees shared by every manipulator during a run.
+
+1.) Parses each document (TEI or NLM) from disk only the first time it is requested
+2.) Hands the same tree to every subsequent caller so that modules no longer re-parse the file
+3.) Turns save_tree into a cheap "mark dirty" call; dirty trees are serialized once, at an explicit commit point
+4.) Writes through on every save when running with --debug and git snapshots, so each snapshot shows the change
+5.) Counts, per module, how many serializations the commit points avoided, and marks the end of a profiler stage at
+    each commit point
+6.) Is told when an external process (Saxon) has rewritten a file so that the next request re-parses it
+7.) Empties the manipulators' text cache whenever a tree is saved, released or committed
+8.) Drops the style index of a tree when the tree is released or replaced
+"""
+
+from lxml import etree
+from debug import Debuggable
+from manipulate import Manipulate
+
+
+class DocumentSession(Debuggable):
+    def __init__(self, global_variables):
+        self.gv = global_variables
+        self.debug = self.gv.debug
+        self.trees = {}
+        self.dirty = {}
+        self.unnormalized = set()
+        self.avoided = {}
+        self.saves = 0
+        self.parses = 0
+        self.serializations = 0
+        self.pending_saves = 0
+        self.pending_serializations = 0
+        Debuggable.__init__(self, 'Document Session')
+
+    def get_tree(self, manipulate):
+        """
+        Returns the live tree for the document handled by a manipulator, parsing it only if it is not yet held
+        @param manipulate: a Manipulate object whose dom_to_load identifies the document
+        @return: the shared lxml ElementTree
+        """
+        path = manipulate.dom_to_load
+
+        if path not in self.trees:
+            self.trees[path] = manipulate.set_dom_tree(path)
+            self.parses += 1
+            self.drop_styles()
+            self.debug.print_debug(self, u'Parsed {0} into the document session'.format(path))
+
+        elif path in self.unnormalized:
+            self.normalize(self.trees[path])
+            self.unnormalized.discard(path)
+
+        return self.trees[path]
+
+    def write_through(self):
+        return self.debug.debug and self.debug.git
+
+    def save_tree(self, manipulate, tree):
+        """
+        Makes the given tree the live tree for the manipulator's document and marks it dirty. The tree is written out
+        at the next commit point (or immediately in write-through mode).
+        @param manipulate: a Manipulate object whose dom_to_load identifies the document
+        @param tree: an lxml ElementTree or element (for instance a tree restored from a backup)
+        """
+        if not isinstance(tree, etree._ElementTree):
+            tree = tree.getroottree()
+
+        path = manipulate.dom_to_load
+
+        if path in self.trees and self.trees[path].getroot() is not tree.getroot():
+            # a tree restored from a backup has no style index until one is asked for
+            Manipulate.styles.pop(self.trees[path].getroot(), None)
+
+        self.trees[path] = tree
+        self.unnormalized.add(path)
+        Manipulate.texts.clear()
+        self.saves += 1
+        self.pending_saves += 1
+
+        if self.write_through():
+            self.write(path, manipulate)
+        else:
+            self.dirty[path] = manipulate
+
+    def write(self, path, manipulate):
+        tree = self.trees[path]
+
+        if path in self.unnormalized:
+            self.normalize(tree)
+            self.unnormalized.discard(path)
+
+        manipulate.write_tree(tree)
+        self.serializations += 1
+        self.pending_serializations += 1
+
+    def commit(self, caller, stage=None):
+        """
+        Serializes every dirty tree. This must be called at the end of each module and before any process outside of
+        Python (Saxon) reads a document from disk.
+        @param caller: the module whose work is being committed; the avoided serializations are counted against it
+        @param stage: the name of the pipeline stage being committed, if the module commits at more than one point
+        """
+        for path, manipulate in list(self.dirty.items()):
+            self.write(path, manipulate)
+
+        self.dirty = {}
+        Manipulate.texts.clear()
+
+        avoided = self.pending_saves - self.pending_serializations
+        name = caller.get_module_name()
+        self.avoided[name] = self.avoided.get(name, 0) + avoided
+
+        if self.pending_saves > 0:
+            self.debug.print_debug(self, u'Committed {0} save(s) from {1} with {2} serialization(s), '
+                                         u'avoiding {3}'.format(self.pending_saves, name,
+                                                                self.pending_serializations, avoided))
+
+        self.pending_saves = 0
+        self.pending_serializations = 0
+
+        self.gv.profiler.checkpoint(caller, stage)
+
+    def report(self):
+        """
+        Prints the number of serializations that each module avoided by saving to the session
+        """
+        for name, avoided in self.avoided.items():
+            if avoided > 0:
+                self.debug.print_debug(self, u'{0} avoided {1} serialization(s)'.format(name, avoided))
+
+        self.debug.print_debug(self, u'{0} save(s) resulted in {1} serialization(s) and {2} parse(s)'.format(
+            self.saves, self.serializations, self.parses))
+
+    @staticmethod
+    def normalize(tree):
+        """
+        Makes a live tree look as it would after a write and a re-parse, which is what modules have always seen on their
+        next load_dom_tree call after a save:
+        1.) elements created without a namespace (etree.Element('p')) move into the default namespace in scope
+        2.) whitespace-only text between elements is dropped, as the remove_blank_text parser does
+        3.) empty strings of text become None
+        @param tree: an lxml ElementTree
+        """
+        for element in tree.iter():
+            DocumentSession.normalize_element(element)
+
+    @staticmethod
+    def normalize_element(element):
+        """
+        Normalizes one element (its tag, its text and the tails of its children) as normalize does
+        @param element: an lxml element
+        """
+        if isinstance(element.tag, str) and not element.tag.startswith('{'):
+            namespace = element.nsmap.get(None)
+
+            if namespace is not None:
+                element.tag = u'{{{0}}}{1}'.format(namespace, element.tag)
+
+        # an empty string does not survive a re-parse and would make p[not(node())] miss an empty paragraph
+        if element.text == '':
+            element.text = None
+
+        if element.tail == '':
+            element.tail = None
+
+        if len(element) == 0 or (element.text is not None and element.text.strip() != ''):
+            return
+
+        element.text = None
+
+        for child in element:
+            if child.tail is not None and child.tail.strip() == '':
+                child.tail = None
+
+    def drop_styles(self):
+        """
+        Drops the style indexes of trees that are no longer live (those of documents converted earlier in a batch)
+        """
+        roots = [tree.getroot() for tree in self.trees.values()]
+
+        for root in list(Manipulate.styles):
+            if root not in roots:
+                del Manipulate.styles[root]
+
+    def release(self, path):
+        """
+        Drops the live tree for a document. This must be called when a stage outside of Python (Saxon) has rewritten
+        the file on disk so that the next manipulator re-parses it.
+        @param path: the path of the document to release
+        """
+        self.dirty.pop(path, None)
+        self.unnormalized.discard(path)
+        Manipulate.texts.clear()
+
+        if path in self.trees:
+            Manipulate.styles.pop(self.trees[path].getroot(), None)
+            del self.trees[path]
+            self.debug.print_debug(self, u'Released {0} from the document session'.format(path))
@@ -0,0 +1,193 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that caches the output of the DOCX to TEI stage so that re-running a document (for instance at another
+aggression level) skips unoconv, extraction and Saxon.
+
+1.) The key is a hash of the input file's bytes, the input type, the DOCX to TEI stylesheet and its includes (and the
+    proprietary math stylesheet with --proprietary) and the options that change the stage's output
+2.) An entry holds the TEI file, the media files and a manifest listing them
+3.) Only the media written by this conversion is stored, not media left in a reused output folder
+4.) Entries are written to a staging folder and renamed into place, so concurrent batch workers never see half an entry
+5.) A cache that cannot be read or written is logged and skipped; the conversion itself carries on
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+from debug import Debuggable
+
+# bump when the output of the DOCX to TEI stage changes for the same inputs
+cache_version = '1'
+
+# the input types whose conversion is cached
+cached_commands = ['doc', 'docx', 'odt', 'other']
+
+
+class DocxCache(Debuggable):
+    def __init__(self, gv):
+        self.gv = gv
+        self.debug = self.gv.debug
+        self.key = None
+        self.existing_media = {}
+        Debuggable.__init__(self, 'DOCX Cache')
+
+    def enabled(self):
+        args = self.gv.settings.args
+
+        return (self.gv.settings.get_boolean('docx-cache', self) and not args['--nocache'] and
+                any(args[command] for command in cached_commands))
+
+    def input_key(self):
+        """
+        Hashes everything that the DOCX to TEI stage's output depends on
+        @return: a hex digest
+        """
+        args = self.gv.settings.args
+        digest = hashlib.sha1(cache_version.encode('utf-8'))
+
+        with open(self.gv.input_file_path, 'rb') as input_file:
+            for block in iter(lambda: input_file.read(1048576), b''):
+                digest.update(block)
+
+        command = [command for command in cached_commands if args[command]][0]
+        digest.update(u'\0{0}\0{1}\0{2}'.format(command, bool(args['--proprietary']),
+                                               bool(args['--noimageprocessing'])).encode('utf-8'))
+        digest.update(self.gv.saxon.stylesheet_key(self.gv.docx_to_tei_stylesheet).encode('utf-8'))
+
+        if args['--proprietary'] and os.path.isfile(self.gv.proprietary_style_sheet):
+            digest.update(self.gv.saxon.stylesheet_key(self.gv.proprietary_style_sheet).encode('utf-8'))
+
+        return digest.hexdigest()
+
+    def restore(self):
+        """
+        Copies a cached TEI file and its media into the output folder
+        @return: True if the input was found in the cache
+        """
+        if not self.enabled():
+            return False
+
+        self.key = self.input_key()
+
+        # media already in a reused output folder is not part of this conversion
+        self.existing_media = self.media_files()
+        entry = os.path.join(self.gv.docx_cache_folder_path, self.key)
+        manifest_path = os.path.join(entry, 'manifest.json')
+
+        if not os.path.isfile(manifest_path):
+            self.debug.print_debug(self, u'No cached conversion of {0} ({1})'.format(self.gv.input_file_path,
+                                                                                   self.key))
+            return False
+
+        try:
+            with open(manifest_path, 'r') as manifest_file:
+                manifest = json.load(manifest_file)
+
+            self.gv.mk_dir(self.gv.tei_folder_path)
+            self.gv.tei_file_path = self.gv.settings.clean_path(self.gv.tei_file_path)
+            shutil.copy2(os.path.join(entry, 'tei.xml'), self.gv.tei_file_path)
+
+            if len(manifest['media']) > 0:
+                self.gv.mk_dir(self.gv.output_media_path)
+
+                for name in manifest['media']:
+                    target = os.path.join(self.gv.output_media_path, name)
+
+                    if not os.path.isdir(os.path.dirname(target)):
+                        os.makedirs(os.path.dirname(target))
+
+                    shutil.copy2(os.path.join(entry, 'media', name), target)
+        except (OSError, ValueError, KeyError) as error:
+            # a broken or unreadable entry only costs the conversion it would have saved
+            self.debug.print_debug(self, u'Unable to restore the cached conversion ({0}): {1}'.format(self.key, error))
+            return False
+
+        self.debug.print_debug(self, u'Restored the TEI and {0} media file(s) from the cache ({1})'.format(
+            len(manifest['media']), self.key))
+
+        return True
+
+    def store(self):
+        """
+        Adds the TEI file and media produced by the DOCX to TEI stage to the cache
+        """
+        if self.key is None or not os.path.isfile(self.gv.tei_file_path):
+            return
+
+        entry = os.path.join(self.gv.docx_cache_folder_path, self.key)
+
+        if os.path.isdir(entry):
+            return
+
+        staging = None
+
+        try:
+            # only the media that this conversion extracted or converted belongs to the entry
+            media = sorted(name for name, signature in self.media_files().items()
+                           if self.existing_media.get(name) != signature)
+
+            if not os.path.isdir(self.gv.docx_cache_folder_path):
+                os.makedirs(self.gv.docx_cache_folder_path)
+
+            staging = tempfile.mkdtemp(dir=self.gv.docx_cache_folder_path, prefix='.staging-')
+
+            shutil.copy2(self.gv.tei_file_path, os.path.join(staging, 'tei.xml'))
+
+            for name in media:
+                target = os.path.join(staging, 'media', name)
+
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+
+                shutil.copy2(os.path.join(self.gv.output_media_path, name), target)
+
+            with open(os.path.join(staging, 'manifest.json'), 'w') as manifest_file:
+                json.dump({'input': self.gv.settings.args['<input>'], 'media': media}, manifest_file, indent=4)
+        except OSError as error:
+            # the cache is an optimization, so failing to fill it never fails the conversion
+            self.debug.print_debug(self, u'Unable to store the conversion in the cache ({0}): {1}'.format(self.key,
+                                                                                                        error))
+            if staging is not None:
+                shutil.rmtree(staging, ignore_errors=True)
+            return
+
+        try:
+            os.rename(staging, entry)
+        except OSError:
+            # another process stored the same conversion first
+            shutil.rmtree(staging, ignore_errors=True)
+            return
+
+        self.debug.print_debug(self, u'Stored the TEI and {0} media file(s) in the cache ({1})'.format(len(media),
+                                                                                                    self.key))
+
+    def media_files(self):
+        """
+        Lists the files in the output media folder
+        @return: a dictionary of each file's path, relative to the media folder, to its modification time and size
+        """
+        media = {}
+
+        if not os.path.isdir(self.gv.output_media_path):
+            return media
+
+        for folder, folders, files in os.walk(self.gv.output_media_path):
+            # the debug git repository is not media
+            if '.git' in folders:
+                folders.remove('.git')
+
+            for name in files:
+                path = os.path.join(folder, name)
+
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+
+                media[os.path.relpath(path, self.gv.output_media_path)] = (stat.st_mtime_ns, stat.st_size)
+
+        return media
@@ -2,6 +2,7 @@
 
 import distutils
 import os
+import pathlib
 import errno
 import shutil
 import zipfile
@@ -13,6 +14,7 @@ __author__ = "Dulip Withanage"
 __email__ = "dulip.withanage@gmail.com"
 
 from debug import Debuggable
+from imageconverter import ImageConverter
 from teimanipulate import TeiManipulate
 from lxml import etree
 
@@ -35,10 +37,19 @@ class DocxToTei(Debuggable):
                "-r",  "org.apache.xml.resolver.tools.CatalogResolver",
                "-o", self.gv.settings.clean_path(self.gv.tei_file_path),
                self.gv.word_document_xml,
-               self.gv.docx_to_tei_stylesheet
+               self.gv.docx_to_tei_stylesheet,
+               'word-directory=' + self.word_directory()
                ]
         return ' '.join(cmd)
 
+    def word_directory(self):
+        """
+        The DOCX to TEI stylesheets are run from the installation, so they are told where the extracted document lives
+        (their default is the folder above the stylesheet)
+        @return: a file URI for the extracted docx folder
+        """
+        return pathlib.Path(os.path.abspath(self.gv.docx_temp_folder_path)).as_uri()
+
     def saxon_omml_to_mml(self):
         """
         Creates the appropriate java command to run Saxon
@@ -58,27 +69,75 @@ class DocxToTei(Debuggable):
 
     def handle_wmf(self):
         """
-        Calls unoconv to convert wmf images into png format. This method has a hard limit of 30 images.
+        Calls unoconv to convert wmf and emf images into png format, in parallel and within the time limits set in the
+        settings file
+
+        @return: False if any image could not be converted, True otherwise
+        """
+        return ImageConverter(self.gv).run(self.gv.output_media_path)
+
+    def extract(self):
+        """
+        Extracts the XML parts of the docx file (document, styles, numbering, notes, headers and footers, rels and
+        docProps) into the temporary folder and streams any media straight into the output media folder. Other binary
+        parts (embedded objects, fonts, thumbnails) are not read by the transform and are skipped.
+
+        @return: True if any media was extracted
+        """
+        media_prefix = 'word/media/'
+        has_media = False
+
+        with zipfile.ZipFile(self.gv.input_file_path, 'r') as z:
+            for member in z.infolist():
+                name = member.filename
+
+                if name.endswith('/'):
+                    continue
+
+                if name.startswith(media_prefix):
+                    folder = self.gv.output_media_path
+                    name = name[len(media_prefix):]
+
+                    if not has_media:
+                        self.debug.print_debug(self, u'Streaming media to {0}'.format(folder))
+                        self.gv.mk_dir(folder)
+                        has_media = True
+
+                elif name.endswith('.xml') or name.endswith('.rels'):
+                    folder = self.gv.docx_temp_folder_path
+                else:
+                    continue
+
+                target = os.path.normpath(os.path.join(folder, name))
+
+                if not target.startswith(os.path.normpath(folder) + os.sep):
+                    self.debug.print_debug(self, u'Skipping zip entry outside of the output folder: {0}'.format(name))
+                    continue
+
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+
+                with z.open(member) as source, open(target, 'wb') as destination:
+                    shutil.copyfileobj(source, destination)
+
+        return has_media
+
+    def copy_media(self):
+        """
+        Copies the media folder of a pre-extracted docx folder into the output media folder
 
-        @return: False if fails (more than 30 images), True otherwise
+        @return: True if any media was copied
         """
-        image_filenames = os.listdir(self.gv.output_media_path)
+        self.debug.print_debug(self, u'Looking for presence of media directory {0}'.format(self.gv.docx_media_path))
 
-        if len(image_filenames) > 30:
-            self.debug.print_debug(self, u'Abandoning image conversion as there are over thirty images (DoS mitigation)')
+        if not os.path.isdir(self.gv.docx_media_path):
             return False
 
-        for image in image_filenames:
-            if re.match(r'.+?\.(w|e)mf', image) is not None:
-                image_name = re.sub(r'\.(w|e)mf', '', image)
-                imagemagick_command = '{3}*DELIMITER*-d*DELIMITER*graphics*DELIMITER*-f*DELIMITER*png*DELIMITER*-o' \
-                                      '*DELIMITER*{0}/{1}.png*DELIMITER*' \
-                                      '{0}/{2}'.format(self.gv.output_media_path, image_name, image,
-                                                       self.gv.settings.get_setting('unoconv',
-                                                                                      self))
-                self.debug.print_debug(self, u'Calling: {0}'.format(imagemagick_command.replace('*DELIMITER*', ' ')))
-
-                subprocess.call(imagemagick_command.split('*DELIMITER*'))
+        self.debug.print_debug(self, u'Ripping out media directory')
+
+        self.gv.mk_dir(self.gv.output_media_path)
+        self.gv.copy_folder(self.gv.docx_media_path, self.gv.output_media_path, False, None)
+
         return True
 
     def clean_proprietary(self):
@@ -111,44 +170,22 @@ class DocxToTei(Debuggable):
 
         # make output folders
         self.gv.mk_dir(self.gv.docx_temp_folder_path)
-        self.gv.mk_dir(self.gv.common2_temp_folder_path)
         self.gv.mk_dir(self.gv.tei_folder_path)
 
-        #copy folders
-        self.gv.copy_folder(self.gv.common2_lib_path,
-                            self.gv.common2_temp_folder_path, False, None)
-        self.gv.copy_folder(self.gv.docx_folder_path,
-                            self.gv.docx_temp_folder_path, False, None)
-
         if extract:
-            # decompress the docx
+            # decompress the parts of the docx that the transform reads; media goes straight to the output
             self.debug.print_debug(self, u'Unzipping {0} to {1}'.format(self.gv.input_file_path,
                                                                        self.gv.docx_temp_folder_path))
-
-            with zipfile.ZipFile(self.gv.input_file_path, "r") as z:
-                z.extractall(self.gv.docx_temp_folder_path)
+            has_media = self.extract()
         elif not tei:
             self.gv.copy_folder(self.gv.input_file_path, self.gv.docx_temp_folder_path)
+            has_media = self.copy_media()
         else:
             shutil.copy2(self.gv.input_file_path, self.gv.tei_file_path)
+            has_media = self.copy_media()
 
-        self.debug.print_debug(self, u'Looking for presence of media directory {0}'.format(self.gv.docx_media_path))
-
-        if os.path.isdir(self.gv.docx_media_path):
-            self.debug.print_debug(self, u'Ripping out media directory')
-
-            self.gv.mk_dir(self.gv.output_media_path)
-            self.gv.copy_folder(self.gv.docx_media_path, self.gv.output_media_path, False, None)
-
-            if not self.gv.settings.args['--noimageprocessing']:
-                self.handle_wmf()
-
-        # copy input file into the docx subfolder
-        if extract:
-            shutil.copy(self.gv.input_file_path, self.gv.docx_temp_folder_path)
-        else:
-            pass
-            #self.gv.tei_file_path = self.gv.tei_file_path + 'tei.xml'
+        if has_media and not self.gv.settings.args['--noimageprocessing']:
+            self.handle_wmf()
 
         if not tei:
             # fix dud LibreOffice conversion
@@ -166,21 +203,25 @@ class DocxToTei(Debuggable):
                 # run a transform on the copied docx to generate a new version of the Word XML that includes MML
                 java_command = self.saxon_omml_to_mml()
                 self.debug.print_debug(self, u'Running saxon transform (DOCX->MML DOCX) [proprietary]')
-                subprocess.call(java_command, stdin=None, shell=True)
+                self.gv.saxon.transform(self.gv.proprietary_style_sheet, self.gv.word_document_xml,
+                                        self.gv.word_document_xml, command=java_command)
                 self.clean_proprietary()
 
             # saxon converter
             java_command = self.saxon_doc_to_tei()
             self.debug.print_debug(self, u'Running saxon transform (DOCX->TEI)')
-            subprocess.call(java_command, stdin=None, shell=True)
+            self.gv.saxon.transform(self.gv.docx_to_tei_stylesheet, self.gv.word_document_xml,
+                                    self.gv.settings.clean_path(self.gv.tei_file_path),
+                                    {'word-directory': self.word_directory()}, java_command)
 
             # delete temp folders
             if not self.gv.debug.debug:
                 shutil.rmtree(self.gv.docx_temp_folder_path)
-                shutil.rmtree(self.gv.common2_temp_folder_path)
 
                 if os.path.exists(self.gv.unoconv_folder_path):
                     shutil.rmtree(self.gv.unoconv_folder_path)
 
             # update path to TEI from normalized saxon output
             self.gv.tei_file_path = self.gv.settings.clean_path(self.gv.tei_file_path)
+
+        self.gv.session.commit(self)
@@ -5,6 +5,11 @@
 import os
 import shutil
 from debug import *
+from documentsession import DocumentSession
+from saxonworker import SaxonWorker
+from officelisteners import OfficeListeners
+from profiler import Profiler
+from identifiers import Identifiers
 import ntpath
 import platform
 
@@ -30,6 +35,15 @@ class GV (Debuggable):
         self.used_list_method = False
         self.used_square_reference_method = False
 
+        # the live TEI and NLM trees shared by all modules
+        self.session = DocumentSession(self)
+
+        # per-stage timings, written to the output folder with --profile
+        self.profiler = Profiler(self, settings.args.get('--profile', False))
+
+        # the IDs given to elements, derived from the input document so that re-runs give the same IDs
+        self.identifiers = Identifiers(self)
+
         if not settings.args['bibscan']:
 
             self.input_file_path = settings.args['<input>'].strip()
@@ -46,7 +60,6 @@ class GV (Debuggable):
             self.common2_lib_path = self.generate_path(settings, common2, settings.script_dir)
             self.binary_folder_path = self.generate_path(settings, 'binaries', settings.script_dir)
             self.runtime_catalog_path = self.generate_path(settings, 'runtime-catalog', settings.script_dir)
-            self.common2_temp_folder_path = self.generate_path(settings, common2, self.output_folder_path)
 
             # docx document paths
             self.docx_folder_path = self.generate_path(settings, docx, settings.script_dir)
@@ -68,8 +81,9 @@ class GV (Debuggable):
                                                                 settings.get_setting('proprietary-math-stylesheet',
                                                                                        self))
 
+            # the stylesheets are run in place from the installation rather than from a copy in the output folder
             self.docx_to_tei_stylesheet = settings.clean_path(
-                os.path.join(self.docx_temp_folder_path, settings.get_setting('doc-to-tei-stylesheet', self)))
+                os.path.join(self.docx_folder_path, settings.get_setting('doc-to-tei-stylesheet', self)))
 
             self.docx_media_path = settings.clean_path(
                 settings.concat_path(self.docx_word_temp_folder_path, settings.get_setting('media', self)))
@@ -109,8 +123,20 @@ class GV (Debuggable):
                 settings.concat_path(settings.script_dir, settings.get_setting('metadata-stylesheet',
                                                                                self)))
 
+            # cache of DOCX to TEI conversions
+            self.docx_cache_folder_path = settings.clean_path(
+                settings.concat_path(settings.script_dir, settings.get_setting('docx-cache-folder', self)))
+
+            # cache of converted WMF and EMF images
+            self.image_cache_folder_path = settings.clean_path(
+                settings.concat_path(settings.script_dir, settings.get_setting('image-cache-folder', self)))
+
             #java classes for saxon
             self.java_class_path = self.set_java_classpath()
+            self.saxon = SaxonWorker(self)
+
+            # office listeners for unoconv
+            self.office = OfficeListeners(self)
 
             self.use_zotero = settings.args['--zotero']
 
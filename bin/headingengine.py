@@ -0,0 +1,436 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that classifies the headings of a TEI document for the size classifier with one walk of the tree and one save.
+
+1.) One walk of the tree records its elements in document order; after the first step (bold-only paragraphs, which
+    sees the tree as loaded) they are normalized as the document session would on reloading the saved tree, and the
+    elements that the other steps look at (paragraphs, lists and cit elements) are picked out; elements with a given
+    rend or meTypesetSize come from the tree's style index, which each step keeps up to date
+2.) The steps that used to be separate passes, each with its own XPath, reload and save (bold-only paragraphs,
+    capital-only paragraphs, single-item lists, styled headings, quote introductions, size headings, heading IDs and
+    line breaks in headings) are then decided from those records in their old order, so each step sees the changes of
+    the steps before it
+3.) No step reorders the elements of the document, so the order recorded by the walk holds throughout; new elements
+    take the position of the element that they enclose
+"""
+
+import re
+from lxml import etree
+from debug import Debuggable
+from documentsession import DocumentSession
+from manipulate import Manipulate
+
+tei = '{http://www.tei-c.org/ns/1.0}'
+
+# the characters removed by the XPath normalize-space function
+xpath_whitespace = ' \t\r\n'
+
+
+class HeadingEngine(Debuggable):
+    def __init__(self, global_variables, size_cutoff, max_headings):
+        self.gv = global_variables
+        self.debug = self.gv.debug
+        self.size_cutoff = size_cutoff
+        self.max_headings = max_headings
+        self.order = {}
+        self.styles = None
+        self.paragraphs = []
+        self.lists = []
+        self.cits = []
+        Debuggable.__init__(self, 'Heading Engine')
+
+    @staticmethod
+    def retag(element, name):
+        # the tag that DocumentSession.normalize would give an element renamed to an unqualified name
+        namespace = element.nsmap.get(None)
+
+        element.tag = name if namespace is None else u'{{{0}}}{1}'.format(namespace, name)
+
+    @staticmethod
+    def has_text(element):
+        # text()[normalize-space()!=""]
+        if element.text is not None and element.text.strip(xpath_whitespace) != '':
+            return True
+
+        for child in element:
+            if child.tail is not None and child.tail.strip(xpath_whitespace) != '':
+                return True
+
+        return False
+
+    def walk(self, tree):
+        for element in tree.iter():
+            self.order[element] = len(self.order)
+
+            if element.tag == tei + 'p':
+                self.paragraphs.append(element)
+
+    def normalize(self):
+        # the first step sees the tree as it was loaded; the others see it as reloaded after that step's save
+        self.paragraphs = []
+
+        for element in self.order:
+            DocumentSession.normalize_element(element)
+
+            if element.tag == tei + 'p':
+                self.paragraphs.append(element)
+            elif element.tag == tei + 'list':
+                self.lists.append(element)
+            elif element.tag == tei + 'cit':
+                self.cits.append(element)
+
+    def in_order(self, elements):
+        return sorted(set(elements), key=lambda element: self.order[element])
+
+    def current(self, name):
+        return [element for element in self.order if element.tag == tei + name]
+
+    def bold_only_paragraphs(self, size):
+        # paragraphs that contain only bold text are given a (root) size
+        for paragraph in self.paragraphs:
+            his = [child for child in paragraph if child.tag == tei + 'hi']
+            bold = [hi for hi in his if 'bold' in hi.get('rend', '')]
+
+            if ('bold' in paragraph.get('rend', '') or len(his) == len(bold)) and not self.has_text(paragraph):
+                for hi in his:
+                    hi.attrib[u'meTypesetSize'] = size
+
+                    if 'rend' in hi.attrib and u'bold' in hi.attrib[u'rend']:
+                        hi.attrib[u'rend'] = hi.attrib[u'rend'].replace(u'bold', u'')
+
+                    self.styles.add(hi)
+
+    def capital_only_paragraphs(self, size):
+        # paragraphs made of capitals followed by a colon (or styled as all capitals) become headings
+        regex = re.compile(r'^[A-Z]+:$')
+
+        for paragraph in self.paragraphs:
+            text = Manipulate.texts.stripped(paragraph).strip()
+
+            if regex.match(text) or ('rend' in paragraph.attrib and 'capsall' in paragraph.attrib['rend']):
+                paragraph.attrib['meTypesetSize'] = size
+                self.retag(paragraph, 'head')
+                self.styles.add(paragraph)
+                self.debug.print_debug(self, u'Changed item {0} to a heading size {1}'.format(text, size))
+
+    def single_item_lists(self, size):
+        # a list with a single item becomes a heading
+        lists = [element for element in self.lists if len([item for item in element if item.tag == tei + 'item']) == 1]
+
+        for element in lists:
+            parent = element.getparent()
+            element.tag = 'REMOVE'
+
+            for item in element:
+                text = Manipulate.get_stripped_text(item)
+                item.attrib['meTypesetSize'] = size
+                self.retag(item, 'head')
+                self.styles.add(item)
+                etree.strip_tags(parent, 'REMOVE')
+                self.debug.print_debug(self, u'Changed item {0} to a heading size {1}'.format(text, size))
+
+    def get_sizes(self):
+        sizes = self.styles.count('meTypesetSize', tei + 'hi')
+
+        if len(sizes) > 0:
+            self.debug.print_debug(self,
+                                   u'Explicitly specified size variations and their frequency of '
+                                   u'occurrence: {0}'.format(str(sizes)))
+        new_sizes = {}
+        for size, frequency in sizes.items():
+            if float(frequency) < float(self.max_headings):
+                new_sizes[size] = frequency
+
+        return new_sizes
+
+    def styled_heading_sizes(self, sizes):
+        # correlate tag sizes specified by true word headings ("heading 1", "heading 2" etc.) to our index
+        sorted_list = []
+        headings = {}
+
+        for size, frequency in sizes.items():
+            if float(frequency) < float(self.max_headings) and float(size) > float(self.size_cutoff):
+                sorted_list.append(size)
+
+        sorted_list = sorted(sorted_list)
+
+        if len(sorted_list) > 0:
+            for count in range(0, len(sorted_list) - 1):
+                key = u'heading {0}'.format(count + 1)
+                headings[key] = sorted_list[count]
+
+                key = u'Heading {0}'.format(count + 1)
+                headings[key] = sorted_list[count]
+
+            for count in range(len(sorted_list) - 1, 8):
+                key = u'heading {0}'.format(count + 1)
+                headings[key] = 100 - 10 * count
+
+                key = u'Heading {0}'.format(count + 1)
+                headings[key] = 100 - 10 * count
+        else:
+            headings = {'title': 100, 'heading 1': 100, 'heading 2': 90, 'heading 3': 80, 'heading 4': 70,
+                        'heading 5': 60, 'heading 6': 50, 'heading 7': 40, 'heading 8': 30, 'heading 9': 20}
+
+            headings.update({'Title': 100, 'Heading 1': 100, 'Heading 2': 90, 'Heading 3': 80,
+                             'Heading 4': 70, 'Heading 5': 60, 'Heading 6': 50, 'Heading 7': 40,
+                             'Heading 8': 30, 'Heading 9': 20})
+
+            headings.update({'H1': 100, 'H2': 90, 'H3': 80, 'H4': 70, 'H5': 60, 'H6': 50, 'H7': 40,
+                             'H8': 30, 'H9': 20})
+
+        return headings
+
+    def enclose_styled_heading(self, child, size):
+        # <p rend="heading 1">text</p> becomes <p><hi meTypesetSize="100.0">text</hi></p>
+        new_element = etree.Element('p')
+        child.attrib[u'meTypesetSize'] = size
+
+        for sub_element in child:
+            if sub_element.tag == tei + 'hi':
+                child.tag = 'REMOVE'
+
+        child.addnext(new_element)
+        self.retag(new_element, 'p')
+        self.order[new_element] = self.order[child] - 0.5
+
+        Manipulate.append_safe(new_element, child, self)
+
+        if child.tag == 'REMOVE':
+            etree.strip_tags(new_element, 'REMOVE')
+        else:
+            self.retag(child, 'hi')
+
+        if u'bold' in child.attrib[u'rend']:
+            child.attrib[u'rend'] = child.attrib[u'rend'].replace(u'bold', u'')
+
+        self.styles.add(new_element)
+        self.styles.add(child)
+
+    def styled_headings(self):
+        headings = self.styled_heading_sizes(self.get_sizes())
+
+        # a paragraph is enclosed by the first style in the list that its rend attribute contains, so each rend value
+        # in the document is matched against the list once
+        styles = {}
+
+        for rend in self.styles.values('rend'):
+            for key in headings:
+                if key in rend:
+                    styles.setdefault(key, []).append(rend)
+                    break
+
+        for key, value in headings.items():
+            self.debug.print_debug(self, u'Changing {0} to size {1}'.format(key, value))
+
+            for paragraph in self.styles.find('rend', styles.get(key, []), tei + 'p'):
+                self.debug.print_debug(self, u'Enclosing and changing size: {0} to hi'.format(paragraph.tag))
+                self.enclose_styled_heading(paragraph, str(float(value)))
+
+    def introduction_headings(self):
+        # a styled heading ending with a colon immediately before a cit introduces a quote
+        for cit in self.cits:
+            if cit.tag != tei + 'cit':
+                continue
+
+            previous = cit.getprevious()
+
+            while previous is not None and not isinstance(previous.tag, str):
+                previous = previous.getprevious()
+
+            if previous is None or previous.tag != tei + 'p':
+                continue
+
+            for element in previous:
+                if element.tag == tei + 'hi' and 'meTypesetSize' in element.attrib:
+                    text = Manipulate.get_stripped_text(previous).strip()
+
+                    if text.endswith(':'):
+                        del element.attrib['meTypesetSize']
+                        self.styles.add(element)
+
+                        self.debug.print_debug(self, u'Removed heading attribute from {0} as it looks '
+                                                     u'like a quote introduction'.format(text))
+
+    def size_headings(self, manipulate, sizes):
+        allowed_elements = ['bold', 'italic', 'p', 'hi', 'seg', 'lb', 'ref']
+        exception_elements = ['lb']
+
+        checked_quotes = False
+
+        for size in sizes:
+            if float(size) < float(self.size_cutoff):
+                continue
+
+            # if the size is greater than or equal to the cutoff, treat it as a heading
+            self.debug.print_debug(self,
+                                   u'Size ({0}) greater '
+                                   u'than or equal to {1}. '
+                                   u'Treating as a heading.'.format(str(size),
+                                                                    str(self.size_cutoff)))
+
+            # change the parent of every hi element of this size to a head, so that, for example,
+            # <p><hi meTypesetSize="18">some text</hi></p> becomes
+            # <head meTypesetSize="18"><hi ...>some text</hi></head>
+            parents = self.in_order([element.getparent()
+                                     for element in self.styles.find('meTypesetSize', size, tei + 'hi')])
+            changed = []
+
+            for child in parents:
+                add = True
+
+                for sub_element in child:
+                    add = manipulate.check_for_disallowed_elements(allowed_elements, sub_element, exception_elements)
+
+                    if not add:
+                        break
+
+                    for sub_child in sub_element:
+                        add = manipulate.check_for_disallowed_elements(allowed_elements, sub_child, exception_elements)
+
+                        if not add:
+                            break
+
+                    if not add:
+                        break
+
+                if add:
+                    self.retag(child, 'head')
+                    child.attrib['meTypesetSize'] = size
+                    self.styles.add(child)
+                    changed.append(child)
+
+            # every heading is checked the first time; after that only new headings can be inside a quote
+            self.unquote_headings(self.current('head') if not checked_quotes else changed)
+            checked_quotes = True
+
+            self.debug.print_debug(self, u'Normalizing nested headings inside cit/quote blocks')
+
+    def unquote_headings(self, heads):
+        # headings inside cit/quote blocks are taken out of them
+        quotes = []
+
+        # //tei:cit/tei:quote/tei:head
+        for head in heads:
+            quote = head.getparent()
+
+            if quote is not None and quote.tag == tei + 'quote' and quote.getparent() is not None and \
+                    quote.getparent().tag == tei + 'cit':
+                quotes.append(quote)
+
+        parents = []
+
+        for quote in quotes:
+            parents.append(quote.getparent().getparent())
+            quote.getparent().tag = 'REMOVE'
+            quote.tag = 'REMOVE'
+
+        for parent in parents:
+            etree.strip_tags(parent, 'REMOVE')
+
+    def heading_ids(self):
+        # assign IDs to every single heading tag for easy manipulation
+        heads = self.in_order(self.current('head'))
+
+        for iterator, head in enumerate(heads):
+            head.attrib['meTypesetHeadingID'] = str(iterator)
+
+        self.debug.print_debug(self, u'Assigned IDs to all headings')
+
+        return heads
+
+    def heading_line_breaks(self, heads):
+        # remove line breaks inside heads that have no text before them
+        titles = []
+
+        for head in heads:
+            if len([item for item in head if item.tag == tei + 'lb']) > 0:
+                titles.append(head)
+
+            for element in head:
+                if element.tag == tei + 'hi' and 'meTypesetSize' in element.attrib and \
+                        len([item for item in element if item.tag == tei + 'lb']) > 0:
+                    titles.append(element)
+
+        titles = self.in_order(titles)
+
+        # these were normalized by a reload before this step ran as a pass of its own
+        for element in titles:
+            DocumentSession.normalize_element(element)
+
+            for item in element:
+                DocumentSession.normalize_element(item)
+
+        for element in titles:
+            total_text = Manipulate.get_stripped_text(element)
+            text = element.text
+
+            if text is None:
+                text = ''
+
+            last_element = None
+
+            for item in element:
+                if item.tag.endswith('lb') and text.strip() == '':
+                    prev = item.getprevious()
+
+                    if prev is not None:
+                        prev.text = item.tail
+                    else:
+                        element.text = item.tail
+
+                    item.getparent().remove(item)
+
+                    self.debug.print_debug(self, u'Removed unneeded lb from {0}'.format(total_text))
+
+                if item.text is not None:
+                    text += item.text
+
+                if last_element is not None and last_element.tail is not None:
+                    text = text + last_element.tail
+
+                last_element = item
+
+    def run(self, manipulate):
+        """
+        Classifies the headings of the document and saves the tree once
+        @param manipulate: a TeiManipulate object
+        @return: the number of headings
+        """
+        tree = manipulate.load_dom_tree()
+
+        Manipulate.texts.clear()
+
+        self.styles = Manipulate.style_index(tree)
+        self.walk(tree)
+
+        # transform bolded paragraphs into size-attributes with an extremely high threshold (so will be thought of as
+        # root nodes)
+        self.bold_only_paragraphs(u'100')
+
+        self.normalize()
+
+        # if a paragraph only contains capitals followed by a colon, make it a heading (root node size)
+        self.capital_only_paragraphs(u'100')
+
+        # if a list contains only a single item, make it a heading (root node size)
+        self.single_item_lists(u'100')
+
+        self.styled_headings()
+
+        # this deals with cases where the user has given a styled heading ending with a colon
+        # immediately before a disp-quote
+        self.introduction_headings()
+
+        self.size_headings(manipulate, self.get_sizes())
+
+        heads = self.heading_ids()
+
+        # this deals with cases where line breaks exist within <head> tags but there is no text before; we remove them
+        self.heading_line_breaks(heads)
+
+        manipulate.save_tree(tree)
+
+        return len(heads)
@@ -0,0 +1,76 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that issues the id attributes that meTypeset gives to elements, in place of random UUIDs, so that converting
+the same document twice gives the same IDs (and so the same output).
+
+1.) Each ID keeps the ID{uuid} form, but the UUID is derived from a hash of the input document, the name of the module
+    that asks for the ID and the number of IDs that the module has already been given (for an extracted docx folder,
+    the hash covers every file in the folder)
+2.) Modules visit the tree in a fixed order, so a re-run of the same input issues the same IDs; a run resumed from a
+    checkpoint issues the same IDs for the stages that it re-runs, and these cannot collide with the IDs of the stages
+    that it restored because every module counts its own IDs
+"""
+
+import hashlib
+import os
+import uuid
+from debug import Debuggable
+
+
+class Identifiers(Debuggable):
+    def __init__(self, gv):
+        self.gv = gv
+        self.debug = self.gv.debug
+        self.namespace = None
+        self.counters = {}
+        Debuggable.__init__(self, 'Identifiers')
+
+    @staticmethod
+    def hash_file(digest, path):
+        """
+        Adds the bytes of a file to a hash
+        @param digest: a hashlib object
+        @param path: the file to read
+        """
+        with open(path, 'rb') as document:
+            for block in iter(lambda: document.read(1048576), b''):
+                digest.update(block)
+
+    def document_namespace(self):
+        """
+        @return: a UUID namespace made from a hash of the input document (read the first time that an ID is issued). The
+        input of docxextracted is a folder, so its files and their paths are hashed instead.
+        """
+        if self.namespace is None:
+            digest = hashlib.sha1()
+            path = self.gv.settings.args.get('<input>')
+
+            if path is not None and os.path.isfile(path.strip()):
+                self.hash_file(digest, path.strip())
+
+            elif path is not None and os.path.isdir(path.strip()):
+                for folder, folders, files in os.walk(path.strip()):
+                    folders.sort()
+
+                    for name in sorted(files):
+                        relative = os.path.relpath(os.path.join(folder, name), path.strip())
+                        digest.update(u'{0}\0'.format(relative.replace(os.sep, '/')).encode('utf-8'))
+                        self.hash_file(digest, os.path.join(folder, name))
+
+            self.namespace = uuid.UUID(bytes=digest.digest()[:16])
+            self.debug.print_debug(self, u'Issuing IDs for document hash {0}'.format(digest.hexdigest()))
+
+        return self.namespace
+
+    def new_id(self, caller):
+        """
+        @param caller: the module that will give the ID to an element
+        @return: an ID that is unique within the document, of the form ID{uuid}
+        """
+        name = caller.get_module_name()
+        count = self.counters.get(name, 0)
+        self.counters[name] = count + 1
+
+        return u'ID{0}'.format(uuid.uuid5(self.document_namespace(), u'{0}/{1}'.format(name, count)))
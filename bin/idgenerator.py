@@ -13,7 +13,7 @@ Options:
 
 from debug import Debuggable
 from nlmmanipulate import NlmManipulate
-import uuid
+from cleanuprules import CleanupRules
 from bare_globals import GV
 from docopt import docopt
 
@@ -42,18 +42,19 @@ class IdGenerator(Debuggable):
                     'title', 'tr', 'trans-abstract', 'trans-source', 'trans-title', 'trans-title-group', 'verse-group',
                     'xref']
 
-        manipulate = NlmManipulate(self.gv)
+        self.debug.print_debug(self, u'Assigning IDs to all {0} supported element types'.format(len(elements)))
 
-        tree = manipulate.load_dom_tree()
+        rules = CleanupRules(NlmManipulate(self.gv))
+        rules.add(u'Assigned IDs', elements, self.assign_id)
+        rules.run()
 
-        for element in elements:
-            self.debug.print_debug(self, u'Assigning ID to all {0} elements'.format(element))
-            for item in tree.xpath(u'//{0}'.format(element)):
-                if not 'id' in item.attrib:
-                    item.attrib['id'] = u'ID{0}'.format(uuid.uuid4())
+    def assign_id(self, item):
+        if 'id' in item.attrib:
+            return False
 
-        tree.write(self.gv.nlm_file_path)
-        tree.write(self.gv.nlm_temp_file_path)
+        item.attrib['id'] = self.gv.identifiers.new_id(self)
+
+        return True
 
 def main():
     args = docopt(__doc__, version='meTypeset 0.1')
@@ -64,6 +65,7 @@ def main():
 
     id_gen_instance = IdGenerator(bare_gv)
     id_gen_instance.run()
+    bare_gv.session.commit(id_gen_instance)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,193 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that converts the WMF and EMF images of a document to PNG with unoconv.
+
+1.) Images with identical content are converted once and copied, within a document and, through a cache of converted
+    images keyed by a hash of their content, across documents; a cache that cannot be read or written is logged and
+    skipped
+2.) Conversions run in a bounded pool of worker threads (image-workers) through the office listeners
+3.) Each conversion is killed after image-timeout seconds and no conversion starts once the document's total budget
+    (image-time-budget) is spent; these limits replace the old hard limit of 30 images per document
+"""
+
+import hashlib
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import as_completed
+from debug import Debuggable
+
+
+class ImageConverter(Debuggable):
+    def __init__(self, gv):
+        self.gv = gv
+        self.debug = self.gv.debug
+        self.workers = self.gv.settings.get_integer('image-workers', self)
+        self.timeout = self.gv.settings.get_integer('image-timeout', self)
+        self.budget = self.gv.settings.get_integer('image-time-budget', self)
+        self.cache_folder = self.gv.image_cache_folder_path
+        Debuggable.__init__(self, 'Image Converter')
+
+    @staticmethod
+    def is_convertible(name):
+        return re.match(r'.+?\.(w|e)mf', name) is not None
+
+    @staticmethod
+    def converted_name(name):
+        return u'{0}.png'.format(re.sub(r'\.(w|e)mf', '', name))
+
+    @staticmethod
+    def file_hash(path):
+        digest = hashlib.sha1()
+
+        with open(path, 'rb') as image:
+            for block in iter(lambda: image.read(1048576), b''):
+                digest.update(block)
+
+        return digest.hexdigest()
+
+    def arguments(self, folder, name):
+        return ['-d', 'graphics', '-f', 'png', '-o', os.path.join(folder, self.converted_name(name)),
+                os.path.join(folder, name)]
+
+    def convert(self, arguments, folder, name, deadline):
+        """
+        Converts one image, within the per-image timeout and what is left of the total budget. This runs in a worker
+        thread, so it does not print (debug output can take git snapshots).
+        @param arguments: the unoconv arguments
+        @param folder: the media folder
+        @param name: the file name of the image
+        @param deadline: the time after which no conversion may run
+        @return: "converted", "failed", "timeout" or "skipped" (the budget was spent before the conversion started)
+        """
+        remaining = deadline - time.time()
+
+        if remaining <= 0:
+            return 'skipped'
+
+        try:
+            self.gv.office.run(arguments, min(self.timeout, remaining))
+        except subprocess.TimeoutExpired:
+            return 'timeout'
+        except OSError:
+            return 'failed'
+
+        return 'converted' if os.path.isfile(os.path.join(folder, self.converted_name(name))) else 'failed'
+
+    def store(self, digest, path):
+        """
+        Adds a converted image to the cache. The cache is optional, so failing to write it only costs later documents
+        the conversion.
+        @param digest: the hash of the source image
+        @param path: the converted image
+        """
+        staging = None
+
+        try:
+            os.makedirs(self.cache_folder, exist_ok=True)
+
+            # write under a temporary name and rename, so that concurrent documents never read a partial image
+            handle, staging = tempfile.mkstemp(dir=self.cache_folder, suffix='.png')
+            os.close(handle)
+            shutil.copyfile(path, staging)
+            os.rename(staging, os.path.join(self.cache_folder, digest + '.png'))
+        except OSError as error:
+            self.debug.print_debug(self, u'Unable to store {0} in the image cache: {1}'.format(path, error))
+
+            if staging is not None and os.path.isfile(staging):
+                os.remove(staging)
+
+    def restore(self, digest, folder, names):
+        """
+        Copies a cached conversion of an image to each of the names that it has in a document
+        @param digest: the hash of the source image
+        @param folder: the media folder
+        @param names: the file names of the image
+        @return: True if the image was in the cache and was copied
+        """
+        cached = os.path.join(self.cache_folder, digest + '.png')
+
+        if not os.path.isfile(cached):
+            return False
+
+        try:
+            for name in names:
+                shutil.copyfile(cached, os.path.join(folder, self.converted_name(name)))
+        except OSError as error:
+            # an unreadable cache entry is converted again
+            self.debug.print_debug(self, u'Unable to copy {0} from the image cache: {1}'.format(names[0], error))
+            return False
+
+        return True
+
+    def run(self, folder):
+        """
+        Converts every WMF and EMF image in a folder
+        @param folder: the media folder
+        @return: True if every image was converted
+        """
+        images = {}
+
+        for name in sorted(os.listdir(folder)):
+            if self.is_convertible(name):
+                images.setdefault(self.file_hash(os.path.join(folder, name)), []).append(name)
+
+        if len(images) == 0:
+            return True
+
+        pending = []
+        counts = {'converted': 0, 'cached': 0, 'failed': 0, 'timeout': 0, 'skipped': 0}
+
+        for digest, names in images.items():
+            if self.restore(digest, folder, names):
+                counts['cached'] += len(names)
+            else:
+                pending.append((digest, names))
+
+        deadline = time.time() + self.budget
+
+        with self.gv.profiler.subprocess('unoconv'):
+            with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as pool:
+                futures = {}
+
+                for digest, names in pending:
+                    arguments = self.arguments(folder, names[0])
+                    self.debug.print_debug(self, u'Calling: unoconv {0}'.format(' '.join(arguments)))
+                    futures[pool.submit(self.convert, arguments, folder, names[0], deadline)] = (digest, names)
+
+                for future in as_completed(futures):
+                    digest, names = futures[future]
+                    status = future.result()
+                    counts[status] += len(names)
+
+                    if status != 'converted':
+                        self.debug.print_debug(self, u'Could not convert {0} ({1})'.format(names[0], status))
+                        continue
+
+                    converted = os.path.join(folder, self.converted_name(names[0]))
+
+                    # identical images are converted once
+                    try:
+                        for name in names[1:]:
+                            shutil.copyfile(converted, os.path.join(folder, self.converted_name(name)))
+                    except OSError as error:
+                        self.debug.print_debug(self, u'Could not copy the conversion of {0}: {1}'.format(names[0],
+                                                                                                      error))
+                        counts['converted'] -= len(names) - 1
+                        counts['failed'] += len(names) - 1
+
+                    self.store(digest, converted)
+
+        self.gv.office.report()
+        self.debug.print_debug(self, u'Converted {0} image(s), copied {1} from the image cache; {2} failed, {3} timed '
+                                     u'out and {4} were skipped when the time budget '
+                                     u'ran out'.format(counts['converted'], counts['cached'], counts['failed'],
+                                                       counts['timeout'], counts['skipped']))
+
+        return counts['failed'] + counts['timeout'] + counts['skipped'] == 0
@@ -247,7 +247,7 @@ class Interactive(Debuggable):
         """Colorize text if colored output is enabled. (Like _colorize but
         conditional.)
         """
-        if self.gv.settings.get_setting('color', self) == 'True':
+        if self.gv.settings.get_boolean('color', self):
             return self._colorize(color, text)
         else:
             return text
@@ -334,7 +334,7 @@ class Interactive(Debuggable):
         """Colorize differences between two values if color is enabled.
     (Like _colordiff but conditional.)
     """
-        if self.gv.settings.get_setting('color', self) == 'True':
+        if self.gv.settings.get_boolean('color', self):
             return self._colordiff(a, b, highlight)
         else:
             return a,b
@@ -353,7 +353,7 @@ class Interactive(Debuggable):
 
     def color_diff_suffix(self, a, b, highlight='red'):
         """Colorize the differing suffix between two strings."""
-        if not self.gv.settings.get_setting('color', self) == 'True':
+        if not self.gv.settings.get_boolean('color', self):
             return a, b
 
         # Fast path.
@@ -12,6 +12,8 @@ A class that looks for common list encodings and handles them properly.
 """
 
 from debug import Debuggable
+from textindex import TextIndex
+from textindex import tei_p
 import math
 from copy import copy
 import re
@@ -24,12 +26,6 @@ class ListClassifier(Debuggable):
         self.skiplist = []
         Debuggable.__init__(self, 'List Classifier')
 
-    @staticmethod
-    def set_dom_tree(filename):
-        p = etree.XMLParser(remove_blank_text=True, resolve_entities=False)
-
-        return etree.parse(filename, p)
-
     def handle_reference_item(self, element, elements, in_list_run, iteration, list_element, offset, to_append):
         if element in self.skiplist:
             return iteration
@@ -45,6 +41,7 @@ class ListClassifier(Debuggable):
             to_append = None
             in_list_run = True
             element.addprevious(list_element)
+            Manipulate.restyle(list_element)
         if not element.getnext() is None or next_text == '':
             if next_text.startswith(u'[') and not element.getnext() in elements:
                 # this element is the last in this list
@@ -95,6 +92,7 @@ class ListClassifier(Debuggable):
             to_append = None
             in_list_run = True
             element.addprevious(list_element)
+            Manipulate.restyle(list_element)
         if not element.getnext().text is None:
             if element.getnext().text.startswith(u'[') and not element.getnext() in elements:
                 # this element is the last in this list
@@ -128,9 +126,9 @@ class ListClassifier(Debuggable):
 
         return iteration, list_element
 
-    def process_enclosed_ref_list(self, tree, manipulate, treestring):
+    def process_enclosed_ref_list(self, tree, manipulate, index):
 
-        if not u'>[' in treestring and not u'> [' in treestring:
+        if not index.follows_tag(u'[') and not index.follows_tag(u' ['):
             self.debug.print_debug(self, u'Leaving enclosed reference processing')
             return
 
@@ -149,14 +147,10 @@ class ListClassifier(Debuggable):
         acted = False
 
         # ascertain if there are other document references. If so, this is probably a footnote
-        footnote_test = '//text()[contains(self::text(), "[1]")]'
-        footnotes = tree.xpath(footnote_test, namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
-        is_footnote = len(footnotes) > 1
+        is_footnote = index.count(u'[1]') > 1
 
         if not is_footnote:
-            footnote_test = '//text()[contains(self::text(), "[1,")]'
-            footnotes = tree.xpath(footnote_test, namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
-            is_footnote = len(footnotes) > 1
+            is_footnote = index.count(u'[1,') > 1
 
         # append an attribute to the preceding element to signal a return point for references if they were wrongly
         # classified
@@ -171,10 +165,12 @@ class ListClassifier(Debuggable):
 
             if prev is not None:
                 prev.attrib['rend'] = 'ref-list-before'
+                Manipulate.restyle(prev)
             else:
                 prev = elements[0].getparent()
                 if prev is not None:
                     prev.attrib['rend'] = 'ref-list-parent'
+                    Manipulate.restyle(prev)
 
         for element in elements:
             if iteration == 0:
@@ -195,13 +191,13 @@ class ListClassifier(Debuggable):
                 iteration = self.handle_reference_item(element, elements, in_list_run, iteration, list_element, offset,
                                                        to_append)
         if acted:
+            # the bibliography is enclosed later, by the bibliography classifier; enclosing it here (which, before the
+            # document shared one tree, was undone when this module saved its own copy) would take the reference list
+            # out of the body before the list classifier has finished with the paragraphs around it
             self.gv.used_square_reference_method = True
-            manipulate.enclose_bibliography_tags('//tei:p[@rend="Bibliography"]', 'back', 'div', 'type', 'bibliogr')
 
             manipulate.save_tree(tree)
 
-            self.debug.print_debug(self, u'Enclosing bibliography')
-
         if is_footnote:
             back = manipulate.find_or_create_element(tree, 'back', '//tei:body', True)
 
@@ -211,23 +207,31 @@ class ListClassifier(Debuggable):
 
             for count in range(1, iteration + 2):
 
-                footnote_test = '//tei:p//text()[contains(self::text(), "[{0}]")]'.format(count)
-                footnote = tree.xpath(footnote_test, namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})[0]
+                footnote = index.first(u'[{0}]'.format(count), tei_p)
+
+                if footnote is None:
+                    raise IndexError(u'No in-text marker for footnote {0}'.format(count))
+
+                parent, is_tail = footnote
 
                 note = copy(new_element_list[count - 1])
 
-                split = footnote.split("[{0}]".format(count))
-                footnote.getparent().text = split[0]
-                manipulate.append_safe(footnote.getparent(), note, self)
+                split = TextIndex.value(parent, is_tail).split("[{0}]".format(count))
+                parent.text = split[0]
+                manipulate.append_safe(parent, note, self)
                 note.tail = split[1]
 
+                index.add(parent, False)
+                index.add_subtree(note)
+                Manipulate.restyle(note, True)
+
             back.remove(list_element)
 
         manipulate.save_tree(tree)
 
-    def process_dash_list(self, tree, manipulate, treestring):
+    def process_dash_list(self, tree, manipulate, index):
 
-        if not u'>-' in treestring:
+        if not index.follows_tag(u'-'):
             return
 
         # select all p elements followed by another p element
@@ -247,6 +251,7 @@ class ListClassifier(Debuggable):
                 to_append = None
                 in_list_run = True
                 element.addprevious(list_element)
+                Manipulate.restyle(list_element)
 
             if not element.getnext().text is None:
                 if element.getnext().text.startswith(u'- ') and not element.getnext() in elements:
@@ -276,11 +281,11 @@ class ListClassifier(Debuggable):
 
         manipulate.save_tree(tree)
 
-    def process_superscript_footnotes(self, tree, manipulate):
+    def process_superscript_footnotes(self, tree, manipulate, index):
 
         self.debug.print_debug(self, u'Scanning for superscripted footnote entries')
 
-        superscripts = reversed(tree.xpath('//*[@rend="superscript"]'))
+        superscripts = reversed(manipulate.style_index(tree).find('rend', 'superscript'))
 
         footnote_list = []
         footnote_text = []
@@ -325,22 +330,19 @@ class ListClassifier(Debuggable):
                     # made into a footnote. However, if the method is a list at the end of the document it will be
                     # only a single occurrence
 
-                    text_blocks = tree.xpath('//text()[contains(self::text()'
-                                             ', "{0}")]'.format(int(number + (offset - 1))))
+                    text_blocks = index.find(str(int(number + (offset - 1))))
 
                     if len(text_blocks) >= 1:
                         parsed = False
-                        for block_to_change in text_blocks:
+                        for parent, is_tail in text_blocks:
                             # (1)[^\d]
                             ref_match = re.compile('^.*(?P<number>{0})[^\d].*'.format(str(int(number + (offset - 1)))))
-                            result = ref_match.match(block_to_change.getparent().text)
+                            result = ref_match.match(parent.text)
 
                             if result:
                                 self.debug.print_debug(self, u'Found potential point for footnote #{0}.'
                                                              u' Superscripting'.format(int(number + (offset - 1))))
 
-                                parent = block_to_change.getparent()
-
                                 before_after = parent.text.split(str(int(number + (offset - 1))))
 
                                 parent.text = before_after[0]
@@ -351,6 +353,9 @@ class ListClassifier(Debuggable):
 
                                 Manipulate.append_safe(parent, encapsulate, self)
 
+                                index.add(parent, False)
+                                index.add_subtree(encapsulate)
+
                                 footnote_list.insert(count, encapsulate)
                                 footnote_text.insert(count, str(int(number + (offset - 1))))
                                 offset += 1
@@ -367,8 +372,7 @@ class ListClassifier(Debuggable):
 
             count -= 1
 
-        whole_document = reversed(tree.xpath('//tei:p[@rend="Normal" or not(@rend)]',
-                                             namespaces={'tei': 'http://www.tei-c.org/ns/1.0'}))
+        whole_document = reversed(manipulate.style_index(tree).find('rend', ['Normal', None], tei_p))
 
         found = []
 
@@ -416,6 +420,7 @@ class ListClassifier(Debuggable):
 
                     footnote.tag = 'note'
                     footnote.attrib['id'] = 'fn_from_list{0}'.format(current)
+                    Manipulate.restyle(footnote)
 
                     replace_regex = '^({0}[\.\s\)]*)'.format(len(found) - current)
 
@@ -443,10 +448,7 @@ class ListClassifier(Debuggable):
 
         manipulate.save_tree(tree)
 
-    def process_number_list(self, tree, manipulate, treestring):
-
-        if not u'>1' and not u'>(' in treestring:
-            return
+    def process_number_list(self, tree, manipulate):
 
         # select all p elements followed by another p element
         expression = u'//tei:p[contains("(0123456789ivxlcmdIVXLCMD", substring(., 1, 1)) and not(@rend="Bibliography")]'
@@ -536,6 +538,7 @@ class ListClassifier(Debuggable):
                         list_element = etree.Element('list')
                         list_element.attrib[u'type'] = u'ordered'
                         element.addprevious(list_element)
+                        Manipulate.restyle(list_element)
 
                         element.tag = 'item'
                         if element.text:
@@ -574,42 +577,43 @@ class ListClassifier(Debuggable):
         return result
 
     def run(self):
-        if int(self.gv.settings.args['--aggression']) < int(self.gv.settings.get_setting('listclassifier',
-                                                                                         self, domain='aggression')):
+        if int(self.gv.settings.args['--aggression']) < self.gv.settings.get_aggression('listclassifier', self):
             self.debug.print_debug(self, u'Aggression level too low: exiting module.')
             return
 
-        dash_lists = self.gv.settings.get_setting('dash-lists', self) == "True"
-        bracket_refs = self.gv.settings.get_setting('bracket-references-and-footnotes', self) == "True"
-        superscripted_footnotes = self.gv.settings.get_setting('superscripted-footnotes', self) == "True"
+        dash_lists = self.gv.settings.get_boolean('dash-lists', self)
+        bracket_refs = self.gv.settings.get_boolean('bracket-references-and-footnotes', self)
+        superscripted_footnotes = self.gv.settings.get_boolean('superscripted-footnotes', self)
 
         if not dash_lists and not bracket_refs and not superscripted_footnotes:
             return
 
-        # load the DOM
-        tree = self.set_dom_tree(self.gv.tei_file_path)
-
         manipulate = TeiManipulate(self.gv)
 
-        string_version = etree.tostring(tree, encoding="unicode")
+        # load the DOM
+        tree = manipulate.load_dom_tree()
+
+        # one index of the document's text nodes serves every marker lookup below
+        index = TextIndex(tree)
 
         # look for dash separated list
         # - Item 1
         # - Item 2
         if dash_lists:
-            self.process_dash_list(tree, manipulate, string_version)
+            self.process_dash_list(tree, manipulate, index)
 
         if int(self.gv.settings.args['--aggression']) >= 10 and bracket_refs:
             backup_tree = copy(tree)
             try:
                 # look for footnote list [1], [2] etc.
-                self.process_enclosed_ref_list(tree, manipulate, string_version)
+                self.process_enclosed_ref_list(tree, manipulate, index)
             except:
                 self.debug.print_debug(self, u'Error processing footnote or reference list. Reverting to backup tree')
                 tree = backup_tree
                 manipulate.save_tree(tree)
+                index = TextIndex(tree)
 
         if superscripted_footnotes:
-            self.process_superscript_footnotes(tree, manipulate)
+            self.process_superscript_footnotes(tree, manipulate, index)
 
-        self.process_number_list(tree, manipulate, string_version)
\ No newline at end of file
+        self.process_number_list(tree, manipulate)
\ No newline at end of file
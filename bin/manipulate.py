@@ -9,10 +9,25 @@ from copy import deepcopy
 import shutil
 from lxml import objectify
 import re
+import codecs
 from debug import Debuggable
+from textcache import TextCache
+from styleindex import StyleIndex
 
 
 class Manipulate(Debuggable):
+    # the lines of each reference marker file, keyed by file name; the files are read once per process
+    language_cues = {}
+
+    # the cue files of each list of reference languages compiled into one dictionary, shared in the same way
+    cue_priorities = {}
+
+    # the cached stripped text of elements, emptied by the document session whenever a tree is saved
+    texts = TextCache()
+
+    # the style index of each live tree, keyed by the tree's root element
+    styles = {}
+
     def __init__(self, gv):
         self.gv = gv
         self.debug = self.gv.debug
@@ -32,6 +47,48 @@ class Manipulate(Debuggable):
     def update_tmp_file(fr, to):
         shutil.copy2(fr, to)
 
+    @staticmethod
+    def get_language_cues(script_dir, language):
+        """
+        Returns the lines of a reference marker file from the language folder, reading each file once per process
+        @param script_dir: the meTypeset installation folder
+        @param language: the language code of the file
+        @return: a list of lines
+        """
+        filename = u'{0}/language/ref_marker_{1}.txt'.format(script_dir, language)
+
+        if not filename in Manipulate.language_cues:
+            with codecs.open(filename, encoding='utf-8') as lang_file:
+                Manipulate.language_cues[filename] = lang_file.read().split('\n')
+
+        return Manipulate.language_cues[filename]
+
+    @staticmethod
+    def get_cue_priorities(script_dir, languages):
+        """
+        Compiles the reference marker files of a list of languages into one dictionary, once per process, so that a
+        paragraph can be checked against every cue with a single lookup
+        @param script_dir: the meTypeset installation folder
+        @param languages: a list of language codes, in order of priority
+        @return: a dictionary of each cue (in lower case and stripped of whitespace) and its priority (0 for the first
+        line of the first language's file; a cue that appears more than once keeps its first priority)
+        """
+        key = (script_dir, tuple(languages))
+
+        if not key in Manipulate.cue_priorities:
+            priorities = {}
+
+            for language in languages:
+                for line in Manipulate.get_language_cues(script_dir, language):
+                    cue = line.lower().strip()
+
+                    if cue != '' and not cue in priorities:
+                        priorities[cue] = len(priorities)
+
+            Manipulate.cue_priorities[key] = priorities
+
+        return Manipulate.cue_priorities[key]
+
     @staticmethod
     def get_file_text(filename):
         f = open(filename)
@@ -63,12 +120,66 @@ class Manipulate(Debuggable):
                         caller.debug.print_debug(caller, u'Aborting append: attempted to add a parent to its own child')
                     return False
 
+            # the child's tail leaves its old parent along with it
+            Manipulate.texts.invalidate(child.getparent())
             base.append(child)
+            Manipulate.texts.invalidate(base)
+            Manipulate.restyle(child)
             return True
         except:
             base.append(child)
+            Manipulate.texts.invalidate(base)
+            Manipulate.restyle(child)
             return True
 
+    @staticmethod
+    def invalidate_text(element):
+        """
+        Tells the text cache that an element was changed directly through lxml
+        @param element: the changed element (for a changed tail, its parent)
+        """
+        Manipulate.texts.invalidate(element)
+
+    @staticmethod
+    def style_index(tree):
+        """
+        Returns the style index of a tree, building it the first time that it is asked for
+        @param tree: an lxml ElementTree or element
+        @return: a StyleIndex
+        """
+        root = tree.getroot() if hasattr(tree, 'getroot') else tree
+
+        if root not in Manipulate.styles:
+            Manipulate.styles[root] = StyleIndex(root)
+
+        return Manipulate.styles[root]
+
+    @staticmethod
+    def restyle(element, subtree=False):
+        """
+        Tells the style index of the element's tree that an element has been created, retagged or restyled. This must
+        be called after the element has been added to the tree (append_safe does this for the element that it moves).
+        @param element: the changed element
+        @param subtree: True to file the element's descendants as well
+        """
+        if len(Manipulate.styles) == 0:
+            return
+
+        root = element
+
+        while root.getparent() is not None:
+            root = root.getparent()
+
+        index = Manipulate.styles.get(root)
+
+        if index is None:
+            return
+
+        if subtree:
+            index.add_subtree(element)
+        else:
+            index.add(element)
+
     def return_elements(self, xpath):
         tree = self.load_dom_read()
         return tree.xpath(xpath, namespaces=self.namespaces)
@@ -141,10 +252,11 @@ class Manipulate(Debuggable):
         return tree
 
     def load_dom_tree(self):
-        # load the DOM
-        self.update_tmp_file(self.dom_to_load, self.dom_temp_file)
-        tree = self.set_dom_tree(self.dom_temp_file)
-        return tree
+        # load the DOM from the shared document session; this only parses the file the first time
+        return self.gv.session.get_tree(self)
+
+    def save_tree(self, tree):
+        self.gv.session.save_tree(self, tree)
 
     # replaces a given tag with a list of replace tags
     def replace(self, text, tag, *params):
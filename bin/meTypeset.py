@@ -9,6 +9,7 @@ Usage:
     meTypeset.py other <input> <output_folder> [options]
     meTypeset.py tei <input> <output_folder> [options]
     meTypeset.py bibscan <input> [options]
+    meTypeset.py batch <input> <output_folder> [options]
 
 Options:
     -a, --aggression <aggression_level>             Parser aggression level 0-10 [default: 10]
@@ -16,10 +17,12 @@ Options:
     -c, --clean                                     Produce final XML, not intermediate markup with additional metadata
     -d, --debug                                     Enable debug output
     -i, --identifiers                               Generate unique identifiers for all supported NLM elements
+    -j, --jobs <jobs>                               Documents to convert in parallel in batch mode [default: 1]
     --includedeleted                                Keep deleted text (track changes)
     --interactive                                   Enable step-by-step interactive mode
     -h, --help                                      Show this screen.
     -m, --metadata <metadata_file>                  Metadata file
+    --nocache                                       Do not use or fill the DOCX to TEI cache
     --nogit                                         Disable git debug filesystem (only of use with --debug)
     --noimageprocessing                             Disable unoconv image processing
     --nolink                                        Do not run reference linker
@@ -27,7 +30,9 @@ Options:
     --purenlm                                       Die after performing NLM XSLT step
     --puretei                                       Die after performing TEI XSLT step
     --prettytei                                     Indent and format intermediary TEI
+    --profile                                       Write per-stage timings to profile.json and profile.folded
     -p, --proprietary                               Enables proprietary math parsing. Requires omml2mml.xsl
+    --resume-from <stage>                           Resume a run in its output folder from a stage's checkpoint
     -s, --settings <settings_file>                  Settings file
     -v, --version                                   Show version.
     -z, --zotero                                    Enable Zotero integration for references.
@@ -56,6 +61,9 @@ from settingsconfiguration import Settings
 from idgenerator import IdGenerator
 from captionclassifier import CaptionClassifier
 from complianceenforcer import ComplianceEnforcer
+from batchconverter import BatchConverter
+from docxcache import DocxCache
+from checkpoints import Checkpoints
 from interactive import Interactive
 from unoconvtodocx import UnoconvToDocx
 
@@ -69,9 +77,9 @@ except ImportError:
 
 
 class MeTypeset (Debuggable):
-    def __init__(self):
-        # read  command line arguments
-        self.args = self.read_command_line()
+    def __init__(self, args=None):
+        # read  command line arguments (batch mode passes the arguments for each document)
+        self.args = args if args is not None else self.read_command_line()
 
         # absolute first priority is to initialize debugger so that anything triggered here can be logged
         self.debug = Debug()
@@ -112,6 +120,8 @@ class MeTypeset (Debuggable):
         return metadata_file
 
     def run_modules(self):
+        self.gv.profiler.start()
+
         ag = int(self.gv.settings.args['--aggression'])
         self.debug.print_debug(self,
                                u'Running at aggression level {0} {1}'.format(ag,
@@ -129,117 +139,177 @@ class MeTypeset (Debuggable):
             # metadata file
             gv.metadata_file = self.set_metadata_file()
 
-            self.gv.mk_dir(self.gv.output_folder_path)
-
-            if self.args['doc']:
-                # run doc to docx conversion
-                # then run docx to tei
-                UnoconvToDocx(self.gv).run('doc')
-                DocxToTei(self.gv).run(True, self.args['--proprietary'])
-            elif self.args['odt']:
-                # run odt to docx conversion
-                # then run docx to tei
-                UnoconvToDocx(self.gv).run('odt')
-                DocxToTei(self.gv).run(True, self.args['--proprietary'])
-            elif self.args['other']:
-                # run other unoconv-supported format to docx conversion
-                # then run docx to tei
-                UnoconvToDocx(self.gv).run('unoconv')
-                DocxToTei(self.gv).run(True, self.args['--proprietary'])
-            elif self.args['docx']:
-                # run docx to tei conversion
-                # includes hooks for proprietary transforms if enabled
-                DocxToTei(self.gv).run(True, self.args['--proprietary'])
-            elif self.args['docxextracted']:
-                self.debug.print_debug(self, u'Skipping docx extraction')
-                DocxToTei(self.gv).run(False, self.args['--proprietary'])
-            elif self.args['tei']:
-                self.debug.print_debug(self, u'Skipping docx extraction; processing TEI file')
-                DocxToTei(self.gv).run(False, self.args['--proprietary'], tei=True)
+            # each stage's saves are held in the document session, written once at its commit point and checkpointed
+            checkpoints = Checkpoints(self.gv)
+
+            if self.args['--resume-from']:
+                # continue in the output folder of an earlier run
+                checkpoints.resume(self.args['--resume-from'])
+            else:
+                self.gv.mk_dir(self.gv.output_folder_path)
+
+            if checkpoints.should_run('docxtotei'):
+                # a cached conversion of the same input replaces unoconv, extraction and Saxon
+                docx_cache = DocxCache(self.gv)
+
+                if docx_cache.restore():
+                    self.debug.print_debug(self, u'Skipping docx extraction; using the cached TEI')
+                elif self.args['doc']:
+                    # run doc to docx conversion
+                    # then run docx to tei
+                    UnoconvToDocx(self.gv).run('doc')
+                    DocxToTei(self.gv).run(True, self.args['--proprietary'])
+                elif self.args['odt']:
+                    # run odt to docx conversion
+                    # then run docx to tei
+                    UnoconvToDocx(self.gv).run('odt')
+                    DocxToTei(self.gv).run(True, self.args['--proprietary'])
+                elif self.args['other']:
+                    # run other unoconv-supported format to docx conversion
+                    # then run docx to tei
+                    UnoconvToDocx(self.gv).run('unoconv')
+                    DocxToTei(self.gv).run(True, self.args['--proprietary'])
+                elif self.args['docx']:
+                    # run docx to tei conversion
+                    # includes hooks for proprietary transforms if enabled
+                    DocxToTei(self.gv).run(True, self.args['--proprietary'])
+                elif self.args['docxextracted']:
+                    self.debug.print_debug(self, u'Skipping docx extraction')
+                    DocxToTei(self.gv).run(False, self.args['--proprietary'])
+                elif self.args['tei']:
+                    self.debug.print_debug(self, u'Skipping docx extraction; processing TEI file')
+                    DocxToTei(self.gv).run(False, self.args['--proprietary'], tei=True)
+
+                docx_cache.store()
+                checkpoints.commit('docxtotei', docx_cache)
 
             if self.args['--puretei']:
                 self.debug.print_debug(self, u'Exiting as TEI transform complete')
+                self.gv.profiler.write(os.path.join(self.gv.output_folder_path, 'profile'))
                 return
 
             metadata = Metadata(self.gv)
-            metadata.pre_clean()
+
+            if checkpoints.should_run('metadata'):
+                metadata.pre_clean()
+                checkpoints.commit('metadata', metadata)
 
             # run size classifier
             # aggression 5
-            SizeClassifier(self.gv).run()
+            if checkpoints.should_run('sizeclassifier'):
+                size_classifier = SizeClassifier(self.gv)
+                size_classifier.run()
+                checkpoints.commit('sizeclassifier', size_classifier)
 
             # run bibliographic addins handler
             # aggression 4
-            found_bibliography = BibliographyAddins(self.gv).run()
+            if checkpoints.should_run('bibliographyaddins'):
+                bibliography_addins = BibliographyAddins(self.gv)
+                checkpoints.values['found_bibliography'] = bibliography_addins.run()
+                checkpoints.commit('bibliographyaddins', bibliography_addins)
+
+            found_bibliography = checkpoints.values['found_bibliography']
 
             # run list classifier
             # aggression 4
-            ListClassifier(self.gv).run()
+            if checkpoints.should_run('listclassifier'):
+                list_classifier = ListClassifier(self.gv)
+                list_classifier.run()
+                checkpoints.commit('listclassifier', list_classifier)
 
             bibliography_classifier = BibliographyClassifier(self.gv)
 
-            if not found_bibliography:
+            if not found_bibliography and checkpoints.should_run('bibliographyclassifier'):
                 # run bibliographic classifier
                 # aggression 4
                 bibliography_classifier.run()
+                checkpoints.commit('bibliographyclassifier', bibliography_classifier)
 
             # tei
             # aggression 3
-            TeiManipulate(self.gv).run()
+            if checkpoints.should_run('teimanipulate'):
+                tei_manipulate = TeiManipulate(self.gv)
+                tei_manipulate.run()
+                checkpoints.commit('teimanipulate', tei_manipulate)
 
             # run tei to nlm conversion
-            TeiToNlm(self.gv).run(not found_bibliography)
+            if checkpoints.should_run('teitonlm'):
+                tei_to_nlm = TeiToNlm(self.gv)
+                tei_to_nlm.run(not found_bibliography)
+                checkpoints.commit('teitonlm', tei_to_nlm)
 
             if self.gv.settings.args['--purenlm']:
                 self.debug.print_debug(self, u'Exiting as NLM transform complete')
+                self.gv.profiler.write(os.path.join(self.gv.output_folder_path, 'profile'))
                 return
 
             manipulate = NlmManipulate(self.gv)
 
-            if not self.gv.used_list_method:
+            if not self.gv.used_list_method and checkpoints.should_run('fusereferences'):
                 manipulate.fuse_references()
+                checkpoints.commit('fusereferences', manipulate)
 
             # run reference linker
-            if not (self.args['--nolink']):
+            if not (self.args['--nolink']) and checkpoints.should_run('referencelinker'):
                 rl = ReferenceLinker(self.gv)
                 rl.run(self.args['--interactive'])
                 rl.cleanup()
+                checkpoints.commit('referencelinker', rl)
 
             # run table classifier
-            cc = CaptionClassifier(self.gv)
-            if int(self.args['--aggression']) > int(self.gv.settings.get_setting('tablecaptions',
-                                                                                 self, domain='aggression')):
-                cc.run_tables()
+            if checkpoints.should_run('captionclassifier'):
+                cc = CaptionClassifier(self.gv)
+                if int(self.args['--aggression']) > self.gv.settings.get_aggression('tablecaptions', self):
+                    cc.run_tables()
 
-            if int(self.args['--aggression']) > int(self.gv.settings.get_setting('graphiccaptions',
-                                                                                 self, domain='aggression')):
-                cc.run_graphics()
+                if int(self.args['--aggression']) > self.gv.settings.get_aggression('graphiccaptions', self):
+                    cc.run_graphics()
 
-            cc.run_ext_link_compliance()
-            manipulate.double_p_compliance()
+                cc.run_ext_link_compliance()
+                checkpoints.commit('captionclassifier', cc)
+
+            if checkpoints.should_run('doublep'):
+                manipulate.double_p_compliance()
+                checkpoints.commit('doublep', manipulate)
 
             # run metadata merge
-            if not (self.args['--nometa']):
+            if not (self.args['--nometa']) and checkpoints.should_run('metadatamerge'):
                 metadata.run()
+                checkpoints.commit('metadatamerge', metadata)
 
-            if self.args['--interactive']:
-                bibliography_classifier.run_prompt(True)
+            if checkpoints.should_run('bibliographydatabase'):
+                if self.args['--interactive']:
+                    bibliography_classifier.run_prompt(True)
+                    self.gv.session.commit(bibliography_classifier)
 
-            # process any bibliography entries that are possible
-            BibliographyDatabase(self.gv).run()
+                # process any bibliography entries that are possible
+                bibliography_database = BibliographyDatabase(self.gv)
+                bibliography_database.run()
+                checkpoints.commit('bibliographydatabase', bibliography_database)
 
             # remove stranded titles and cleanup
-            manipulate.final_clean()
+            if checkpoints.should_run('finalclean'):
+                manipulate.final_clean()
+                checkpoints.commit('finalclean', manipulate)
 
-            if self.args['--identifiers']:
-                IdGenerator(self.gv).run()
+            if self.args['--identifiers'] and checkpoints.should_run('idgenerator'):
+                id_generator = IdGenerator(self.gv)
+                id_generator.run()
+                checkpoints.commit('idgenerator', id_generator)
 
-            if self.args['--chain']:
+            if self.args['--chain'] and checkpoints.should_run('xslchain'):
                 # construct and run an XSLT chainer
-                XslChain(self.gv).run()
+                xsl_chain = XslChain(self.gv)
+                xsl_chain.run()
+                checkpoints.commit('xslchain', xsl_chain)
+
+            if self.args['--clean'] and checkpoints.should_run('complianceenforcer'):
+                compliance_enforcer = ComplianceEnforcer(self.gv)
+                compliance_enforcer.run()
+                checkpoints.commit('complianceenforcer', compliance_enforcer)
 
-            if self.args['--clean']:
-                ComplianceEnforcer(self.gv).run()
+            self.gv.session.report()
+            self.gv.profiler.write(os.path.join(self.gv.output_folder_path, 'profile'))
 
     def run(self):
         self.run_modules()
@@ -249,8 +319,14 @@ class MeTypeset (Debuggable):
 
 
 def main():
-    me_typeset_instance = MeTypeset()
-    me_typeset_instance.run()
+    args = MeTypeset.read_command_line()
+
+    if args['batch']:
+        # convert a folder or manifest of documents with a pool of workers
+        BatchConverter(args).run()
+    else:
+        me_typeset_instance = MeTypeset(args)
+        me_typeset_instance.run()
 
 
 if __name__ == '__main__':
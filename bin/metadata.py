@@ -1,6 +1,5 @@
 #!/usr/bin/env python
 
-import subprocess
 from manipulate import Manipulate
 from teimanipulate import TeiManipulate
 
@@ -35,12 +34,19 @@ class Metadata(Manipulate):
         return ' '.join(cmd)
 
     def run(self):
+        # saxon reads the NLM file from disk
+        self.gv.session.commit(self)
+
         java_command = self.attach_metadata()
-        subprocess.call(java_command, stdin=None, shell=True)
+        self.gv.saxon.transform(self.gv.metadata_style_sheet_path, self.gv.nlm_temp_file_path, self.gv.nlm_file_path,
+                                {'metadataFile': self.gv.input_metadata_file_path}, java_command)
 
         # copy back to the temp file for debug purposes
         Manipulate.update_tmp_file(self.gv.nlm_file_path, self.gv.nlm_temp_file_path)
 
+        # saxon has rewritten the NLM file so any held tree is stale
+        self.gv.session.release(self.gv.nlm_file_path)
+
         self.debug.print_debug(self, u'Running metadata transform')
 
     def extract_metadata_fields(self):
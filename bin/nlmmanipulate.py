@@ -2,9 +2,9 @@ __author__ = "Martin Paul Eve"
 __email__ = "martin@martineve.com"
 
 from manipulate import Manipulate
+from cleanuprules import CleanupRules
 from lxml import etree
 import re
-import uuid
 
 
 class NlmManipulate(Manipulate):
@@ -29,213 +29,129 @@ class NlmManipulate(Manipulate):
 
         self.save_tree(tree)
 
-    def remove_empty_elements(self, element):
-        tree = self.load_dom_tree()
+    def remove_empty_element(self, paragraph):
+        """
+        Removes an element that has no text and no graphic, preserving its tail (a cleanup rule action)
+        @param paragraph: the element to test
+        @return: True if the element was removed
+        """
+        text = self.get_stripped_text(paragraph).strip()
 
-        for paragraph in tree.xpath(element):
-            found = False
-            text = self.get_stripped_text(paragraph).strip()
+        if text != '':
+            return False
 
-            if text == '':
-                for item in paragraph:
-                    if self.get_stripped_text(item) != '' or item.tag == 'graphic':
-                        found = True
-                        break
-            else:
-                found = True
+        for item in paragraph:
+            if self.get_stripped_text(item) != '' or item.tag == 'graphic':
+                return False
 
-            if not found and (paragraph.tail is None or paragraph.tail == ''):
-                paragraph.getparent().remove(paragraph)
-                self.save_tree(tree)
-                self.debug.print_debug(self, u'Removed an empty element')
-            elif not found and paragraph.tail != '':
-                sibling = paragraph.getprevious()
+        if paragraph.tail is None or paragraph.tail == '':
+            paragraph.getparent().remove(paragraph)
+            self.debug.print_debug(self, u'Removed an empty element')
+        else:
+            sibling = paragraph.getprevious()
 
-                if sibling is None:
-                    if paragraph.getparent().text is not None:
-                        paragraph.getparent().text += paragraph.tail
-                    else:
-                        paragraph.getparent().text = paragraph.tail
+            if sibling is None:
+                if paragraph.getparent().text is not None:
+                    paragraph.getparent().text += paragraph.tail
                 else:
-                    sibling.tail = paragraph.tail
-
-                paragraph.getparent().remove(paragraph)
-                self.save_tree(tree)
-                self.debug.print_debug(self, u'Removed an empty element but preserved tail')
-
-        self.save_tree(tree)
+                    paragraph.getparent().text = paragraph.tail
+            else:
+                sibling.tail = paragraph.tail
 
-    def double_p_compliance(self):
-        self.debug.print_debug(self, u'Attempting to correct any mis-nested paragraph elements')
+            paragraph.getparent().remove(paragraph)
+            self.debug.print_debug(self, u'Removed an empty element but preserved tail')
 
-        manipulate = NlmManipulate(self.gv)
+        return True
 
-        tree = manipulate.load_dom_tree()
-        bad_ps = tree.xpath('//p/p')
+    @staticmethod
+    def unnest_paragraph(p):
+        """
+        Moves a paragraph that is nested in another paragraph to just after it (a cleanup rule action)
+        @param p: a p element whose parent is a p element
+        @return: True
+        """
+        p_parent = p.getparent()
+        parent = p_parent.getparent()
+        parent.insert(parent.index(p_parent)+1, p)
 
-        for p in bad_ps:
-            p_parent = p.getparent()
-            parent = p_parent.getparent()
-            parent.insert(parent.index(p_parent)+1, p)
+        return True
 
-        self.save_tree(tree)
+    def double_p_compliance(self):
+        self.debug.print_debug(self, u'Attempting to correct any mis-nested paragraph elements')
 
+        rules = CleanupRules(self)
+        rules.add(u'Moved mis-nested paragraphs', 'p', self.unnest_paragraph, 'parent::p', before_children=True)
+        rules.run()
 
     @staticmethod
-    def handle_nested_elements(iter_node, move_node, node, node_parent, outer_node, tag_name, tail_stack,
-                               tail_stack_objects):
-        if iter_node is None:
-            return None, None, None
-
-        while iter_node.tag != tag_name:
-            tail_stack.append(iter_node.tag)
-            tail_stack_objects.append(iter_node)
-            iter_node = iter_node.getparent()
-            if iter_node is None:
-                return None, None, None
-
-        # get the tail (of the comment) and style it
-        append_location = None
-        tail_text = node.tail
-        iterator = 0
-        tail_stack.reverse()
-        tail_stack_objects.reverse()
-        # rebuild the styled tree on a set of subelements
-        for node_to_add in tail_stack:
-            sub_element = etree.Element(node_to_add)
-            if iterator == len(tail_stack) - 1:
-                sub_element.text = node.tail
-
-            if iterator == 0:
-                outer_node = sub_element
-
-            iterator += 1
-            if append_location is None:
-                tail_stack_objects[0].addnext(sub_element)
-                append_location = sub_element
-            else:
-                Manipulate.append_safe(append_location, sub_element, None)
-                append_location = sub_element
+    def split_at_break(node, block, new_tag):
+        """
+        Splits an element (a paragraph or a title) at a line break marker anywhere inside it. The content after the
+        marker moves into a new element that is placed after the block, inside copies of the inline elements (bold,
+        italic etc.) that the marker was nested in, so that for example
+        <p>A <italic>second<!--meTypeset:br-->third</italic> line</p> becomes
+        <p>A <italic>second</italic></p><p><italic>third</italic> line</p>
+        @param node: the marker
+        @param block: the ancestor of the marker that is split
+        @param new_tag: the tag of the new element
+        @return: the new element, or None if nothing but whitespace followed the marker (the marker is then removed)
+        """
+        # the inline elements between the block and the marker, outermost first, followed by the marker itself
+        path = [node]
 
-        # remove the old node (this is in the element above)
-        node.getparent().remove(node)
-        # set the search node to the outermost node so that we can find siblings
-        node_parent = iter_node
-        node = outer_node
-        move_node = True
-        return move_node, node, node_parent
+        while path[0].getparent() is not block:
+            path.insert(0, path[0].getparent())
 
-    @staticmethod
-    def search_and_copy(last_node, move_node, nested_sibling, new_element, node, node_parent):
-        append_location = new_element
-        new_nodes_to_copy = node.xpath('following-sibling::node()')
-        last_append = None
-        for new_node in new_nodes_to_copy:
-            if type(new_node) is etree._ElementStringResult or type(new_node) is etree._ElementUnicodeResult:
-                if last_append is None:
-                    last_append = append_location
-                    if move_node:
-                        node.tail = new_node
-                        Manipulate.append_safe(last_append, node, None)
-                    else:
-                        last_append.text = new_node
-                else:
-                    last_append.tail = new_node
-            else:
-                Manipulate.append_safe(append_location, new_node, None)
-                last_append = new_node
-        if nested_sibling is None:
-            node_parent.addnext(new_element)
-            node_parent.tail = ''
-            nested_sibling = new_element
-        else:
-            nested_sibling.addnext(new_element)
-            nested_sibling = new_element
-
-        # remove the original tail (all text after the line break, for example)
-        # <!--meTypeset:br-->A third break <-- "a third break" is the tail
-        if not move_node:
-            node.tail = ''
-            last_node = new_element
-        else:
-            last_node = None
-        return last_node
+        # whether anything follows each element of the path within its parent
+        follows = [element.getnext() is not None or (element.tail is not None and element.tail != '')
+                   for element in path]
 
-    def process_node_for_tags(self, nested_sibling, node, search_xpath, tag_name, new_tag='SAME'):
-        if new_tag == 'SAME':
-            new_tag = tag_name
+        if len([element for element in path if element.getnext() is not None
+                or (element.tail is not None and element.tail.strip() != '')]) == 0:
+            node.getparent().remove(node)
+            return None
 
-        last_node = node
         new_element = etree.Element(new_tag)
-        new_element.text = ''
-        nodes_to_copy = node.xpath('//{0}/following-sibling::node()'.format(search_xpath))
+        container = new_element
+
+        for position, element in enumerate(path):
+            following = list(element.itersiblings())
+            copy = None
+
+            if element is node:
+                container.text = node.tail
+            elif True in follows[position + 1:]:
+                # the inline element continues after the marker, so it is opened again in the new element
+                copy = etree.SubElement(container, element.tag,
+                                        dict([(key, value) for key, value in element.attrib.items() if key != 'id']))
+                copy.tail = element.tail
+            else:
+                container.text = element.tail
 
-        if len(nodes_to_copy) == 0:
-            return
+            element.tail = None
 
-        self.debug.print_debug(self, u'Found {0} nodes to copy: {1}'.format(len(nodes_to_copy),
-                                                                           nodes_to_copy))
-        #for element in nodes_to_copy:
-        element = nodes_to_copy[0]
-        # noinspection PyProtectedMember
-        if not type(element) is etree._Element:
-            if node.tail == element:
-                # this should handle cases where a tag spans the break
-                # for example: <p>Some text <italic>some italic text<!--meTypeset:br-->
-                # more italic text</italic> more text</p>
-                node_parent = node.getparent()
-                iter_node = node_parent
-                tail_stack = []
-                tail_stack_objects = []
-                move_node = False
-                outer_node = None
-
-                if node_parent.tag != tag_name:
-                    # the element here is nested (bold etc), so we need to move the tail to be the tail of the
-                    # outermost element and change "node" to be correct for its siblings to be the rest of
-                    # the element. So we might find the last part is in italics and bold, so we build a list and
-                    # iterate over it within the new copied element
-                    move_node, node, node_parent = self.handle_nested_elements(iter_node, move_node, node,
-                                                                               node_parent, outer_node, tag_name,
-                                                                               tail_stack, tail_stack_objects)
-
-                # search for all siblings and copy them into a new element below
-                last_node = self.search_and_copy(last_node, move_node, nested_sibling, new_element, node,
-                                                 node_parent)
+            for sibling in following:
+                container.append(sibling)
 
-            else:
-                new_element.tail = node.tail
-                node.tail = ''
-        else:
-            Manipulate.append_safe(new_element, element, self)
-        if not last_node is None:
-            last_node.addnext(new_element)
-            node.getparent().remove(node)
+            if copy is None:
+                break
 
-    @staticmethod
-    def add_error_tag(node, error_number):
-        rend = 'error-{0}'.format(error_number)
+            container = copy
 
-        if u'rend' in node.attrib:
-            if not rend in node.attrib['rend']:
-                # append the new value
-                rend = u'{0} {1}'.format(node.attrib[u'rend'], rend)
-            else:
-                # just re-write the old value
-                rend = node.attrib[u'rend']
+        node.getparent().remove(node)
+        block.addnext(new_element)
 
-        node.attrib[u'rend'] = rend
+        return new_element
 
-    def close_and_open_tag_not_styled(self, search_xpath, tag_name):
+    def split_at_breaks(self, search_xpath, tag_name, new_tag, styled=True):
         """
-        Opens and closes an XML tag within a document. This is primarily useful when we have a marker such as
-        meTypeset:br in comments which corresponds to no JATS/NLM equivalent. We use this function in certain
-        behavioural modes to close the preceding paragraph and open the next.
-
-        This variant only performs this action when the subsequent text does not look like a heading.
-
+        Splits every tag_name element at the markers inside it in one traversal. The markers are handled from the last
+        to the first, so the content after each marker is moved only once.
         @param search_xpath: the node that serves as a marker
-        @param tag_name: the tag name that will be open and closed
+        @param tag_name: the tag name that will be closed and opened
+        @param new_tag: the tag of the elements that are opened
+        @param styled: False to leave whole any element in which a marker is followed by another node (such as styled
+        text that may be a subtitle)
         """
         tree = self.load_dom_tree()
 
@@ -243,78 +159,50 @@ class NlmManipulate(Manipulate):
         self.debug.print_debug(self, u'Found {0} {1} nodes on which to close and open tag {2}'.format(
             len(initial_nodes), search_xpath, tag_name))
 
-        nested_sibling = None
-        bail = False
-
-        if len(initial_nodes) > 80 and int(self.gv.settings.args["--aggression"]) < 11:
-            self.debug.print_debug(self, u'Bailing from replacement of tag {0} [limit exceeded]'.format(search_xpath))
-            self.debug.write_error(self,
-                                   'Bailing from replacement of tag {0} [limit exceeded]'.format(search_xpath),
-                                   '001')
-            bail = True
-
-        if not bail:
-            for node in initial_nodes:
-                sibling = node
-
-                while sibling.getnext() is not None:
-                    try:
-                        if sibling.tag.endswith('bold'):
-                            bail = True
-                    except:
-                        bail = True
-                        break
+        blocks = [next(node.iterancestors(tag_name)) for node in initial_nodes]
+        unsplit = set()
 
-                if not bail:
-                    self.process_node_for_tags(nested_sibling, node, search_xpath, tag_name, 'p')
-        else:
-            # add an error tag to p elements where there are more than 3 comments within
-            children = tree.xpath('//*[count(comment()[.="meTypeset:br"]) > 3]'.format(search_xpath))
+        if not styled:
+            unsplit = set([block for node, block in zip(initial_nodes, blocks) if node.getnext() is not None])
+
+        count = 0
+
+        for node, block in reversed(list(zip(initial_nodes, blocks))):
+            if block not in unsplit:
+                self.split_at_break(node, block, new_tag)
+                count += 1
 
-            for child in children:
-                self.add_error_tag(child, u'001')
+        if count > 0:
+            self.debug.print_debug(self, u'Closed and opened tag {0} at {1} markers'.format(tag_name, count))
 
         self.save_tree(tree)
 
-    def close_and_open_tag(self, search_xpath, tag_name):
+    def close_and_open_tag_not_styled(self, search_xpath, tag_name):
         """
         Opens and closes an XML tag within a document. This is primarily useful when we have a marker such as
         meTypeset:br in comments which corresponds to no JATS/NLM equivalent. We use this function in certain
-        behavioural modes to close the preceding paragraph and open the next.
+        behavioural modes to close the preceding title and open a paragraph.
+
+        This variant only performs this action when only text follows each marker, so that a title whose subsequent
+        text may be styled as a heading is left whole.
 
         @param search_xpath: the node that serves as a marker
         @param tag_name: the tag name that will be open and closed
         """
-        tree = self.load_dom_tree()
-
-        initial_nodes = tree.xpath('//{0}//{1}'.format(tag_name, search_xpath))
-        self.debug.print_debug(self, u'Found {0} {1} nodes on which to close and open tag {2}'.format(
-            len(initial_nodes), search_xpath, tag_name))
-
-        nested_sibling = None
-        bail = False
-
-        if len(initial_nodes) > 80 and int(self.gv.settings.args["--aggression"]) < 11:
-            self.debug.print_debug(self, u'Bailing from replacement of tag {0} [limit exceeded]'.format(search_xpath))
-            self.debug.write_error(self,
-                                   'Bailing from replacement of tag {0} [limit exceeded]'.format(search_xpath),
-                                   '001')
-            bail = True
+        self.split_at_breaks(search_xpath, tag_name, 'p', False)
 
-        if not bail:
-            for node in initial_nodes:
-                if not bail:
-                    self.process_node_for_tags(nested_sibling, node, search_xpath, tag_name)
-        else:
-            # add an error tag to p elements where there are more than 3 comments within
-            children = tree.xpath('//*[count(comment()[.="meTypeset:br"]) > 3]'.format(search_xpath))
-
-            for child in children:
-                self.add_error_tag(child, u'001')
+    def close_and_open_tag(self, search_xpath, tag_name):
+        """
+        Opens and closes an XML tag within a document. This is primarily useful when we have a marker such as
+        meTypeset:br in comments which corresponds to no JATS/NLM equivalent. We use this function in certain
+        behavioural modes to close the preceding paragraph and open the next.
 
-        self.save_tree(tree)
+        @param search_xpath: the node that serves as a marker
+        @param tag_name: the tag name that will be open and closed
+        """
+        self.split_at_breaks(search_xpath, tag_name, tag_name)
 
-    def save_tree(self, tree):
+    def write_tree(self, tree):
         tree.write(self.dom_temp_file, pretty_print=True)
         tree.write(self.dom_to_load, pretty_print=True)
 
@@ -475,34 +363,36 @@ class NlmManipulate(Manipulate):
 
         return ret
 
-    def delete_special_lines(self):
-        tree = self.load_dom_tree()
+    def delete_special_line(self, paragraph):
+        """
+        Removes a paragraph that consists only of punctuation (a cleanup rule action)
+        @param paragraph: a p element
+        @return: True if the paragraph was removed
+        """
+        text = self.get_stripped_text(paragraph)
 
-        special_regex = re.compile('^[\-\.\,\+\#\'\;\:]+$')
+        if not re.match(r'^[\-\.\,\+\#\'\;\:]+$', text):
+            return False
 
-        to_remove = []
+        paragraph.getparent().remove(paragraph)
+        self.debug.print_debug(self, u'Removing special character line: {0}'.format(text))
 
-        for ref in tree.xpath('//p'):
-            text = self.get_stripped_text(ref)
-
-            if special_regex.match(text):
-                ref.getparent().remove(ref)
-                self.save_tree(tree)
-                self.debug.print_debug(self, u'Removing special character line: {0}'.format(text))
-
-    def clean_refs(self):
-        tree = self.load_dom_tree()
+        return True
 
+    def clean_ref(self, ref):
+        """
+        Removes the number from the start of a reference and encapsulates it inside a mixed-citation block unless it
+        is an element-citation (a cleanup rule action)
+        @param ref: a ref element in the reference list
+        @return: True
+        """
         ref_regex = re.compile('^(?P<prelim>\s*\d+[\.\,]?\s+)(?P<reference>.+)')
 
-        for ref in tree.xpath('//back/ref-list/ref'):
-            if ref.text and ref_regex.match(ref.text):
-                ref.text = ref_regex.sub('\\g<reference>', ref.text)
-                self.save_tree(tree)
-                self.debug.print_debug(self,
-                                       u'Removing number/whitespace from start of reference: {0}'.format(ref.text))
+        if ref.text and ref_regex.match(ref.text):
+            ref.text = ref_regex.sub('\\g<reference>', ref.text)
+            self.debug.print_debug(self, u'Removing number/whitespace from start of reference: {0}'.format(ref.text))
 
-        for ref in tree.xpath('//back/ref-list/ref[not(element-citation)]'):
+        if ref.find('element-citation') is None:
             new_ref = etree.Element('ref')
             ref.addnext(new_ref)
 
@@ -513,16 +403,88 @@ class NlmManipulate(Manipulate):
                 new_ref.attrib['id'] = ref.attrib['id']
                 del ref.attrib['id']
 
-        self.save_tree(tree)
-        self.debug.print_debug(self, u'Encapsulated any loose refs inside mixed-citation blocks')
+        return True
+
+    def remove_stranded_title(self, section, reference_terms, emptied):
+        """
+        Removes a section that holds nothing but a title whose text is in our linguistic cues documents, as left behind
+        by reference parsing (a cleanup rule action)
+        @param section: a sec element with one title and no paragraphs
+        @param reference_terms: the lower-cased cue lines
+        @param emptied: the elements that cleanup has already removed a child from; these held more than a title when
+        stranded titles were looked for, so they are left alone
+        @return: True if the section was removed
+        """
+        if section in emptied:
+            return False
+
+        for item in section:
+            if item.tag != 'title':
+                return False
+
+        text = self.get_stripped_text(section[0]).strip()
+
+        if text.lower() not in reference_terms:
+            return False
+
+        emptied.add(section.getparent())
+        section.getparent().remove(section)
+        self.debug.print_debug(self, u'Removed a stranded title: {0}'.format(text))
+
+        return True
+
+    def remove_empty_child(self, element, emptied):
+        """
+        Removes an empty element (see remove_empty_element) and records its parent in emptied (a cleanup rule action)
+        @param element: the element to test
+        @param emptied: the set of elements that cleanup has removed a child from
+        @return: True if the element was removed
+        """
+        parent = element.getparent()
+
+        if not self.remove_empty_element(element):
+            return False
+
+        emptied.add(parent)
+
+        return True
 
     def final_clean(self):
-        self.delete_special_lines()
-        self.handle_stranded_reference_titles_from_cues()
-        self.clean_refs()
-        self.remove_empty_elements('//fn-group')
-        self.remove_empty_elements('//p')
-        self.remove_empty_elements('//ref-list')
+        self.debug.print_debug(self, u'Checking for any stranded titles as a result of reference parsing')
+
+        language_list = self.gv.settings.get_setting('reference-languages', self).split(',')
+
+        reference_terms = []
+
+        for language in language_list:
+            for line in self.get_language_cues(self.gv.script_dir, language):
+                reference_terms.append(line.lower())
+
+        # special character lines go first, in a walk of their own, as the first of the old separate passes removed
+        # them; the other checks then see the document without them (so an fn-group whose notes held nothing but such
+        # lines is empty)
+        special_lines = CleanupRules(self)
+        special_lines.add(u'Removed special character lines', 'p', self.delete_special_line, before_children=True)
+        special_lines.run()
+
+        # footnote groups and paragraphs are tested in document order, as the separate passes tested them (so an outer
+        # element is tested before the paragraphs inside it are removed); sections and reference lists are tested
+        # once their contents have been cleaned, but stranded titles were looked for before any empty element or
+        # nested stranded title was removed, so a section that has lost a child that way is not treated as stranded
+        emptied = set()
+
+        rules = CleanupRules(self)
+        rules.add(u'Removed stranded titles', 'sec',
+                  lambda section: self.remove_stranded_title(section, reference_terms, emptied),
+                  'count(p) = 0 and count(title) = 1')
+        rules.add(u'Encapsulated loose refs inside mixed-citation blocks', 'ref', self.clean_ref,
+                  'parent::ref-list/parent::back')
+        rules.add(u'Removed empty fn-group elements', 'fn-group',
+                  lambda element: self.remove_empty_child(element, emptied), before_children=True)
+        rules.add(u'Removed empty paragraphs', 'p', lambda element: self.remove_empty_child(element, emptied),
+                  before_children=True)
+        rules.add(u'Removed empty reference lists', 'ref-list', self.remove_empty_element)
+        rules.run()
 
     def find_reference_list(self):
         if self.gv.used_list_method or self.gv.used_square_reference_method:
@@ -549,42 +511,6 @@ class NlmManipulate(Manipulate):
 
         self.save_tree(tree)
 
-    def handle_stranded_reference_titles_from_cues(self):
-        # this method looks for paragraphs with one title element and nothing else whose text is in our
-        # linguistic cues documents. It then removed them as superfluous.
-
-        self.debug.print_debug(self, u'Checking for any stranded titles as a result of reference parsing')
-
-        tree = self.load_dom_tree()
-
-        xpath = '//sec[(count(p) = 0) and (count(title) = 1)]'
-
-        language_list = self.gv.settings.get_setting('reference-languages', self).split(',')
-
-        reference_terms = []
-
-        for language in language_list:
-            with open ('{0}/language/ref_marker_{1}.txt'.format(self.gv.script_dir, language), 'r', encoding="utf8") as lang_file:
-                lines = lang_file.read().split('\n')
-
-                for line in lines:
-                    reference_terms.append(line.lower())
-
-        for sections in tree.xpath(xpath):
-            process = True
-            for item in sections:
-                if item.tag != 'title':
-                    process = False
-
-            if process:
-                for item in sections:
-                    text = self.get_stripped_text(item).strip()
-
-                    if text.lower() in reference_terms:
-                        sections.getparent().remove(sections)
-                        self.save_tree(tree)
-                        self.debug.print_debug(self, u'Removed a stranded title: {0}'.format(text))
-
     def fuse_references(self):
         tree = self.load_dom_tree()
 
@@ -626,7 +552,7 @@ class NlmManipulate(Manipulate):
             else:
                 self.debug.print_debug(self, u'Tagging element "{0}" as reference item'.format(refs.tag))
                 refs.tag = 'ref'
-                refs.attrib['id'] = u'ID{0}'.format(uuid.uuid4())
+                refs.attrib['id'] = self.gv.identifiers.new_id(self)
 
                 if 'rend' in refs.attrib:
                         del refs.attrib['rend']
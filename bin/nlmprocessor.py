@@ -11,6 +11,7 @@ Options:
     -d, --debug                                     Enable debug output
     -h, --help                                      Show this screen.
     -i, --identifiers                               Generate unique identifiers for all supported NLM elements
+    --profile                                       Write per-stage timings to <input>.profile.json and .folded
     --interactive                                   Enable step-by-step interactive mode
     --nogit                                         Disable git debug filesystem (only of use with --debug)
     --noimageprocessing                             Disable unoconv image processing
@@ -50,44 +51,64 @@ def main():
     nlm_instance = TeiToNlm(bare_gv)
 
     if args['process']:
+            # each module's saves are held in the document session and written once at its commit point
+            session = bare_gv.session
+            bare_gv.profiler.start()
+
             # run non-transform portions of teitonlm
-            TeiToNlm(bare_gv).run(True, False)
+            nlm_instance.run(True, False)
+            session.commit(nlm_instance)
+
             # run reference linker
             rl = ReferenceLinker(bare_gv)
             rl.run(args['--interactive'])
             rl.cleanup()
+            session.commit(rl)
 
             bibliography_classifier = BibliographyClassifier(bare_gv)
 
             # run table classifier
             cc = CaptionClassifier(bare_gv)
-            if int(args['--aggression']) > int(bare_gv.settings.get_setting('tablecaptions',
-                                                                            None, domain='aggression')):
+            if int(args['--aggression']) > bare_gv.settings.get_aggression('tablecaptions', None):
                 cc.run_tables()
 
-            if int(args['--aggression']) > int(bare_gv.settings.get_setting('graphiccaptions',
-                                                                            None, domain='aggression')):
+            if int(args['--aggression']) > bare_gv.settings.get_aggression('graphiccaptions', None):
                 cc.run_graphics()
 
+            session.commit(cc)
+
             if args['--interactive']:
                 bibliography_classifier.run_prompt(True)
+                session.commit(bibliography_classifier)
 
             # process any bibliography entries that are possible
-            BibliographyDatabase(bare_gv).run()
+            bibliography_database = BibliographyDatabase(bare_gv)
+            bibliography_database.run()
+            session.commit(bibliography_database)
 
             # remove stranded titles
             manipulate = NlmManipulate(bare_gv)
             manipulate.final_clean()
+            session.commit(manipulate)
 
             if args['--identifiers']:
-                IdGenerator(bare_gv).run()
+                id_generator = IdGenerator(bare_gv)
+                id_generator.run()
+                session.commit(id_generator)
 
             if args['--chain']:
                 # construct and run an XSLT chainer
-                XslChain(bare_gv).run()
+                xsl_chain = XslChain(bare_gv)
+                xsl_chain.run()
+                session.commit(xsl_chain)
 
             if args['--clean']:
-                ComplianceEnforcer(bare_gv).run()
+                compliance_enforcer = ComplianceEnforcer(bare_gv)
+                compliance_enforcer.run()
+                session.commit(compliance_enforcer)
+
+            session.report()
+            bare_gv.profiler.write(bare_gv.input_file_path + '.profile', 'nlmprocessor')
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
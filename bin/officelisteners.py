@@ -0,0 +1,195 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that runs unoconv conversions through a pool of long-lived headless office listeners instead of starting an
+office instance for every conversion.
+
+1.) Up to office-listeners listeners ("unoconv --listener") are started on free local ports the first time they are
+    needed; the pool size is also the limit on concurrent conversions
+2.) Before each conversion the listener is health checked (process alive and port accepting connections) and restarted
+    if it has died
+3.) A listener is recycled after office-listener-recycle conversions and after any conversion that exceeds
+    office-conversion-timeout seconds
+4.) With office-listeners set to 0, or once a listener has failed to start, unoconv runs on its own as it always has
+"""
+
+import atexit
+import os
+import signal
+import socket
+import subprocess
+import threading
+import time
+from queue import Queue
+from debug import Debuggable
+
+
+class OfficeListener(object):
+    def __init__(self):
+        self.process = None
+        self.port = None
+        self.conversions = 0
+
+
+class OfficeListeners(Debuggable):
+    def __init__(self, gv):
+        self.gv = gv
+        self.debug = self.gv.debug
+        self.size = self.gv.settings.get_integer('office-listeners', self)
+        self.recycle_after = self.gv.settings.get_integer('office-listener-recycle', self)
+        self.startup_timeout = self.gv.settings.get_integer('office-listener-startup', self)
+        self.listeners = Queue()
+        self.stats = {'started': 0, 'recycled': 0, 'conversions': 0, 'cold': 0}
+        self.stats_lock = threading.Lock()
+        self.registered = False
+        self.unavailable = False
+
+        for index in range(self.size):
+            self.listeners.put(OfficeListener())
+
+        Debuggable.__init__(self, 'Office Listeners')
+
+    def attach(self, gv):
+        """
+        Hands this pool (and its running listeners) to the GV of another document in the same process
+        @param gv: the new document's global variables
+        """
+        self.gv = gv
+        self.debug = self.gv.debug
+        self.gv.office = self
+
+    def unoconv(self):
+        return self.gv.settings.get_setting('unoconv', self)
+
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+
+    @staticmethod
+    def free_port():
+        probe = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+        probe.close()
+
+        return port
+
+    @staticmethod
+    def accepting(port):
+        try:
+            connection = socket.create_connection(('127.0.0.1', port), timeout=1)
+            connection.close()
+            return True
+        except (IOError, OSError):
+            return False
+
+    def healthy(self, listener):
+        return listener.process is not None and listener.process.poll() is None and self.accepting(listener.port)
+
+    def start_listener(self, listener):
+        """
+        Starts a listener and waits for it to accept connections
+        @param listener: the pool slot to start
+        @return: True if the listener is ready
+        """
+        self.stop_listener(listener)
+
+        listener.port = self.free_port()
+
+        if not self.registered:
+            atexit.register(self.stop)
+            self.registered = True
+
+        try:
+            # a session of its own, so that stopping the listener also stops the office process that it spawns
+            listener.process = subprocess.Popen([self.unoconv(), '--listener', '--port', str(listener.port)],
+                                                stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                                                start_new_session=True)
+        except OSError:
+            listener.process = None
+            return False
+
+        deadline = time.time() + self.startup_timeout
+
+        while time.time() < deadline:
+            if listener.process.poll() is not None:
+                break
+
+            if self.accepting(listener.port):
+                self.count('started')
+                return True
+
+            time.sleep(0.25)
+
+        self.stop_listener(listener)
+
+        return False
+
+    @staticmethod
+    def stop_listener(listener):
+        if listener.process is None:
+            return
+
+        try:
+            if hasattr(os, 'killpg'):
+                os.killpg(listener.process.pid, signal.SIGTERM)
+            else:
+                listener.process.terminate()
+
+            listener.process.wait(10)
+        except (OSError, subprocess.TimeoutExpired):
+            listener.process.kill()
+
+        listener.process = None
+        listener.conversions = 0
+
+    def run(self, arguments, timeout=None):
+        """
+        Runs unoconv through a listener. This may be called from worker threads, so it does not print; call report
+        afterwards.
+        @param arguments: the unoconv arguments (without the executable or a port)
+        @param timeout: the number of seconds after which the conversion is killed (and its listener recycled)
+        @return: the exit status of unoconv
+        @raise subprocess.TimeoutExpired: if the conversion took longer than the timeout
+        """
+        if self.size < 1 or self.unavailable:
+            self.count('cold')
+            return subprocess.run([self.unoconv()] + arguments, timeout=timeout).returncode
+
+        listener = self.listeners.get()
+
+        try:
+            if not self.healthy(listener) and not self.start_listener(listener):
+                self.unavailable = True
+                self.count('cold')
+                return subprocess.run([self.unoconv()] + arguments, timeout=timeout).returncode
+
+            listener.conversions += 1
+            self.count('conversions')
+
+            try:
+                return subprocess.run([self.unoconv(), '--port', str(listener.port)] + arguments,
+                                      timeout=timeout).returncode
+            except subprocess.TimeoutExpired:
+                # a listener that hung on one document is not trusted with the next
+                self.stop_listener(listener)
+                self.count('recycled')
+                raise
+        finally:
+            if listener.process is not None and listener.conversions >= self.recycle_after:
+                self.stop_listener(listener)
+                self.count('recycled')
+
+            self.listeners.put(listener)
+
+    def report(self):
+        self.debug.print_debug(self, u'{0} conversion(s) through listeners, {1} without; {2} listener(s) started and '
+                                     u'{3} recycled'.format(self.stats['conversions'], self.stats['cold'],
+                                                            self.stats['started'], self.stats['recycled']))
+
+    def stop(self):
+        for index in range(self.size):
+            listener = self.listeners.get()
+            self.stop_listener(listener)
+            self.listeners.put(listener)
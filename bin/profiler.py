@@ -0,0 +1,194 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that records where a meTypeset run spends its time (enabled with --profile).
+
+1.) A stage runs from one commit point of the document session to the next and is named after the committing module
+    and, when the pipeline gives one, the stage's own name (NlmManipulate commits at three points)
+2.) Each stage records wall time, CPU time (own and reaped child processes), DOM parses and serializations, bytes
+    read and written, time spent waiting on subprocesses (Saxon, unoconv) and the peak RSS at its end
+3.) Writes the stages as JSON and as collapsed stacks (one "frame;frame time" line each) that flamegraph tools read
+"""
+
+import contextlib
+import json
+import os
+import time
+from debug import Debuggable
+
+try:
+    import resource
+except ImportError:
+    # peak RSS is not available on this platform
+    resource = None
+
+
+class Profiler(Debuggable):
+    def __init__(self, gv, enabled=False):
+        self.gv = gv
+        self.debug = self.gv.debug
+        self.enabled = enabled
+        self.stages = []
+        self.subprocesses = {}
+        self.started = None
+        self.last = None
+        Debuggable.__init__(self, 'Profiler')
+
+    @staticmethod
+    def io_counters():
+        """
+        Reads the bytes this process has read and written so far
+        @return: a tuple of bytes read and bytes written or (None, None) if the platform does not report them
+        """
+        try:
+            with open('/proc/self/io', 'r') as io:
+                counters = dict(line.split(': ') for line in io.read().splitlines())
+
+            return int(counters['rchar']), int(counters['wchar'])
+        except (IOError, OSError, KeyError, ValueError):
+            return None, None
+
+    @staticmethod
+    def peak_rss():
+        """
+        @return: the peak resident set size of this process and of its largest reaped child, in kilobytes
+        """
+        if resource is None:
+            return None, None
+
+        return (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+                resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+    def sample(self):
+        times = os.times()
+        bytes_read, bytes_written = self.io_counters()
+
+        return {'wall': time.time(), 'cpu': times[0] + times[1], 'child_cpu': times[2] + times[3],
+                'parses': self.gv.session.parses, 'serializations': self.gv.session.serializations,
+                'bytes_read': bytes_read, 'bytes_written': bytes_written}
+
+    def start(self):
+        if not self.enabled:
+            return
+
+        self.started = self.sample()
+        self.last = self.started
+
+    def checkpoint(self, caller, stage_name=None):
+        """
+        Ends the current stage and attributes it to the calling module. Called at every commit point.
+        @param caller: the module whose work has just been committed
+        @param stage_name: the name of the pipeline stage, or None if the module commits at a single point
+        """
+        if not self.enabled or self.last is None:
+            return
+
+        now = self.sample()
+        stage = {'name': caller.get_module_name(), 'stage': stage_name, 'subprocesses': self.subprocesses}
+
+        for key, value in now.items():
+            stage[key] = None if value is None or self.last[key] is None else value - self.last[key]
+
+        stage['peak_rss_kb'], stage['peak_child_rss_kb'] = self.peak_rss()
+
+        self.stages.append(stage)
+        self.subprocesses = {}
+        self.last = now
+
+    @contextlib.contextmanager
+    def subprocess(self, name):
+        """
+        Times a call out to another process and adds it to the current stage
+        @param name: the kind of subprocess (for instance "saxon" or "unoconv")
+        """
+        if not self.enabled:
+            yield
+            return
+
+        start = time.time()
+
+        try:
+            yield
+        finally:
+            self.subprocesses[name] = self.subprocesses.get(name, 0) + time.time() - start
+
+    def summarize(self):
+        """
+        Merges the commit points of each module and stage (a module can commit several times within one stage, for
+        instance in a loop) in the order that they first ran. The stages of a module that commits at several points of
+        the pipeline, such as NlmManipulate, are kept apart.
+        @return: a list of stage dictionaries with a count of the commit points merged into each
+        """
+        merged = {}
+        order = []
+
+        for stage in self.stages:
+            key = (stage['name'], stage['stage'])
+
+            if key not in merged:
+                merged[key] = dict(stage, subprocesses=dict(stage['subprocesses']), commits=1)
+                order.append(key)
+                continue
+
+            total = merged[key]
+            total['commits'] += 1
+
+            for field in ['wall', 'cpu', 'child_cpu', 'parses', 'serializations', 'bytes_read', 'bytes_written']:
+                total[field] = None if total[field] is None or stage[field] is None else total[field] + stage[field]
+
+            for field in ['peak_rss_kb', 'peak_child_rss_kb']:
+                total[field] = stage[field]
+
+            for name, seconds in stage['subprocesses'].items():
+                total['subprocesses'][name] = total['subprocesses'].get(name, 0) + seconds
+
+        return [merged[key] for key in order]
+
+    def collapsed_stacks(self, root, stages):
+        """
+        @param root: the name of the bottom frame
+        @param stages: the summarized stages
+        @return: collapsed stack lines with times in microseconds, with subprocess time as child frames of its stage
+        """
+        lines = []
+
+        for stage in stages:
+            frame = u'{0};{1}'.format(root, stage['name'].replace(';', ','))
+
+            if stage['stage'] is not None:
+                frame = u'{0};{1}'.format(frame, stage['stage'].replace(';', ','))
+            waited = sum(stage['subprocesses'].values())
+
+            lines.append(u'{0} {1}'.format(frame, int(max(stage['wall'] - waited, 0) * 1000000)))
+
+            for name, seconds in sorted(stage['subprocesses'].items()):
+                lines.append(u'{0};{1} {2}'.format(frame, name, int(seconds * 1000000)))
+
+        return lines
+
+    def write(self, base_path, root='meTypeset'):
+        """
+        Writes the profile to base_path.json and base_path.folded
+        @param base_path: the path to write to, without an extension
+        @param root: the name of the bottom frame in the collapsed stacks
+        """
+        if not self.enabled or self.started is None:
+            return
+
+        stages = self.summarize()
+        total = self.sample()
+
+        profile = {'wall': total['wall'] - self.started['wall'], 'cpu': total['cpu'] - self.started['cpu'],
+                   'child_cpu': total['child_cpu'] - self.started['child_cpu'],
+                   'parses': self.gv.session.parses, 'serializations': self.gv.session.serializations,
+                   'peak_rss_kb': self.peak_rss()[0], 'peak_child_rss_kb': self.peak_rss()[1],
+                   'stages': stages}
+
+        with open(base_path + '.json', 'w') as json_file:
+            json.dump(profile, json_file, indent=4)
+
+        with open(base_path + '.folded', 'w') as folded_file:
+            folded_file.write(u'\n'.join(self.collapsed_stacks(root, stages)) + u'\n')
+
+        self.debug.print_(self, u'Wrote profile of {0} stage(s) to {1}.json'.format(len(stages), base_path))
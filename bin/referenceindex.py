@@ -0,0 +1,103 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that indexes the items of a reference list by the words that they contain, so that the reference linker can
+find the references that match an author-year citation without comparing every word of the citation with every word of
+every reference.
+
+1.) One walk of the reference list files every reference under each of its words with the punctuation stripped from
+    their ends (so "Smith," and "2004a." are filed as "Smith" and "2004a"), and again with all punctuation and digits
+    removed (so "2004a" is also filed as "a")
+2.) A citation matches the references that contain every one of its words, found by intersecting the sets of
+    references filed under each word
+3.) A reference that does not match can still match with the digits removed (a word that is nothing but digits then
+    matches anything if the citation has more than one word), but this fallback never links to the last item in the
+    list because that is almost universally wrong
+4.) The references must not change while the index is in use
+"""
+
+import re
+
+# the characters that are stripped from words before they are compared
+punctuation = r'[,\.\<\>\(\)\;\:\@\'\#\~\}\{\[\]\"]'
+punctuation_and_digits = r'[,\.\<\>\(\)\;\:\@\'\#\~\}\{\[\]\"\d]'
+
+punctuation_pattern = re.compile(punctuation)
+punctuation_and_digits_pattern = re.compile(punctuation_and_digits)
+
+
+class ReferenceIndex(object):
+    def __init__(self, ref_items, tokens):
+        """
+        @param ref_items: the ref elements of the reference list, in order
+        @param tokens: a function that returns the words of an element (Manipulate.texts.tokens)
+        """
+        self.ref_items = ref_items
+        self.words = {}
+        self.bare_words = {}
+
+        for position, ref in enumerate(ref_items):
+            for token in tokens(ref):
+                self.words.setdefault(token.strip(punctuation), set()).add(position)
+
+                bare_word = punctuation_and_digits_pattern.sub('', token.strip()).strip()
+
+                if bare_word != '':
+                    self.bare_words.setdefault(bare_word, set()).add(position)
+
+    @staticmethod
+    def intersect(candidates, positions):
+        return set(positions) if candidates is None else candidates & positions
+
+    def find_words(self, items):
+        """
+        @param items: the words of a citation
+        @return: the positions of the references that contain every word
+        """
+        candidates = None
+
+        for item in items:
+            candidates = self.intersect(candidates, self.words.get(punctuation_pattern.sub('', item.strip()).strip(),
+                                                                   set()))
+
+            if len(candidates) == 0:
+                break
+
+        return candidates
+
+    def find_bare_words(self, items):
+        """
+        @param items: the words of a citation
+        @return: the positions of the references that contain every word once punctuation and digits are removed
+        """
+        candidates = None
+
+        for item in items:
+            bare_item = punctuation_and_digits_pattern.sub('', item.strip()).strip()
+
+            if bare_item == '':
+                if len(items) > 1:
+                    continue
+
+                return set()
+
+            candidates = self.intersect(candidates, self.bare_words.get(bare_item, set()))
+
+            if len(candidates) == 0:
+                break
+
+        return set(range(len(self.ref_items))) if candidates is None else candidates
+
+    def find(self, text):
+        """
+        @param text: the text of a citation (e.g. "Smith 2004a")
+        @return: the matching ref elements, in the order of the reference list
+        """
+        items = text.strip().replace(u',', '').split(u' ')
+
+        found = self.find_words(items)
+        fallback = self.find_bare_words(items) - found
+        fallback.discard(len(self.ref_items) - 1)
+
+        return [self.ref_items[position] for position in sorted(found | fallback)]
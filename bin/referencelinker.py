@@ -27,9 +27,9 @@ A class that looks for references to link in an NLM file and joins them to the c
 
 from debug import Debuggable
 from nlmmanipulate import NlmManipulate
+from referenceindex import ReferenceIndex
 import re
 import lxml
-import uuid
 from bare_globals import GV
 from docopt import docopt
 from interactive import Interactive
@@ -49,7 +49,7 @@ class ReplaceObject(Debuggable):
         if 'id' in self.reference_to_link.attrib:
             bib_id = self.reference_to_link.attrib['id']
         else:
-            self.reference_to_link.attrib['id'] = u'ID{0}'.format(uuid.uuid4())
+            self.reference_to_link.attrib['id'] = self.gv.identifiers.new_id(self)
             bib_id = self.reference_to_link.attrib['id']
 
         self.paragraph.attrib['rid'] = bib_id
@@ -58,168 +58,327 @@ class ReplaceObject(Debuggable):
 
 
 class ReplaceStub(Debuggable):
-    def __init__(self, global_variables, paragraph, replace_text, tree, manipulate, link_text='TO_LINK',
-                 length_ignore=False):
+    def __init__(self, global_variables, paragraph, replace_text, link_text='TO_LINK', length_ignore=False):
         self.paragraph = paragraph
         self.replace_text = replace_text
         self.gv = global_variables
         self.debug = self.gv.debug
-        self.tree = tree
-        self.manipulate = manipulate
         self.link_text = link_text
         self.length_ignore = length_ignore
         Debuggable.__init__(self, 'Reference Stub Linker Object')
 
-    def replace_in_text(self, element, link_text):
-        if not self.replace_text in element.text:
-            # safety check: if not in the text, just return
-            return element
+    def usable(self):
+        """
+        @return: False if the stub is too short to be linked safely
+        """
+        if self.replace_text is not None and self.replace_text == '':
+            self.debug.print_debug(self, u'Replace text is empty: bailing')
+            return False
 
-        before_after = element.text.split(self.replace_text, 1)
+        if not self.length_ignore and len(self.replace_text) < 3:
+            try:
+                int(self.replace_text)
+            except ValueError:
+                self.debug.print_debug(self, u'Replace text is too short: bailing')
+                return False
+
+        return True
+
+
+class StubSlot(object):
+    def __init__(self, owner, is_tail, leading_only):
+        """
+        A run of text that stubs may be linked in: the text of a paragraph, or the text or tail of one of its children
+        @param owner: the element whose text or tail this is
+        @param is_tail: True for the element's tail
+        @param leading_only: True if a stub may only be linked before the first earlier link (the text of a child
+        element); otherwise it may be linked in any part of the run that is not yet linked
+        """
+        self.owner = owner
+        self.is_tail = is_tail
+        self.leading_only = leading_only
+        self.text = (owner.tail if is_tail else owner.text) or ''
+        self.claims = []
+
+    def free_runs(self):
+        """
+        @return: a list of (start, end) tuples of the parts of the text that no stub has claimed yet
+        """
+        runs = []
+        position = 0
+
+        for start, end, stub in self.claims:
+            runs.append((position, start))
+            position = end
+
+        runs.append((position, len(self.text)))
+
+        return runs[:1] if self.leading_only else runs
+
+    def find(self, stub, start, end):
+        """
+        @param stub: a ReplaceStub
+        @return: the position of the first occurrence of the stub between start and end, or -1; a numeric stub does
+        not match inside a longer number (so "1" is not found in "(1999)")
+        """
+        length = len(stub.replace_text)
+        position = self.text.find(stub.replace_text, start, end)
+
+        if stub.replace_text.isdigit():
+            while position != -1 and (self.text[position - 1:position].isdigit() or
+                                      self.text[position + length:position + length + 1].isdigit()):
+                position = self.text.find(stub.replace_text, position + 1, end)
+
+        return position
+
+    def claim(self, stub):
+        """
+        Claims the first occurrence of a stub in the unclaimed parts of the text
+        @param stub: a ReplaceStub
+        @return: True if an occurrence was claimed
+        """
+        for start, end in self.free_runs():
+            position = self.find(stub, start, end)
+
+            if position != -1:
+                self.claims.append((position, position + len(stub.replace_text), stub))
+                self.claims.sort(key=lambda claim: claim[0])
+                return True
+
+        return False
+
+
+class StubLinker(Debuggable):
+    def __init__(self, global_variables, paragraph, stubs):
+        """
+        Links the stubs of one paragraph. Each stub claims its first occurrence in the paragraph's text and in the text
+        and tail of each of its children, in order (so a stub cannot claim text that an earlier stub has claimed), and
+        all claims are then turned into xref elements in one pass over the paragraph's mixed content.
+        @param global_variables: the global variables
+        @param paragraph: a p or td element
+        @param stubs: the ReplaceStub objects of the paragraph, in order
+        """
+        self.gv = global_variables
+        self.debug = self.gv.debug
+        self.paragraph = paragraph
+        self.stubs = stubs
+        self.slots = []
+        self.has_xref = False
+        Debuggable.__init__(self, 'Reference Stub Linker')
+
+    def read_slots(self):
+        self.slots = [StubSlot(self.paragraph, False, False)]
+        self.has_xref = False
+
+        for child in self.paragraph:
+            if child.tag == 'xref':
+                self.has_xref = True
+            elif isinstance(child.tag, str):
+                self.slots.append(StubSlot(child, False, True))
+
+            self.slots.append(StubSlot(child, True, False))
+
+    def new_xref(self, stub):
+        xref = etree.Element('xref')
+        xref.attrib['rid'] = stub.link_text
+        xref.attrib['ref-type'] = 'bibr'
+        xref.attrib['id'] = self.gv.identifiers.new_id(stub)
+
+        return xref
+
+    def apply(self):
+        """
+        Splits every slot at its claims, wrapping each claimed occurrence in an xref element
+        """
+        for slot in self.slots:
+            if len(slot.claims) == 0:
+                continue
+
+            if slot.is_tail:
+                container = slot.owner.getparent()
+                index = container.index(slot.owner) + 1
+            else:
+                container = slot.owner
+                index = 0
 
-        encapsulate = etree.Element(element.tag)
-        encapsulate.text = before_after[0]
+            ends = [start for start, end, stub in slot.claims[1:]] + [len(slot.text)]
 
-        new_element = etree.Element('xref')
-        new_element.attrib['rid'] = link_text
-        new_element.attrib['ref-type'] = 'bibr'
-        new_element.attrib['id'] = u'ID{0}'.format(uuid.uuid4())
-        new_element.text = self.replace_text
-        new_element.tail = ''.join(before_after[1:])
+            for (start, end, stub), next_start in zip(slot.claims, ends):
+                xref = self.new_xref(stub)
+                xref.text = slot.text[start:end]
+                xref.tail = slot.text[end:next_start]
+                container.insert(index, xref)
+                index += 1
 
-        Manipulate.append_safe(encapsulate, new_element, self)
+            if slot.is_tail:
+                slot.owner.tail = slot.text[:slot.claims[0][0]]
+            else:
+                slot.owner.text = slot.text[:slot.claims[0][0]]
 
-        for sub_element in element:
-            Manipulate.append_safe(encapsulate, sub_element, self)
+                # TEI markers such as rend="ref" are not valid NLM, so they go when an element's text is split
+                if 'rend' in slot.owner.attrib:
+                    del slot.owner.attrib['rend']
 
-        element.addnext(encapsulate)
-        element.getparent().remove(element)
+            Manipulate.invalidate_text(container)
 
-        return encapsulate
+    def text_runs(self):
+        """
+        @return: the text of the paragraph in document order, as a list of (owner, is_tail) tuples, with None marking
+        the start or end of each xref element
+        """
+        runs = []
 
-    def replace_in_tail(self, element, link_text):
+        for event, element in etree.iterwalk(self.paragraph, events=('start', 'end')):
+            if event == 'start':
+                if element.tag == 'xref':
+                    runs.append(None)
 
-        before_after = element.tail.split(self.replace_text, 1)
+                if isinstance(element.tag, str):
+                    runs.append((element, False))
+            else:
+                if element.tag == 'xref':
+                    runs.append(None)
 
-        new_element = etree.Element('xref')
-        new_element.attrib['rid'] = link_text
-        new_element.attrib['ref-type'] = 'bibr'
-        new_element.attrib['id'] = u'ID{0}'.format(uuid.uuid4())
-        new_element.text = self.replace_text
-        new_element.tail = ''.join(before_after[1:])
+                if element is not self.paragraph:
+                    runs.append((element, True))
 
-        element.getparent().insert(element.getparent().index(element) + 1, new_element)
+        return runs
 
-        element.tail = before_after[0]
+    @staticmethod
+    def run_text(run):
+        owner, is_tail = run
+        return (owner.tail if is_tail else owner.text) or ''
 
-        return new_element
+    def find_parenthesis(self):
+        """
+        Finds the first bracketed run of text in the paragraph that could be linked: the brackets must be on one line
+        with no xref after the opening bracket on that line
+        @return: the runs and offsets of the opening and closing brackets, or None
+        """
+        runs = self.text_runs()
 
-    def replace_in_text_and_update_others(self, object_list, link_text):
-        to_update = []
-        if object_list is not None:
-            for item in object_list:
-                if item.paragraph is self.paragraph:
-                    to_update.append(item)
+        for number, run in enumerate(runs):
+            if run is None:
+                continue
 
-        self.paragraph = self.replace_in_text(self.paragraph, self.link_text)
+            text = self.run_text(run)
+            opening = text.find('(')
 
-        for item in to_update:
-            item.paragraph = self.paragraph
+            while opening != -1:
+                closing = None
+                rejected = False
 
-    def link(self, object_list=None):
-        # this procedure is more complex than desirable because the content can appear between tags (like italic)
-        # otherwise it would be a straight replace
-        linked = False
-        in_xref = False
+                # read the rest of the line after the bracket
+                for later in range(number, len(runs)):
+                    if runs[later] is None:
+                        rejected = True
+                        break
 
-        if self.replace_text is not None and self.replace_text == '':
-            self.debug.print_debug(self, u'Replace text is empty: bailing')
-            return
+                    later_text = self.run_text(runs[later])
+                    start = opening + 1 if later == number else 0
+                    line_end = later_text.find('\n', start)
+                    line = later_text[start:] if line_end == -1 else later_text[start:line_end]
 
-        if not self.length_ignore and len(self.replace_text) < 3:
-            try:
-                attempt = int(self.replace_text)
-            except:
-                self.debug.print_debug(self, u'Replace text is too short: bailing')
-                return
+                    if 'xref' in line:
+                        rejected = True
+                        break
 
-        if self.paragraph.text and self.replace_text in self.paragraph.text and len(self.paragraph) > 0:
-            self.replace_in_text_and_update_others(object_list, self.link_text)
+                    if closing is None and ')' in line:
+                        closing = (runs[later], start + line.find(')'))
 
-            self.manipulate.save_tree(self.tree)
+                    if line_end != -1:
+                        break
 
-            self.debug.print_debug(self, u'Successfully linked {0} stub with sub elements'.format(self.replace_text))
-            linked = True
+                if not rejected and closing is not None:
+                    return run, opening, closing[0], closing[1]
 
-            self.tree = self.manipulate.load_dom_tree()
+                opening = text.find('(', opening + 1)
 
-        if self.paragraph.text and self.replace_text in self.paragraph.text and len(self.paragraph) == 0:
-            self.replace_in_text_and_update_others(object_list, self.link_text)
-            self.paragraph = self.replace_in_text(self.paragraph, self.link_text)
+        return None
 
-            self.manipulate.save_tree(self.tree)
+    def wrap_parenthesis(self, stub):
+        """
+        Wraps the first bracketed run of text in the paragraph (for instance "(<italic>Text Name</italic> 354)") in an
+        xref, for stubs that span tags. The run may contain elements but may not cross the start or end of one.
+        @param stub: the ReplaceStub that could not be linked
+        @return: True if the paragraph was changed
+        """
+        found = self.find_parenthesis()
 
-            self.debug.print_debug(self, u'Successfully linked {0} stub'.format(self.replace_text))
-            linked = True
+        if found is None:
+            self.debug.print_debug(self, u'Did not link {0} stub'.format(stub.replace_text))
+            return False
 
-            self.tree = self.manipulate.load_dom_tree()
+        (start_owner, start_is_tail), opening, (end_owner, end_is_tail), closing = found
 
-        for sub_element in self.paragraph:
-            if sub_element.tag != 'xref':
-                if sub_element.text and self.replace_text in sub_element.text:
-                    self.replace_in_text(sub_element, self.link_text)
+        container = start_owner.getparent() if start_is_tail else start_owner
 
-                    self.manipulate.save_tree(self.tree)
+        if (end_owner.getparent() if end_is_tail else end_owner) is not container:
+            self.debug.print_debug(self, u'Did not link {0} stub as had overlapping tags'.format(stub.replace_text))
+            return False
 
-                    self.debug.print_debug(self,
-                                           u'Successfully linked {0} stub from sub element'.format(self.replace_text))
-                    linked = True
-            else:
-                in_xref = True
+        start_text = self.run_text((start_owner, start_is_tail))
+        end_text = self.run_text((end_owner, end_is_tail))
+        index = container.index(start_owner) + 1 if start_is_tail else 0
 
-            if sub_element.tail is not None and self.replace_text in sub_element.tail:
-                new_element = self.replace_in_tail(sub_element, self.link_text)
+        xref = etree.Element('xref')
+        xref.attrib['ref-type'] = 'bibr'
+        xref.attrib['id'] = self.gv.identifiers.new_id(stub)
+        xref.attrib['rid'] = stub.link_text
 
-                self.manipulate.save_tree(self.tree)
+        if (start_owner, start_is_tail) == (end_owner, end_is_tail):
+            xref.text = start_text[opening + 1:closing]
+            xref.tail = start_text[closing:]
+        else:
+            # the elements between the brackets move into the xref
+            moved = container[index:container.index(end_owner) + 1]
 
-                self.debug.print_debug(self,
-                                       u'Successfully linked {0} stub from sub element tail'.format(self.replace_text))
-                linked = True
+            xref.text = start_text[opening + 1:]
 
-        if not linked:
-            if not in_xref:
-                # likelihood here is that we have something like this:
-                # (<italic>Text Name</italic> 354)
-                # or
-                # (text <italic>something</italic>)
-                # this requires a more complex approach: we will fallback to the less safe method of using tostring
-                # doing a regex replace and then re-encapsulating with fromstring
+            for element in moved:
+                xref.append(element)
 
-                in_string = etree.tostring(self.paragraph, encoding="unicode")
+            end_owner.tail = end_text[:closing]
+            xref.tail = end_text[closing:]
 
-                regex = u'\((?P<text>(?!.*xref).*?)\)'
+        container.insert(index, xref)
 
-                xref_before = u'<xref ref-type="bibr" ' \
-                              u'id="{0}" rid="{1}">'.format(u'ID{0}'.format(uuid.uuid4()), self.link_text)
-                xref_after = u'</xref>'
+        if start_is_tail:
+            start_owner.tail = start_text[:opening + 1]
+        else:
+            start_owner.text = start_text[:opening + 1]
 
-                new_text = re.sub(regex, u'({0}\g<text>{1})'.format(xref_before, xref_after), in_string, 1)
+        Manipulate.invalidate_text(container)
+        self.debug.print_debug(self, u'Linked {0} stub by wrapping the text in brackets'.format(stub.replace_text))
 
-                try:
-                    new_element = etree.fromstring(new_text)
+        return True
 
-                    if etree.tostring(new_element, encoding="unicode") == in_string:
-                        self.debug.print_debug(self, u'Did not link {0} stub'.format(self.replace_text))
-                    else:
-                        # a change has been made
-                        self.paragraph.addnext(new_element)
-                        self.paragraph.tag = 'REMOVE'
-                        self.debug.print_debug(self, u'Linked {0} stub using regex method'.format(self.replace_text))
+    def run(self):
+        self.read_slots()
 
-                        self.manipulate.save_tree(self.tree)
-                except:
-                    self.debug.print_debug(self, u'Did not link {0} stub as '
-                                                 u'had overlapping tags'.format(self.replace_text))
+        for stub in self.stubs:
+            if not stub.usable():
+                continue
+
+            linked = False
+
+            for slot in self.slots:
+                if slot.claim(stub):
+                    linked = True
+
+                    if not slot.leading_only:
+                        self.has_xref = True
+
+            if linked:
+                self.debug.print_debug(self, u'Successfully linked {0} stub'.format(stub.replace_text))
+            elif not self.has_xref:
+                # the stub may span tags (as in "(<italic>Text Name</italic> 354)"), so the claims so far are applied
+                # and the first bracketed run of text is wrapped instead
+                self.apply()
+                self.wrap_parenthesis(stub)
+                self.read_slots()
+
+        self.apply()
 
 
 class ReferenceLinker(Debuggable):
@@ -293,6 +452,24 @@ class ReferenceLinker(Debuggable):
         manipulate.save_tree(tree)
         self.debug.print_debug(self, u'Stripped disallowed tags from reference tree')
 
+    def link_stubs(self, stubs):
+        """
+        Wraps the text of each stub in an xref, one paragraph at a time and without saving the tree in between
+        @param stubs: a list of ReplaceStub objects
+        """
+        paragraphs = []
+        by_paragraph = {}
+
+        for stub in stubs:
+            if stub.paragraph not in by_paragraph:
+                paragraphs.append(stub.paragraph)
+                by_paragraph[stub.paragraph] = []
+
+            by_paragraph[stub.paragraph].append(stub)
+
+        for paragraph in paragraphs:
+            StubLinker(self.gv, paragraph, by_paragraph[paragraph]).run()
+
     def run(self, interactive):
         if interactive:
             self.run_prompt()
@@ -394,7 +571,7 @@ class ReferenceLinker(Debuggable):
                                         self.debug.print_debug(self, u'Parsing reference '
                                                                      u'number in range {0}'.format(str(no)))
 
-                                        to_stub.append(ReplaceStub(self.gv, p, str(no), tree, manipulate,
+                                        to_stub.append(ReplaceStub(self.gv, p, str(no),
                                                                    'TO_LINK_NUMBER', length_ignore=True))
                                 except:
                                     self.debug.print_debug(self, u'Unable to parse reference '
@@ -405,11 +582,11 @@ class ReferenceLinker(Debuggable):
                                 # just replace the components
                                 split_range = item.strip().split('-')
                                 for link in split_range:
-                                    to_stub.append(ReplaceStub(self.gv, p, link, tree, manipulate,
+                                    to_stub.append(ReplaceStub(self.gv, p, link,
                                                                'TO_LINK_NUMBER', length_ignore=True))
                         else:
                             if len(item.strip()) < 60:
-                                to_stub.append(ReplaceStub(self.gv, p, item.strip(), tree, manipulate, 'TO_LINK_NUMBER',
+                                to_stub.append(ReplaceStub(self.gv, p, item.strip(), 'TO_LINK_NUMBER',
                                                            length_ignore=True))
 
                         square_bracket_count[item.strip()] = 1
@@ -417,13 +594,9 @@ class ReferenceLinker(Debuggable):
                 for match in matches:
                     for item in match.group('text').split(u';'):
                         if len(item.strip()) < 60:
-                            to_stub.append(ReplaceStub(self.gv, p, item.strip(), tree, manipulate))
+                            to_stub.append(ReplaceStub(self.gv, p, item.strip()))
 
-        for link in to_stub:
-            link.link(to_stub)
-            #pass
-
-        etree.strip_elements(tree, 'REMOVE')
+        self.link_stubs(to_stub)
 
         use_index_method = False
 
@@ -456,60 +629,14 @@ class ReferenceLinker(Debuggable):
                                                  u'indexical method'.format(text))
                     p.attrib['rid'] = 'TO_LINK'
 
+        # the refs do not change while the author-year citations are matched, so their words are indexed once
+        ref_index = ReferenceIndex(ref_items, manipulate.texts.tokens)
+
         for p in tree.xpath('//xref[@rid="TO_LINK"]'):
             text = manipulate.get_stripped_text(p)
 
-            item = text
-
-            bare_items = item.strip().replace(u',', '').split(u' ')
-
-            for ref in ref_items:
-                found = True
-
-                bare_ref = manipulate.get_stripped_text(ref)
-
-                bare_refs = bare_ref.split(' ')
-
-                replace_chars = '[,\.\<\>\(\)\;\:\@\'\#\~\}\{\[\]\"]'
-
-                for sub_item in bare_items:
-                    found_ref = False
-                    for sub_ref in bare_refs:
-                        if re.sub(replace_chars, '', sub_item.strip()).strip() == sub_ref.strip(replace_chars):
-                            found_ref = True
-                            break
-
-                    if not found_ref:
-                        found = False
-
-                if len(bare_items) > 0 and found:
-                    to_link.append(ReplaceObject(self.gv, p, ref))
-
-                elif len(bare_items) > 0:
-                    replace_chars = '[,\.\<\>\(\)\;\:\@\'\#\~\}\{\[\]\"\d]'
-                    found = True
-
-                    for sub_item in bare_items:
-                        found_ref = False
-                        subbed_text = re.sub(replace_chars, '', sub_item.strip()).strip()
-                        for sub_ref in bare_refs:
-                            sub_ref = re.sub(replace_chars, '', sub_ref.strip()).strip()
-
-                            if subbed_text == '' and len(bare_items) > 1:
-                                found_ref = True
-                                break
-
-                            if subbed_text == sub_ref and subbed_text != '' and sub_ref != '':
-                                found_ref = True
-                                break
-
-                        if not found_ref:
-                            found = False
-
-                    # we don't allow linking to the last item here because it is almost universally wrong
-                    if len(bare_items) > 0 and found and ref_items.index(ref) != len(ref_items) - 1:
-                        to_link.append(ReplaceObject(self.gv, p, ref))
-
+            for ref in ref_index.find(text):
+                to_link.append(ReplaceObject(self.gv, p, ref))
 
         if len(to_link) == 0:
             self.debug.print_debug(self, u'Found no references to link')
@@ -717,5 +844,7 @@ def main():
     elif args['prune']:
         rl_instance.prune()
 
+    bare_gv.session.commit(rl_instance)
+
 if __name__ == '__main__':
     main()
@@ -0,0 +1,267 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that runs every Saxon transform of a meTypeset run through one long-lived Java process.
+
+1.) Compiles runtime/SaxonWorker.java against the configured saxon-libs the first time it is needed
+2.) Starts the worker once and sends it one request per transform over a pipe
+3.) The worker keeps the catalog resolver warm and holds compiled stylesheets in memory
+4.) Compiled stylesheets are keyed by a hash of the stylesheet and its xsl:include/xsl:import closure, so that an
+    edited stylesheet is recompiled even by a worker that outlives the edit
+5.) Falls back to the one-JVM-per-transform command line if the worker is disabled, cannot be built or dies, and for a
+    transform whose paths or parameters contain a tab or a line break (the request protocol is one tab-separated line)
+"""
+
+import atexit
+import hashlib
+import os
+import subprocess
+import tempfile
+from lxml import etree
+from debug import Debuggable
+
+
+class SaxonWorker(Debuggable):
+    def __init__(self, gv):
+        self.gv = gv
+        self.debug = self.gv.debug
+        self.process = None
+        self.unavailable = False
+        self.transforms = 0
+        self.keys = {}
+        Debuggable.__init__(self, 'Saxon Worker')
+
+    def attach(self, gv):
+        """
+        Hands this worker (and its running process) to the GV of another document in the same process
+        @param gv: the new document's global variables
+        """
+        self.gv = gv
+        self.debug = self.gv.debug
+        self.gv.saxon = self
+
+    def class_path(self):
+        # the GV class path is quoted for use in a shell command line
+        return self.gv.java_class_path.strip('"')
+
+    def compile_worker(self):
+        """
+        Compiles the worker into a temporary folder named after a hash of its source
+        @return: the folder containing SaxonWorker.class or None if it could not be built
+        """
+        source = os.path.join(self.gv.runtime_folder_path, 'SaxonWorker.java')
+
+        if not os.path.isfile(source):
+            return None
+
+        with open(source, 'rb') as source_file:
+            digest = hashlib.sha1(source_file.read()).hexdigest()
+
+        class_folder = os.path.join(tempfile.gettempdir(), 'metypeset-saxon-worker-{0}'.format(digest[:12]))
+
+        if os.path.isfile(os.path.join(class_folder, 'SaxonWorker.class')):
+            return class_folder
+
+        self.debug.print_debug(self, u'Compiling the Saxon worker into {0}'.format(class_folder))
+
+        try:
+            if not os.path.isdir(class_folder):
+                os.makedirs(class_folder)
+
+            with self.gv.profiler.subprocess('javac'):
+                if subprocess.call(['javac', '-classpath', self.class_path(), '-d', class_folder, source]) != 0:
+                    return None
+        except OSError:
+            return None
+
+        return class_folder
+
+    def start(self):
+        if self.process is not None and self.process.poll() is None:
+            return True
+
+        if self.unavailable:
+            return False
+
+        class_folder = None
+
+        if self.gv.settings.get_boolean('saxon-worker', self):
+            class_folder = self.compile_worker()
+
+        if class_folder is None:
+            self.debug.print_debug(self, u'Saxon worker unavailable: running one JVM per transform')
+            self.unavailable = True
+            return False
+
+        try:
+            self.process = subprocess.Popen(['java', '-classpath', class_folder + os.pathsep + self.class_path(),
+                                             '-Dxml.catalog.files=' + self.gv.runtime_catalog_path,
+                                             'SaxonWorker'],
+                                            stdin=subprocess.PIPE, stdout=subprocess.PIPE, universal_newlines=True)
+        except OSError:
+            self.debug.print_debug(self, u'Unable to start the Saxon worker: running one JVM per transform')
+            self.unavailable = True
+            return False
+
+        atexit.register(self.stop)
+        self.debug.print_debug(self, u'Started Saxon worker (pid {0})'.format(self.process.pid))
+
+        return True
+
+    def stop(self):
+        if self.process is None:
+            return
+
+        try:
+            self.process.stdin.close()
+            self.process.wait()
+        except (IOError, OSError):
+            pass
+
+        self.debug.print_debug(self, u'Stopped Saxon worker after {0} transform(s)'.format(self.transforms))
+        self.process = None
+
+    @staticmethod
+    def include_closure(stylesheet):
+        """
+        Finds every local file that a stylesheet includes or imports, recursively
+        @param stylesheet: the path to the stylesheet
+        @return: a list of absolute paths, starting with the stylesheet itself
+        """
+        closure = []
+        pending = [os.path.abspath(stylesheet)]
+
+        while len(pending) > 0:
+            path = pending.pop(0)
+
+            if path in closure or not os.path.isfile(path):
+                continue
+
+            closure.append(path)
+
+            try:
+                tree = etree.parse(path)
+            except etree.XMLSyntaxError:
+                continue
+
+            for href in tree.xpath('//xsl:include/@href | //xsl:import/@href',
+                                   namespaces={'xsl': 'http://www.w3.org/1999/XSL/Transform'}):
+                pending.append(os.path.normpath(os.path.join(os.path.dirname(path), href)))
+
+        return closure
+
+    @staticmethod
+    def signature(closure):
+        signature = []
+
+        for path in closure:
+            try:
+                stat = os.stat(path)
+                signature.append((path, stat.st_mtime, stat.st_size))
+            except OSError:
+                signature.append((path, None, None))
+
+        return signature
+
+    def stylesheet_key(self, stylesheet):
+        """
+        Returns the key under which the worker caches a compiled stylesheet. This is a hash of the paths and contents of
+        the stylesheet and its include closure; the paths are part of the key because a compiled stylesheet resolves
+        document() calls against its own location. The hash is only recomputed when one of the files changes on disk.
+        @param stylesheet: the path to the stylesheet
+        @return: a hex digest
+        """
+        if stylesheet in self.keys:
+            closure, signature, key = self.keys[stylesheet]
+
+            if self.signature(closure) == signature:
+                return key
+
+        closure = self.include_closure(stylesheet)
+        digest = hashlib.sha1()
+
+        for path in closure:
+            digest.update(path.encode('utf-8'))
+
+            with open(path, 'rb') as stylesheet_file:
+                digest.update(stylesheet_file.read())
+
+        key = digest.hexdigest()
+        self.keys[stylesheet] = (closure, self.signature(closure), key)
+
+        self.debug.print_debug(self, u'Stylesheet {0} and {1} included file(s) hash to {2}'.format(stylesheet,
+                                                                                                  len(closure) - 1,
+                                                                                                  key))
+
+        return key
+
+    @staticmethod
+    def request_fields(key, stylesheet, source, output, parameters):
+        """
+        Builds the fields of a worker request, which are sent tab-separated on one line
+        @return: a list of fields, or None if a field contains a tab or a line break and so cannot be sent
+        """
+        fields = [key, stylesheet, source, output]
+
+        for name, value in parameters.items():
+            fields.append(u'{0}={1}'.format(name, value))
+
+        for field in fields:
+            if '\t' in field or '\n' in field or '\r' in field:
+                return None
+
+        return fields
+
+    def request(self, fields):
+        try:
+            self.process.stdin.write(u'\t'.join(fields) + u'\n')
+            self.process.stdin.flush()
+
+            return self.process.stdout.readline().strip()
+        except (IOError, OSError):
+            return ''
+
+    def transform(self, stylesheet, source, output, parameters=None, command=None):
+        """
+        Runs a stylesheet over a source document
+        @param stylesheet: the path to the XSLT stylesheet
+        @param source: the path to the source document
+        @param output: the path to write the result to
+        @param parameters: a dictionary of stylesheet parameters
+        @param command: the equivalent net.sf.saxon.Transform command line, used when the worker is unavailable
+        """
+        if parameters is None:
+            parameters = {}
+
+        fields = None
+
+        if self.start():
+            fields = self.request_fields(self.stylesheet_key(stylesheet), stylesheet, source, output, parameters)
+
+            if fields is None:
+                # a tab or line break would put the worker's line protocol out of step
+                self.debug.print_debug(self, u'A path or parameter of this transform contains a tab or a line break: '
+                                             u'running it on the command line')
+
+        if fields is not None:
+            with self.gv.profiler.subprocess('saxon'):
+                reply = self.request(fields)
+
+            if reply == 'OK':
+                self.transforms += 1
+                return
+
+            if reply.startswith('ERROR'):
+                # the worker has already printed the Saxon error; the pipeline carries on as it does for the
+                # command line
+                self.debug.print_debug(self, u'Saxon reported an error: {0}'.format(reply[6:]))
+                return
+
+            self.debug.print_debug(self, u'Saxon worker exited: running one JVM per transform')
+            self.process = None
+            self.unavailable = True
+
+        if command is not None:
+            with self.gv.profiler.subprocess('saxon'):
+                subprocess.call(command, stdin=None, shell=True)
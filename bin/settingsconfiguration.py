@@ -6,13 +6,44 @@ import os
 import docxtotei
 
 class Settings:
+    # the parsed registry of each settings file, keyed by its path; an edited file is not re-read by this process
+    registries = {}
+
     def __init__(self, set_file, args):
-        tree = etree.parse(set_file)
-        self.tree = tree
+        self.registry = Settings.load_registry(set_file)
         self.script_dir = os.environ['METYPESET']
         self.args = args
         self.settings_file = set_file
 
+    @staticmethod
+    def load_registry(set_file):
+        """
+        Parses a settings file once into a registry of cleaned values. The registry is a plain dictionary (and so can be
+        pickled and handed to batch workers) keyed by (None, name) for the first setting of that name in the file and
+        by (domain, name) for a setting inside a domain element such as mt:aggression.
+        @param set_file: the path to the settings file
+        @return: the registry
+        """
+        if set_file in Settings.registries:
+            return Settings.registries[set_file]
+
+        registry = {}
+
+        for element in etree.parse(set_file).iter(etree.Element):
+            name = etree.QName(element).localname
+            value = Settings.clean_path(element.text) if element.text is not None else None
+
+            registry.setdefault((None, name), value)
+
+            parent = element.getparent()
+
+            if parent is not None:
+                registry.setdefault((etree.QName(parent).localname, name), value)
+
+        Settings.registries[set_file] = registry
+
+        return registry
+
     @staticmethod
     def setup_settings_file(args):
         if '--settings' in args:
@@ -30,18 +61,36 @@ class Settings:
     def concat_path(parent, child):
         return os.path.join(parent, child)
 
-    def get_setting(self, tag_name, caller, domain=None):
-        settings = self
+    def get_setting(self, tag_name, caller, domain=None, default=None):
+        if (domain, tag_name) in self.registry:
+            return self.registry[(domain, tag_name)]
 
-        if domain is None:
-            expr = "//*[local-name() = $name]"
-        else:
-            expr = "//mt:{0}/*[local-name() = $name]".format(domain, tag_name)
+        if default is not None:
+            return default
+
+        return caller.debug.fatal_error(caller, '{0} is not defined in settings.xml'.format(tag_name))
 
-        tag = settings.tree.xpath(expr, name=tag_name, namespaces={'mt': 'https://github.com/MartinPaulEve/meTypeset'})
+    def get_integer(self, tag_name, caller, domain=None, default=None):
+        value = self.get_setting(tag_name, caller, domain, default)
 
-        return settings.clean_path(tag[0].text) if tag \
-            else caller.debug.fatal_error(caller, '{0} is not defined in settings.xml'.format(tag_name))
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return caller.debug.fatal_error(caller, '{0} in settings.xml must be an integer'.format(tag_name))
+
+    def get_boolean(self, tag_name, caller, domain=None, default=None):
+        value = self.get_setting(tag_name, caller, domain, default)
+
+        return value if isinstance(value, bool) else value == 'True'
+
+    def get_aggression(self, module_name, caller):
+        """
+        Returns the aggression threshold of a module
+        @param module_name: the name of the module in the aggression domain of the settings file
+        @param caller: the calling object
+        @return: the threshold as an integer
+        """
+        return self.get_integer(module_name, caller, domain='aggression')
 
     @staticmethod
     def check_settings_file_exists(caller, set_file):
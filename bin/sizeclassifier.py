@@ -13,30 +13,23 @@ A class that scans for meTypeset size fields in a TEI file.
 """
 
 from debug import Debuggable
+from headingengine import HeadingEngine
 
 
 class SizeClassifier(Debuggable):
     def __init__(self, global_variables):
         self.gv = global_variables
         self.debug = self.gv.debug
-        self.size_cutoff = int(self.gv.settings.get_setting('minimum-heading-size', self))
-        self.max_headings = int(self.gv.settings.get_setting('maximum-headings', self))
+        self.size_cutoff = self.gv.settings.get_integer('minimum-heading-size', self)
+        self.max_headings = self.gv.settings.get_integer('maximum-headings', self)
         self.root = 0
         self.tree = None
         Debuggable.__init__(self, 'Size Classifier')
 
     @staticmethod
     def get_values(tree, search_attribute):
-        # this function searches the DOM tree for TEI "hi" elements with the specified search_attribute
-        sizes = {}
-        for child in tree.xpath('//tei:hi[@' + search_attribute + '=not("")]',
-                                namespaces={'tei': 'http://www.tei-c.org/ns/1.0'}):
-            if child.get(search_attribute) in sizes:
-                sizes[child.get(search_attribute)] += 1
-            else:
-                sizes[child.get(search_attribute)] = 1
-
-        return sizes
+        # this function counts the values of the specified search_attribute on TEI "hi" elements
+        return Manipulate.style_index(tree).count(search_attribute, '{http://www.tei-c.org/ns/1.0}hi')
 
     @staticmethod
     def get_sizes_ordered(tree):
@@ -49,131 +42,6 @@ class SizeClassifier(Debuggable):
 
         return sizes_ordered
 
-    def set_dom_tree(self, filename):
-        p = etree.XMLParser(remove_blank_text=True, resolve_entities=False)
-        self.tree = etree.parse(filename, p)
-
-        return self.tree
-
-    @staticmethod
-    def handle_bold_only_paragraph(manipulate, root_size):
-        """
-        This method looks for paragraphs that contain only bold text. It then transforms them to titles.
-        @param manipulate: a TeiManipulator object
-        @param root_size: the size styling to apply to these elements
-        """
-        expression = u'//tei:p[(contains(@rend, "bold") or count(tei:hi) = count(tei:hi[contains(@rend, "bold")])) ' \
-                     u'and not(text()[normalize-space()!=""])]/tei:hi'
-
-        manipulate.change_self_size(expression, str(root_size))
-
-    @staticmethod
-    def handle_heading(manipulate, attribute, root_size):
-        """
-        This method looks for paragraphs that contain the specified attribute in their rend tag.
-        It then transforms them to titles.
-        @param manipulate: a TeiManipulator object
-        @param attribute: a string to search for in the rend attribute
-        @param root_size: the size styling to apply to these elements
-        """
-        expression = u'//tei:p[contains(@rend, "{0}")]'.format(attribute)
-
-        manipulate.enclose_and_change_self_size(expression, str(root_size), 'p', 'hi')
-
-    def get_sizes(self, tree):
-        sizes = self.get_values(tree, "meTypesetSize")
-
-        if len(sizes) > 0:
-            self.debug.print_debug(self,
-                                   u'Explicitly specified size variations and their frequency of '
-                                   u'occurrence: {0}'.format(str(sizes)))
-        new_sizes = {}
-        for size, frequency in sizes.items():
-            if float(frequency) < float(self.max_headings):
-                new_sizes[size] = frequency
-        sizes = new_sizes
-        return sizes
-
-    def correlate_styled_headings(self, manipulate):
-        # reload the DOM
-        tree = self.set_dom_tree(self.gv.tei_file_path)
-        # get a numerical list of explicit size values inside meTypesetSize attributes
-        sizes = self.get_sizes(tree)
-        sorted_list = []
-        headings = {}
-
-        # correlate tag sizes specified by true word headings ("heading 1", "heading 2" etc.) to our index
-        for size, frequency in sizes.items():
-            if float(frequency) < float(self.max_headings) and float(size) > float(self.size_cutoff):
-                sorted_list.append(size)
-
-        sorted_list = sorted(sorted_list)
-
-        if len(sorted_list) > 0:
-            for count in range(0, len(sorted_list) - 1):
-                key = u'heading {0}'.format(count + 1)
-                headings[key] = sorted_list[count]
-
-                key = u'Heading {0}'.format(count + 1)
-                headings[key] = sorted_list[count]
-
-            for count in range(len(sorted_list) - 1, 8):
-                key = u'heading {0}'.format(count + 1)
-                headings[key] = 100 - 10 * count
-
-                key = u'Heading {0}'.format(count + 1)
-                headings[key] = 100 - 10 * count
-        else:
-            headings = {'title': 100, 'heading 1': 100, 'heading 2': 90, 'heading 3': 80, 'heading 4': 70,
-                        'heading 5': 60, 'heading 6': 50, 'heading 7': 40, 'heading 8': 30, 'heading 9': 20}
-
-            headings.update({'Title': 100, 'Heading 1': 100, 'Heading 2': 90, 'Heading 3': 80,
-                                                'Heading 4': 70, 'Heading 5': 60, 'Heading 6': 50, 'Heading 7': 40,
-                                                'Heading 8': 30, 'Heading 9': 20})
-
-            headings.update({'H1': 100, 'H2': 90, 'H3': 80, 'H4': 70, 'H5': 60, 'H6': 50, 'H7': 40,
-                                                'H8': 30, 'H9': 20})
-
-        for key, value in headings.items():
-            self.debug.print_debug(self, u'Changing {0} to size {1}'.format(key, value))
-            self.handle_heading(manipulate, key, float(value))
-
-        # reload the DOM
-        tree = self.set_dom_tree(self.gv.tei_file_path)
-        return tree
-
-
-    def convert_to_headings(self, manipulate, sizes, tree):
-        for size in sizes:
-
-            if float(size) >= float(self.size_cutoff):
-                # if the size is greater than or equal to 16, treat it as a heading
-                self.debug.print_debug(self,
-                                       u'Size ({0}) greater '
-                                       u'than or equal to {1}. '
-                                       u'Treating as a heading.'.format(str(size),
-                                                                        str(self.size_cutoff)))
-
-                # instruct the manipulator to change the parent tag of every tag it finds containing
-                # a "hi" tag with meTypesetSize set to the value found to "title"
-                # so, for example <p><hi meTypesetSize="18">some text</hi></p>
-                # will be transformed to
-                # <title><hi meTypesetSize="18">some text</hi></title>
-                manipulate.change_outer('//tei:hi[@meTypesetSize=\'{0}\']'.format(size), 'head', size)
-
-                tree = self.set_dom_tree(self.gv.tei_file_path)
-
-                for normalize in tree.xpath('//tei:cit/tei:quote/tei:head',
-                                            namespaces={'tei': 'http://www.tei-c.org/ns/1.0'}):
-                    normalize.getparent().tag = 'REMOVE'
-                    normalize.getparent().getparent().tag = 'REMOVE'
-
-                etree.strip_tags(tree, 'REMOVE')
-                manipulate.save_tree(tree)
-                self.debug.print_debug(self, u'Normalizing nested headings inside cit/quote blocks')
-
-        return tree
-
     def encapsulate_headings(self, manipulate, tree):
         titles = tree.xpath('//tei:head[preceding-sibling::node()]', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
         for title in titles:
@@ -192,13 +60,67 @@ class SizeClassifier(Debuggable):
                 new_section.append(sibling)
 
             existing_section.addnext(new_section)
+            Manipulate.restyle(new_section)
             manipulate.save_tree(tree)
 
             self.debug.print_debug(self, u'Handling unnested title: '
                                          u'{0}'.format(manipulate.get_stripped_text(title).strip()))
         manipulate.save_tree(tree)
 
+    @staticmethod
+    def last_section(element, placed):
+        """
+        @param element: an element
+        @param placed: the sections that have been placed so far
+        @return: the last placed section in document order within the element (or the element itself), or None
+        """
+        for child in reversed(element):
+            section = SizeClassifier.last_section(child, placed)
+
+            if section is not None:
+                return section
+
+        return element if element in placed else None
+
+    @staticmethod
+    def preceding_section(div, placed):
+        """
+        @param div: a section
+        @param placed: the sections that have been placed so far
+        @return: the placed section that comes before it in document order, or None
+        """
+        element = div
+
+        while element.getparent() is not None:
+            sibling = element.getprevious()
+
+            if sibling is None:
+                element = element.getparent()
+
+                if element in placed:
+                    return element
+            else:
+                section = SizeClassifier.last_section(sibling, placed)
+
+                if section is not None:
+                    return section
+
+                element = sibling
+
+        return None
+
     def nest_headings(self, manipulate, tree):
+        """
+        Nests each section inside the nearest preceding section with a bigger heading, in one pass over the sections.
+        The sections that are still open are held on a stack of strictly decreasing heading sizes: a section closes
+        every open section with a smaller heading, then follows an open section of the same size or goes inside the
+        nearest bigger one. A section whose heading is the size of the first (root) heading, or bigger, starts again
+        from the root.
+        @param manipulate: a TEI manipulator
+        @param tree: the TEI tree
+        @return: the list of (size, section) tuples in document order, the tree and True if the sections are still in
+        document order once nested
+        """
         tree = manipulate.load_dom_tree()
         stack = []
         message = {}
@@ -214,108 +136,72 @@ class SizeClassifier(Debuggable):
                 message[div] = manipulate.get_stripped_text(title[0]).strip()
 
             stack.append((size, div))
-        first = True
-        position = 0
-        root_size = None
-        root_div = None
-        dict_thresholds = {}
-        for element in stack:
-            if first:
-                first = False
-                root_size, root_div = element
-                self.debug.print_debug(self, u'Set root size as {0}'.format(root_size))
-            else:
-                size, div = element
 
-                previous, previous_div = stack[position - 1]
+        if len(stack) == 0:
+            return stack, tree, True
 
-                if float(size) > float(root_size):
-                    size = float(root_size)
+        root_size = float(stack[0][0])
+        open_sections = [(root_size, stack[0][1])]
+        placed = {stack[0][1]}
+        moved = False
 
-                # handle an element that is the root size
-                if float(size) == float(root_size):
-                    root_div = div
-                    dict_thresholds[float(root_size)] = position
+        self.debug.print_debug(self, u'Set root size as {0}'.format(stack[0][0]))
 
-                    for item in dict_thresholds.keys():
-                        dict_thresholds[item] = position
+        for position in range(1, len(stack)):
+            size, div = stack[position]
+            size = min(float(size), root_size)
+            previous_div = stack[position - 1][1]
 
-                    self.debug.print_debug(self, u'Heading {0} ("{1}") was same size as root. '
-                                                 u'Resetting stack.'.format(position + 1,
-                                                                            message[div]))
+            if size == root_size:
+                # a heading the size of the root starts again from the root
+                open_sections = [(size, div)]
 
-                # handle an element that is smaller than its predecessor
-                elif float(size) < float(previous):
-                    addnext = False
-                    # traverse up the tree to see if there is an equal size element
-                    iteration = position - 1
+                self.debug.print_debug(self, u'Heading {0} ("{1}") was same size as root. '
+                                             u'Resetting stack.'.format(position + 1, message[div]))
+            else:
+                # close every open section with a smaller heading
+                closed_div = None
 
-                    if not float(size) in dict_thresholds.keys():
-                        dict_thresholds[float(size)] = position
+                while open_sections[-1][0] < size:
+                    closed_size, closed_div = open_sections.pop()
 
-                    while iteration >= dict_thresholds[float(size)]:
-                        iterpos, iterdiv = stack[iteration]
+                open_size, open_div = open_sections[-1]
 
-                        if float(iterpos) == float(size):
-                            previous_div = iterdiv
-                            addnext = True
-                            break
-                        else:
-                            iteration -= 1
+                if open_size == size:
+                    open_div.addnext(div)
+                    open_sections[-1] = (size, div)
 
-                    if addnext:
-                        previous_div.addnext(div)
-                    else:
-                        previous_div.append(div)
+                    self.debug.print_debug(self, u'Added heading {0} ("{1}") adjacent to previous because '
+                                                 u'it is the same size'.format(position + 1, message[div]))
+                elif closed_div is not None:
+                    # each open section is a child of the one below it on the stack, so this is inside open_div
+                    closed_div.addnext(div)
+                    open_sections.append((size, div))
 
-                    dict_thresholds[float(size)] = position
+                    self.debug.print_debug(self, u'Moved heading {0} ("{1}") into previous '
+                                                 u'because it is bigger'.format(position + 1, message[div]))
+                else:
+                    open_div.append(div)
+                    open_sections.append((size, div))
 
-                    manipulate.save_tree(tree)
                     self.debug.print_debug(self, u'Moved heading {0} ("{1}") into previous because '
-                                                 u'it is smaller'.format(position + 1,
-                                                                         message[div]))
-
-                # handle an element that is bigger than its predecessor
-                elif float(size) > float(previous):
-                    # traverse up the tree to see if there is an equal size element
-                    iteration = position - 1
-
-                    found = False
-
-                    if not float(size) in dict_thresholds.keys():
-                        dict_thresholds[float(size)] = position
-
-                    while iteration >= dict_thresholds[float(size)]:
-                        iterpos, iterdiv = stack[iteration]
-
-                        if float(iterpos) == float(size):
-                            previous_div = iterdiv
-                            break
-                        else:
-                            iteration -= 1
+                                                 u'it is smaller'.format(position + 1, message[div]))
 
-                    previous_div.addnext(div)
+                moved = True
 
-                    dict_thresholds[float(size)] = position
-                    for item in dict_thresholds.keys():
-                        if float(dict_thresholds[item]) < float(size):
-                            dict_thresholds[item] = position
+            # check that the placed sections are still in document order (sections that have yet to be placed may still
+            # be inside those that have been moved)
+            placed.add(div)
 
-                    manipulate.save_tree(tree)
-                    self.debug.print_debug(self, u'Moved heading {0} ("{1}") into previous '
-                                                 u'because it is bigger'.format(position + 1,
-                                                                                message[div]))
-
-                # handle an element that is the same size as its predecessor
-                elif float(size) == float(previous):
-                    previous_div.addnext(div)
-                    self.debug.print_debug(self, u'Added heading {0} ("{1}") adjacent to previous because '
-                                                 u'it is the same size'.format(position + 1,
-                                                                               message[div]))
+            if self.preceding_section(div, placed) is not previous_div:
+                self.debug.write_error(self, u'Size elements were disordered', '002')
+                self.debug.print_debug(self, u'WARNING: size elements were disordered')
+                return stack, tree, False
 
-            position += 1
+        if moved:
+            manipulate.save_tree(tree)
 
-        return stack, tree
+        return stack, tree, True
 
     def verify_headings(self, stack, tree):
         # verify that the stack has not been disordered
@@ -356,94 +242,10 @@ class SizeClassifier(Debuggable):
 
             if len(text) > 200:
                 title.tag = 'p'
+                Manipulate.restyle(title)
                 manipulate.save_tree(tree)
                 self.debug.print_debug(self, u'Over-length heading downgraded')
 
-    def handle_capital_only_paragraph(self, manipulate, new_size):
-        tree = manipulate.load_dom_tree()
-
-        for child in tree.xpath('//tei:p', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'}):
-            text = manipulate.get_stripped_text(child).strip()
-
-            regex = re.compile('^[A-Z]+\:$')
-
-            if regex.match(text) or ('rend' in child.attrib and 'capsall' in child.attrib['rend']):
-                child.attrib['meTypesetSize'] = str(new_size)
-                child.tag = 'head'
-                manipulate.save_tree(tree)
-                self.debug.print_debug(self, u'Changed item {0} to a heading size {1}'.format(text, new_size))
-
-    def handle_single_item_list(self, manipulate, new_size):
-        tree = manipulate.load_dom_tree()
-
-        for child in tree.xpath('//tei:list[count(tei:item)=1]', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'}):
-            child.tag = 'REMOVE'
-
-            for item in child:
-                text = manipulate.get_stripped_text(item)
-                item.attrib['meTypesetSize'] = str(new_size)
-                item.tag = 'head'
-                etree.strip_tags(tree, 'REMOVE')
-                manipulate.save_tree(tree)
-                self.debug.print_debug(self, u'Changed item {0} to a heading size {1}'.format(text, new_size))
-
-    def clean_introduction_headings(self, manipulate):
-        tree = manipulate.load_dom_tree()
-
-        titles = tree.xpath('//tei:p[following-sibling::*[1][self::tei:cit]]/tei:hi[@meTypesetSize]',
-                            namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
-
-        for element in titles:
-            text = manipulate.get_stripped_text(element.getparent()).strip()
-            if text.endswith(':'):
-                del element.attrib['meTypesetSize']
-
-                manipulate.save_tree(tree)
-
-                self.debug.print_debug(self, u'Removed heading attribute from {0} as it looks '
-                                             u'like a quote introduction'.format(text))
-
-        return tree
-
-    def clean_line_breaks(self, manipulate):
-        tree = manipulate.load_dom_tree()
-
-        titles = tree.xpath('//tei:head/tei:hi[@meTypesetSize][tei:lb] | //tei:head[tei:lb]',
-                            namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
-
-        for element in titles:
-            total_text = manipulate.get_stripped_text(element)
-            text = element.text
-
-            if text is None:
-                text = ''
-
-            last_element = None
-
-            for item in element:
-                if item.tag.endswith('lb') and text.strip() == '':
-                    prev = item.getprevious()
-
-                    if prev is not None:
-                        prev.text = item.tail
-                    else:
-                        element.text = item.tail
-
-                    item.getparent().remove(item)
-                    manipulate.save_tree(tree)
-
-                    self.debug.print_debug(self, u'Removed unneeded lb from {0}'.format(total_text))
-
-                if item.text is not None:
-                    text += item.text
-
-                if last_element is not None and last_element.tail is not None:
-                    text = text + last_element.tail
-
-                last_element = item
-
-        return tree
-
     def renest_headings(self, manipulate, tree):
         titles = tree.xpath('//tei:div[count(*) = 1][tei:head]', namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
 
@@ -495,44 +297,21 @@ class SizeClassifier(Debuggable):
 
                         if bolded:
                             next_element.tag = 'head'
+                            Manipulate.restyle(next_element)
                             self.debug.print_debug(self, u'Replaced empty title with bolded sibling')
 
         manipulate.save_tree(tree)
 
     def run(self):
-        if int(self.gv.settings.args['--aggression']) < int(self.gv.settings.get_setting('sizeclassifier', self,
-                                                                                         domain='aggression')):
+        if int(self.gv.settings.args['--aggression']) < self.gv.settings.get_aggression('sizeclassifier', self):
             self.debug.print_debug(self, u'Aggression level too low: exiting module.')
             return
 
         manipulate = TeiManipulate(self.gv)
 
-        # transform bolded paragraphs into size-attributes with an extremely high threshold (so will be thought of as
-        # root nodes)
-        self.handle_bold_only_paragraph(manipulate, 100)
-
-        # if a paragraph only contains capitals followed by a colon, make it a heading (root node size)
-        self.handle_capital_only_paragraph(manipulate, 100)
-
-        # if a list contains only a single item, make it a heading (root node size)
-        self.handle_single_item_list(manipulate, 100)
-
-        tree = self.correlate_styled_headings(manipulate)
-
-        # this deals with cases where the user has given a styled heading ending with a colon
-        # immediately before a disp-quote
-        tree = self.clean_introduction_headings(manipulate)
-
-        # refresh the size list
-        sizes = self.get_sizes(tree)
-
-        tree = self.convert_to_headings(manipulate, sizes, tree)
-
-        # assign IDs to every single heading tag for easy manipulation
-        heading_count = manipulate.tag_headings()
-
-        # this deals with cases where line breaks exist within <head> tags but there is no text before; we remove them
-        tree = self.clean_line_breaks(manipulate)
+        # classify bold-only and capital-only paragraphs, single-item lists, styled headings and sized text as
+        # headings, assign them IDs and clean their line breaks in one walk of the tree
+        HeadingEngine(self.gv, self.size_cutoff, self.max_headings).run(manipulate)
 
         tree = manipulate.load_dom_tree()
 
@@ -545,9 +324,9 @@ class SizeClassifier(Debuggable):
 
         backup_tree = etree.tostring(tree, encoding="unicode")
 
-        stack, tree = self.nest_headings(manipulate, tree)
+        stack, tree, ordered = self.nest_headings(manipulate, tree)
 
-        if not self.verify_headings(stack, tree):
+        if not ordered:
             # something went very wrong in the stacking of elements
             # revert to the backup tree
             self.debug.print_debug(self, u'Reverting to backup tree as size classification failed')
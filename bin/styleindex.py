@@ -0,0 +1,154 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that indexes the elements of a tree by their rend and meTypesetSize attributes, so that the classifiers can
+find every element with a given style without running an XPath over the whole document each time.
+
+1.) One walk of the tree files every element under its local tag name and its current rend and meTypesetSize values
+    (elements without the attribute are filed under None)
+2.) Lookups re-read the tag and attribute of each candidate and return the matches that are still in the tree, in
+    document order, so elements that have since been retagged, restyled or removed are answered correctly
+3.) Elements that are created, retagged or restyled are filed again with add (or add_subtree), which manipulators do
+    through Manipulate.restyle
+"""
+
+indexed_attributes = ['rend', 'meTypesetSize']
+
+
+def local_name(tag):
+    return tag[tag.find('}') + 1:]
+
+
+class StyleIndex(object):
+    def __init__(self, tree):
+        self.root = tree.getroot() if hasattr(tree, 'getroot') else tree
+        self.elements = {}
+
+        for attribute in indexed_attributes:
+            self.elements[attribute] = {}
+
+        self.add_subtree(self.root)
+
+    def add(self, element):
+        """
+        Files an element under its current tag and attribute values
+        @param element: the element that was created, retagged or restyled
+        """
+        if not isinstance(element.tag, str):
+            return
+
+        name = local_name(element.tag)
+
+        for attribute in indexed_attributes:
+            self.elements[attribute].setdefault(element.get(attribute), {}).setdefault(name, set()).add(element)
+
+    def add_subtree(self, element):
+        for descendant in element.iter():
+            self.add(descendant)
+
+    def values(self, attribute):
+        """
+        @param attribute: rend or meTypesetSize
+        @return: every value under which an element has been filed (not all of them may still be in use)
+        """
+        return [value for value in self.elements[attribute] if value is not None]
+
+    def in_tree(self, element, positions):
+        """
+        @param element: an element
+        @param positions: a dictionary that caches the position of each element among its siblings
+        @return: a key that sorts elements into document order, or None if the element has left the tree
+        """
+        path = []
+        parent = element.getparent()
+
+        while parent is not None:
+            if element not in positions:
+                for position, sibling in enumerate(parent):
+                    positions[sibling] = position
+
+            path.append(positions[element])
+            element = parent
+            parent = element.getparent()
+
+        if element is not self.root:
+            return None
+
+        path.reverse()
+
+        return path
+
+    def find(self, attribute, values, tag=None):
+        """
+        Stands in for //tag[@attribute=value or ...] (with None standing for not(@attribute))
+        @param attribute: rend or meTypesetSize
+        @param values: a value or a list of values
+        @param tag: the full tag that the elements must have, or None for any element
+        @return: a list of elements in document order
+        """
+        if not isinstance(values, list):
+            values = [values]
+
+        candidates = set()
+
+        for value in values:
+            by_name = self.elements[attribute].get(value, {})
+
+            if tag is None:
+                for elements in by_name.values():
+                    candidates.update(elements)
+            else:
+                candidates.update(by_name.get(local_name(tag), ()))
+
+        return self.in_order([element for element in candidates
+                              if (tag is None or element.tag == tag) and element.get(attribute) in values])
+
+    def in_order(self, elements):
+        """
+        @param elements: a collection of elements
+        @return: the elements that are still in the tree, once each and in document order
+        """
+        found = []
+        positions = {}
+
+        for element in set(elements):
+            key = self.in_tree(element, positions)
+
+            if key is not None:
+                found.append((key, element))
+
+        found.sort(key=lambda match: match[0])
+
+        return [element for key, element in found]
+
+    def find_containing(self, attribute, fragments, tag=None):
+        """
+        Stands in for //tag[contains(@attribute, fragment) or ...]
+        @param attribute: rend or meTypesetSize
+        @param fragments: a list of strings, any of which the value must contain
+        @param tag: the full tag that the elements must have, or None for any element
+        @return: a list of elements in document order
+        """
+        values = [value for value in self.values(attribute)
+                  if len([fragment for fragment in fragments if fragment in value]) > 0]
+
+        if len(values) == 0:
+            return []
+
+        return self.find(attribute, values, tag)
+
+    def count(self, attribute, tag=None):
+        """
+        Stands in for counting the values of //tag[@attribute]
+        @param attribute: rend or meTypesetSize
+        @param tag: the full tag that the elements must have, or None for any element
+        @return: a dictionary of each value and the number of elements that have it
+        """
+        counts = {}
+
+        for element in self.find(attribute, self.values(attribute), tag):
+            value = element.get(attribute)
+            counts[value] = counts.get(value, 0) + 1
+
+        return counts
@@ -18,7 +18,7 @@ class TeiManipulate(Manipulate):
         self.mod_name = 'TEI'
         Manipulate.__init__(self, gv)
 
-    def save_tree(self, tree):
+    def write_tree(self, tree):
         tree.write(self.dom_temp_file, pretty_print=self.gv.settings.args['--prettytei'])
         tree.write(self.dom_to_load, pretty_print=self.gv.settings.args['--prettytei'])
 
@@ -53,6 +53,7 @@ class TeiManipulate(Manipulate):
                     new_element.text = tag_to_parse
 
                     child.addnext(new_element)
+                    Manipulate.restyle(new_element)
 
                     for subchild in child:
                         if type(subchild) is etree._Element:
@@ -80,6 +81,7 @@ class TeiManipulate(Manipulate):
                         found = True
                         last_list.tag = '{http://www.tei-c.org/ns/1.0}div'
                         last_list.attrib['rend'] = u'Bibliography'
+                        Manipulate.restyle(last_list)
 
                         parent_element = None
 
@@ -92,6 +94,8 @@ class TeiManipulate(Manipulate):
                             Manipulate.append_safe(new_element, list_item, self)
                             list_item.tag = '{http://www.tei-c.org/ns/1.0}ref'
                             list_item.attrib['target'] = 'None'
+                            Manipulate.restyle(new_element)
+                            Manipulate.restyle(list_item)
             elif last_list.tag.endswith('item'):
 
                 text = self.get_stripped_text(last_list)
@@ -105,6 +109,7 @@ class TeiManipulate(Manipulate):
                     found = True
                     last_list.tag = '{http://www.tei-c.org/ns/1.0}div'
                     last_list.attrib['rend'] = u'Bibliography'
+                    Manipulate.restyle(last_list)
 
                     parent_element = None
 
@@ -117,6 +122,8 @@ class TeiManipulate(Manipulate):
                         Manipulate.append_safe(new_element, list_item, self)
                         list_item.tag = '{http://www.tei-c.org/ns/1.0}ref'
                         list_item.attrib['target'] = 'None'
+                        Manipulate.restyle(new_element)
+                        Manipulate.restyle(list_item)
             else:
                 self.debug.print_debug(self, u'Last element in document was {0}. Not treating as '
                                              u'bibliography.'.format(xpath[0].tag))
@@ -146,6 +153,8 @@ class TeiManipulate(Manipulate):
                     Manipulate.append_safe(new_element, sibling, self)
                     sibling.tag = '{http://www.tei-c.org/ns/1.0}ref'
                     sibling.attrib['target'] = 'None'
+                    Manipulate.restyle(new_element)
+                    Manipulate.restyle(sibling)
 
                     sibling = next_sibling
 
@@ -157,6 +166,8 @@ class TeiManipulate(Manipulate):
                 Manipulate.append_safe(new_element, last_list, self)
                 last_list.tag = '{http://www.tei-c.org/ns/1.0}ref'
                 last_list.attrib['target'] = 'None'
+                Manipulate.restyle(new_element)
+                Manipulate.restyle(last_list)
 
 
             else:
@@ -220,6 +231,7 @@ class TeiManipulate(Manipulate):
 
             if is_sibling:
                 ret.addnext(new_element)
+                Manipulate.restyle(new_element)
             else:
                 Manipulate.append_safe(ret, new_element, self)
 
@@ -260,6 +272,8 @@ class TeiManipulate(Manipulate):
         if not parent.tag == top_tag and not parent.tag == '{http://www.tei-c.org/ns/1.0}' + top_tag:
             parent.addnext(new_element)
 
+        Manipulate.restyle(new_element, True)
+
         for element in tree.xpath(xpath, namespaces={'tei': 'http://www.tei-c.org/ns/1.0'}):
             Manipulate.append_safe(sub_element, element, self)
 
@@ -278,12 +292,14 @@ class TeiManipulate(Manipulate):
                     ref_parent = ref.getparent()
 
                     ref_parent.addnext(ref)
+                    Manipulate.restyle(ref)
                     if ref_parent.getparent() is not None:  
                       ref_parent.getparent().remove(ref_parent)
         else:
             for ref in tree.xpath(xpath, namespaces={'tei': 'http://www.tei-c.org/ns/1.0'}):
                 ref.tag = 'p'
                 ref.attrib['rend'] = 'Bibliography'
+                Manipulate.restyle(ref)
 
         self.save_tree(tree)
 
@@ -357,26 +373,38 @@ class TeiManipulate(Manipulate):
 
         return True
 
-    def find_references_from_cue(self, cue, tree):
-        # load the DOM
-
+    def find_references_from_cue(self, cues, tree):
+        """
+        Finds the first paragraph or heading whose text is the highest priority linguistic cue that the document
+        contains, in one pass over the paragraphs and headings, and classifies the paragraphs that follow it as
+        references
+        @param cues: a dictionary of cues and their priorities, as returned by Manipulate.get_cue_priorities
+        @param tree: the TEI tree
+        @return: True if a cue was found
+        """
         found_element = None
+        found_priority = None
 
         remove = ['cit', 'quote']
 
         for child in tree.xpath('//tei:p | //tei:head',
                                 namespaces={'tei': 'http://www.tei-c.org/ns/1.0'}):
 
-            skip = self.contains_graphic(child)
+            priority = cues.get(self.texts.lowered(child).strip(':.').strip())
 
-            if not skip:
-                stripped_text = self.get_stripped_text(child).strip(':.')
+            # a later paragraph only replaces a match with a cue of higher priority (a lower number)
+            if priority is not None and (found_priority is None or priority < found_priority) \
+                    and not self.contains_graphic(child):
+                found_element = child
+                found_priority = priority
 
-                if stripped_text.lower().strip() == cue.lower().strip():
-                    found_element = child
-                    self.debug.print_debug(self, u'Found linguistic cue: {0}'.format(stripped_text.lower().strip()))
+                if priority == 0:
                     break
 
+        if found_element is not None:
+            self.debug.print_debug(self, u'Found linguistic cue: '
+                                         u'{0}'.format(self.texts.lowered(found_element).strip(':.').strip()))
+
         # the endgame switch is set when we're handling the last two lines (which are sometimes acknowledgements etc)
         endgame = False
         last = None
@@ -391,6 +419,7 @@ class TeiManipulate(Manipulate):
 
         if found_element is not None:
             found_element.attrib['rend'] = 'REMOVE'
+            Manipulate.restyle(found_element)
             count = 0
 
             for sibling in found_element.itersiblings():
@@ -426,6 +455,7 @@ class TeiManipulate(Manipulate):
                                                  u'cue'.format(count))
                     item.attrib['rend'] = 'Bibliography'
                     item.tag = 'p'
+                    Manipulate.restyle(item)
                     last = item
 
                     failcount = 0
@@ -446,6 +476,7 @@ class TeiManipulate(Manipulate):
                                     and (child.tail == '' or child.tail is None):
                                 item.tag = 'hi'
                                 last.append(item)
+                                Manipulate.restyle(item)
                                 parsed = True
 
                                 self.debug.print_debug(self, u'[REF{0}] Appending to previous element '
@@ -466,12 +497,14 @@ class TeiManipulate(Manipulate):
                         self.debug.print_debug(self, u'[REF{0}] Appending to previous element'.format(count))
                         item.tag = 'hi'
                         last.append(item)
+                        Manipulate.restyle(item)
 
                 elif last is not None:
                     # otherwise, we will add this reference to the last block used
                     self.debug.print_debug(self, u'[REF{0}] Appending to previous element'.format(count))
                     item.tag = 'hi'
                     last.append(item)
+                    Manipulate.restyle(item)
 
                 else:
                     self.debug.print_debug(self, u'[REF{0}] Left item in situ'.format(count))
@@ -519,6 +552,7 @@ class TeiManipulate(Manipulate):
 
                 if parent.tag == parent_tag:
                     parent.attrib['rend'] = 'Bibliography'
+                    Manipulate.restyle(parent)
                     parent = None
                 else:
                     parent = parent.getparent()
@@ -541,6 +575,7 @@ class TeiManipulate(Manipulate):
                             text = self.get_stripped_text(element)
 
                             element.attrib['rend'] = 'Bibliography'
+                            Manipulate.restyle(element)
                 else:
                     self.debug.print_debug(self, u'Failed to find sibling in bibliographic addin classification')
 
@@ -565,6 +600,7 @@ class TeiManipulate(Manipulate):
 
             new_element = etree.Element('div')
             change_element.addnext(new_element)
+            Manipulate.restyle(new_element)
             Manipulate.append_safe(new_element, change_element, self)
 
             # change all sub-elements to ref
@@ -580,6 +616,7 @@ class TeiManipulate(Manipulate):
 
                     Manipulate.append_safe(outer, element, self)
                     Manipulate.append_safe(new_element, outer, self)
+                    Manipulate.restyle(element)
 
             new_element.remove(change_element)
 
@@ -614,6 +651,7 @@ class TeiManipulate(Manipulate):
                         new_element = etree.Element(replace_tag, rel = attribute)
                         new_element.text = sub_element.tail
                         child.addnext(new_element)
+                        Manipulate.restyle(new_element)
 
                     if delete_original:
                         child.getparent().remove(child)
@@ -676,6 +714,7 @@ class TeiManipulate(Manipulate):
             if add:
                 child.tag = new_value
                 child.attrib['meTypesetSize'] = size_attribute
+                Manipulate.restyle(child)
 
         self.save_tree(tree)
 
@@ -690,6 +729,8 @@ class TeiManipulate(Manipulate):
                 if u'bold' in child.attrib[u'rend']:
                     child.attrib[u'rend'] = child.attrib[u'rend'].replace(u'bold', u'')
 
+            Manipulate.restyle(child)
+
         self.save_tree(tree)
 
     # changes the parent element of the outer_xpath expression to the new_value
@@ -712,6 +753,7 @@ class TeiManipulate(Manipulate):
                 child.tag = change_tag
 
             child.addnext(new_element)
+            Manipulate.restyle(new_element)
             Manipulate.append_safe(new_element, child, self)
 
             if child.tag == 'REMOVE':
@@ -721,6 +763,8 @@ class TeiManipulate(Manipulate):
                 if u'bold' in child.attrib[u'rend']:
                     child.attrib[u'rend'] = child.attrib[u'rend'].replace(u'bold', u'')
 
+            Manipulate.restyle(child)
+
         self.save_tree(tree)
 
     def move_size_div(self, heading_id, sibling_id):
@@ -753,10 +797,11 @@ class TeiManipulate(Manipulate):
     def resize_headings(self, old_size, new_size):
         tree = self.load_dom_tree()
 
-        nodes_to_downsize = tree.xpath(u'//tei:head[@meTypesetSize=\'{0}\']'.format(str(old_size)),
-                                       namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
+        nodes_to_downsize = self.style_index(tree).find('meTypesetSize', str(old_size),
+                                                        '{http://www.tei-c.org/ns/1.0}head')
         for node_to_downsize in nodes_to_downsize:
             node_to_downsize.attrib['meTypesetSize'] = new_size
+            Manipulate.restyle(node_to_downsize)
             self.debug.print_debug(self, u'Resizing node from: {0} to {1}'.format(old_size, new_size))
 
         self.save_tree(tree)
@@ -767,6 +812,7 @@ class TeiManipulate(Manipulate):
         node = tree.xpath(start_xpath, namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})[0]
         div = etree.Element('div')
         node.addprevious(div)
+        Manipulate.restyle(div)
 
         self.debug.print_debug(self, u'Selecting for enclosure: {0}'.format(select_xpath))
 
@@ -795,6 +841,7 @@ class TeiManipulate(Manipulate):
         for element in child:
             if not added:
                 element.getparent().addprevious(div)
+                Manipulate.restyle(div)
                 added = True
 
             Manipulate.append_safe(div, element, self)
@@ -844,6 +891,7 @@ class TeiManipulate(Manipulate):
                                   namespaces={'tei': 'http://www.tei-c.org/ns/1.0'}):
             element.tag = 'p'
             element.attrib['rend'] = 'Bibliography'
+            Manipulate.restyle(element)
             element.getparent().tag = 'REMOVE'
             count += 1
 
@@ -866,16 +914,15 @@ class TeiManipulate(Manipulate):
     def run(self):
         self.handle_metypesetdeleted(self.gv.settings.args['--includedeleted'])
 
-        if int(self.gv.settings.args['--aggression']) > int(self.gv.settings.get_setting('wmfimagereplace', self,
-                                                                                         domain='aggression')):
+        if int(self.gv.settings.args['--aggression']) > self.gv.settings.get_aggression('wmfimagereplace', self):
             # convert .wmf image links to png
             if not self.gv.settings.args['--noimageprocessing']:
                 self.change_wmf_image_links()
 
-        if int(self.gv.settings.args['--aggression']) > int(self.gv.settings.get_setting('teicleanup', self,
-                                                                                         domain='aggression')):
+        if int(self.gv.settings.args['--aggression']) > self.gv.settings.get_aggression('teicleanup', self):
             self.cleanup()
 
+        self.gv.session.commit(self)
         os.remove(self.dom_temp_file)
 
 
@@ -1,10 +1,10 @@
 #!/usr/bin/env python
 #@Author Dulip Withanage
-import subprocess
 import shutil
 from lxml import etree
 from nlmmanipulate import NlmManipulate
 from teimanipulate import TeiManipulate
+from cleanuprules import CleanupRules
 from debug import Debuggable
 
 
@@ -32,7 +32,7 @@ class TeiToNlm (Debuggable):
     def run_quirks(self, process_ref_lists):
         manipulate = NlmManipulate(self.gv)
 
-        if self.gv.settings.get_setting('linebreaks-as-comments', self) == 'False':
+        if not self.gv.settings.get_boolean('linebreaks-as-comments', self):
             # we need to convert every instance of <!--meTypeset:br--> to a new paragraph
             manipulate.close_and_open_tag('comment()[. = "meTypeset:br"]', 'p')
             manipulate.close_and_open_tag_not_styled('comment()[. = "meTypeset:br"]', 'title')
@@ -41,16 +41,24 @@ class TeiToNlm (Debuggable):
         manipulate.insert_break('comment()[. = "meTypeset:br"]', 'td')
         manipulate.insert_break('comment()[. = "meTypeset:br"]', 'title')
 
-        manipulate.remove_empty_elements('//sec//p')
+        rules = CleanupRules(manipulate)
+        rules.add(u'Removed empty paragraphs', 'p', manipulate.remove_empty_element, 'ancestor::sec',
+                  before_children=True)
 
         if process_ref_lists:
+            # the reference list methods look at the paragraphs that are left, so they run between the two passes
+            rules.run()
+
             self.debug.print_debug(self, u'Finding potential reference lists')
             manipulate.find_reference_list()
             manipulate.tag_bibliography_refs()
 
-        manipulate.remove_empty_elements('//sec/list')
-        manipulate.remove_empty_elements('//sec/disp-quote')
-        manipulate.remove_empty_elements('//back/ref-list/ref')
+            rules = CleanupRules(manipulate)
+
+        rules.add(u'Removed empty lists', 'list', manipulate.remove_empty_element, 'parent::sec')
+        rules.add(u'Removed empty quotes', 'disp-quote', manipulate.remove_empty_element, 'parent::sec')
+        rules.add(u'Removed empty refs', 'ref', manipulate.remove_empty_element, 'parent::ref-list/parent::back')
+        rules.run()
 
     def pre_cleanup(self):
         manipulate = TeiManipulate(self.gv)
@@ -87,10 +95,12 @@ class TeiToNlm (Debuggable):
 
         # split any p tags with sub-tags hi rend="Indent" into new elements
 
-        biblio_elements = tree.xpath('//tei:p'
-                                     '[tei:hi[contains(@rend, "Indent") or contains(@rend, "Default Style") or '
-                                     'contains(@rend, "Text Body")]]',
-                                     namespaces={'tei': 'http://www.tei-c.org/ns/1.0'})
+        styles = manipulate.style_index(tree)
+
+        biblio_elements = styles.in_order([element.getparent() for element in
+                                           styles.find_containing('rend', ['Indent', 'Default Style', 'Text Body'],
+                                                                  '{http://www.tei-c.org/ns/1.0}hi')
+                                           if element.getparent().tag == '{http://www.tei-c.org/ns/1.0}p'])
 
         for parent in biblio_elements:
             add_position = parent
@@ -105,6 +115,7 @@ class TeiToNlm (Debuggable):
 
                 add_position.addnext(new_p)
                 new_p.append(element)
+                manipulate.restyle(new_p)
                 add_position = new_p
 
             manipulate.save_tree(tree)
@@ -113,14 +124,21 @@ class TeiToNlm (Debuggable):
     def run_transform(self):
         self.pre_cleanup()
 
+        # saxon reads the TEI file from disk
+        self.gv.session.commit(self)
+
         self.gv.mk_dir(self.gv.nlm_folder_path)
         java_command = self.saxon_tei2nlm()
         self.debug.print_debug(self, u'Running saxon transform (TEI->NLM)')
-        subprocess.call(java_command, stdin=None, shell=True)
+        self.gv.saxon.transform(self.gv.nlm_style_sheet_dir, self.gv.tei_file_path, self.gv.nlm_temp_file_path,
+                                {'autoBlockQuote': 'true'}, java_command)
 
         if self.gv.nlm_temp_file_path != self.gv.nlm_file_path:
             shutil.copy2(self.gv.nlm_temp_file_path, self.gv.nlm_file_path)
 
+        # saxon has written a new NLM file so any held tree is stale
+        self.gv.session.release(self.gv.nlm_file_path)
+
     def run(self, process_ref_lists, transform=True):
         if transform:
             self.run_transform()
@@ -0,0 +1,88 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that caches the stripped text of elements (as returned by Manipulate.get_stripped_text) so that loops that
+compare the same elements many times (every ref for every xref, every paragraph for every cue line) compute it once.
+
+1.) The stripped text of an element is built from the cached text of its children; the lowercased and tokenized
+    variants are computed from it on first use
+2.) An element's entries and those of its ancestors are dropped when it is changed through the manipulator API
+    (append_safe or invalidate_text)
+3.) Every entry is dropped when a tree is saved to, released from or committed by the document session, because
+    modules also change trees directly through lxml; callers that do so between two reads must call invalidate_text
+"""
+
+
+class TextCache(object):
+    def __init__(self):
+        self.stripped_texts = {}
+        self.lowered_texts = {}
+        self.token_lists = {}
+
+    def stripped(self, element):
+        """
+        @param element: an lxml element
+        @return: the same string as Manipulate.get_stripped_text(element)
+        """
+        text = self.stripped_texts.get(element)
+
+        if text is None:
+            parts = [element.text if element.text is not None else '']
+
+            for sub_element in element:
+                parts.append(' ')
+                parts.append(self.stripped(sub_element))
+
+                if sub_element.tail is not None:
+                    parts.append(sub_element.tail)
+
+            text = ''.join(parts)
+            self.stripped_texts[element] = text
+
+        return text
+
+    def lowered(self, element):
+        """
+        @param element: an lxml element
+        @return: the stripped text of the element in lower case
+        """
+        text = self.lowered_texts.get(element)
+
+        if text is None:
+            text = self.stripped(element).lower()
+            self.lowered_texts[element] = text
+
+        return text
+
+    def tokens(self, element):
+        """
+        @param element: an lxml element
+        @return: a tuple of the stripped text of the element split on spaces
+        """
+        tokens = self.token_lists.get(element)
+
+        if tokens is None:
+            tokens = tuple(self.stripped(element).split(' '))
+            self.token_lists[element] = tokens
+
+        return tokens
+
+    def invalidate(self, element):
+        """
+        Drops the entries of an element whose text, tail or children have changed, and those of its ancestors
+        @param element: the changed element
+        """
+        if len(self.stripped_texts) == 0:
+            return
+
+        while element is not None:
+            self.stripped_texts.pop(element, None)
+            self.lowered_texts.pop(element, None)
+            self.token_lists.pop(element, None)
+            element = element.getparent()
+
+    def clear(self):
+        self.stripped_texts = {}
+        self.lowered_texts = {}
+        self.token_lists = {}
@@ -0,0 +1,157 @@
+__author__ = "Martin Paul Eve"
+__email__ = "martin@martineve.com"
+
+"""
+A class that indexes the text nodes of a tree by the footnote markers that they contain, so that the list classifier
+can find a marker without running an XPath over (or serializing) the whole document for every footnote number.
+
+1.) One walk of the tree records, for every text node (an element's text or tail), the bracketed markers ("[12]" and
+    "[12,") and the numbers (every run of digits and every part of it) that it contains, along with the leading
+    characters of the text that follows each tag
+2.) Lookups re-read the current text of each candidate and return the matches in document order, so nodes that have
+    been trimmed or moved since the walk are still answered correctly
+3.) Nodes that are split or inserted are added to the index with add and add_subtree
+"""
+
+import re
+import sys
+
+bracketed_marker = re.compile(r'\[\d+[\],]')
+number_run = re.compile(r'\d+')
+
+tei_p = '{http://www.tei-c.org/ns/1.0}p'
+
+
+class TextIndex(object):
+    def __init__(self, tree):
+        self.root = tree.getroot() if hasattr(tree, 'getroot') else tree
+        self.markers = {}
+        self.leading = set()
+
+        # the root's own text and the descendants of the root (tails of the root are outside the document)
+        self.add(self.root, False, True)
+
+        for element in self.root.iterdescendants():
+            if isinstance(element.tag, str):
+                self.add(element, False, True)
+
+            self.add(element, True, True)
+
+    @staticmethod
+    def value(owner, is_tail):
+        return owner.tail if is_tail else owner.text
+
+    def add(self, owner, is_tail, leading=False):
+        """
+        Indexes the current value of one text node
+        @param owner: the element whose text or tail this is
+        @param is_tail: True for the element's tail
+        @param leading: True to record the text's leading characters (only during the initial walk, which stands in for
+        a serialization of the tree before any module changes it)
+        """
+        text = self.value(owner, is_tail)
+
+        if not text:
+            return
+
+        if leading:
+            self.leading.add(text[:1])
+            self.leading.add(text[:2])
+
+        node = (owner, is_tail)
+
+        for marker in bracketed_marker.findall(text):
+            self.markers.setdefault(marker, set()).add(node)
+
+        for run in number_run.findall(text):
+            for start in range(len(run)):
+                for end in range(start + 1, len(run) + 1):
+                    self.markers.setdefault(run[start:end], set()).add(node)
+
+    def add_subtree(self, element):
+        """
+        Indexes an element that has been inserted into the tree, including its descendants and its tail
+        @param element: the inserted element
+        """
+        for descendant in element.iter():
+            if isinstance(descendant.tag, str):
+                self.add(descendant, False)
+
+            if descendant is not element:
+                self.add(descendant, True)
+
+        self.add(element, True)
+
+    def follows_tag(self, prefix):
+        """
+        Stands in for a test of the form u'>' + prefix in etree.tostring(tree)
+        @param prefix: one or two characters
+        @return: True if the text after any tag began with the prefix when the index was built
+        """
+        return prefix in self.leading
+
+    def position(self, owner, is_tail, scope):
+        """
+        @param owner: the element whose text or tail this is
+        @param is_tail: True for the element's tail
+        @param scope: a tag that the text node must be inside, or None
+        @return: a key that sorts text nodes into document order, or None if the node has left the tree or is not
+        inside the scope
+        """
+        if is_tail and owner is self.root:
+            return None
+
+        path = [sys.maxsize if is_tail else -1]
+        in_scope = scope is None or (not is_tail and owner.tag == scope)
+        element = owner
+        parent = element.getparent()
+
+        while parent is not None:
+            in_scope = in_scope or parent.tag == scope
+            path.append(parent.index(element))
+            element = parent
+            parent = element.getparent()
+
+        if element is not self.root or not in_scope:
+            return None
+
+        path.reverse()
+
+        return path
+
+    def find(self, marker, scope=None):
+        """
+        Stands in for //text()[contains(self::text(), marker)] (or //scope//text()[...] with a scope)
+        @param marker: a bracketed marker such as "[12]" or "[12," or a number such as "12"
+        @param scope: a tag that the text nodes must be inside, or None for the whole document
+        @return: a list of (owner, is_tail) tuples in document order
+        """
+        found = []
+
+        for owner, is_tail in self.markers.get(marker, ()):
+            text = self.value(owner, is_tail)
+
+            if text is None or marker not in text:
+                continue
+
+            key = self.position(owner, is_tail, scope)
+
+            if key is not None:
+                found.append((key, owner, is_tail))
+
+        found.sort(key=lambda match: match[0])
+
+        return [(owner, is_tail) for key, owner, is_tail in found]
+
+    def count(self, marker):
+        return len(self.find(marker))
+
+    def first(self, marker, scope=None):
+        """
+        @param marker: a bracketed marker or a number
+        @param scope: a tag that the text node must be inside, or None for the whole document
+        @return: the first (owner, is_tail) tuple in document order, or None
+        """
+        found = self.find(marker, scope)
+
+        return found[0] if len(found) > 0 else None
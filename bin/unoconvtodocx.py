@@ -24,14 +24,13 @@ class UnoconvToDocx(Debuggable):
 
     def unoconv_to_docx(self):
         """
-        Creates the appropriate java command to run Saxon
-        @return: a string to run on the command line
+        Creates the unoconv arguments to convert the input to docx
+        @return: a list of arguments for the office listeners
         """
-        cmd = ["unoconv", "-f", "docx",
-               "-o", os.path.join(self.gv.unoconv_folder_path, 'new.docx'),
-               self.gv.input_file_path
-               ]
-        return ' '.join(cmd)
+        return ["-f", "docx",
+                "-o", os.path.join(self.gv.unoconv_folder_path, 'new.docx'),
+                self.gv.input_file_path
+                ]
 
     def run(self, input_format):
         """
@@ -40,10 +39,22 @@ class UnoconvToDocx(Debuggable):
         # make output folders
         self.gv.mk_dir(self.gv.unoconv_folder_path)
 
-        unoconv_command = self.unoconv_to_docx()
+        unoconv_arguments = self.unoconv_to_docx()
 
         self.debug.print_debug(self, u'Running unoconv transform ({0}->DOCX)'.format(input_format.upper()))
-        subprocess.call(unoconv_command, stdin=None, shell=True)
+
+        try:
+            with self.gv.profiler.subprocess('unoconv'):
+                self.gv.office.run(unoconv_arguments, self.gv.settings.get_integer('office-conversion-timeout', self))
+        except subprocess.TimeoutExpired:
+            self.debug.fatal_error(self, u'unoconv did not convert {0} within the time allowed by '
+                                         u'office-conversion-timeout'.format(self.gv.input_file_path))
+        except OSError:
+            self.debug.fatal_error(self, u'Unable to run unoconv')
+
+        self.gv.office.report()
 
         self.gv.input_file_path = os.path.join(self.gv.unoconv_folder_path, 'new.docx')
 
+        self.gv.session.commit(self)
+
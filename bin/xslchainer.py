@@ -1,7 +1,6 @@
 #!/usr/bin/env python
 __author__ = "Martin Paul Eve"
 __email__ = "martin@martineve.com"
-import subprocess
 import shutil
 from nlmmanipulate import NlmManipulate
 from debug import Debuggable
@@ -29,11 +28,15 @@ class XslChain (Debuggable):
             return ' '.join(cmd)
 
     def run_transform(self):
+        # saxon reads the NLM file from disk
+        self.gv.session.commit(self)
+
         self.gv.mk_dir(self.gv.xsl_folder_path)
         java_command = self.saxon_arbitrary_xsl()
         print(java_command)
         self.debug.print_debug(self, u'Running saxon transform (XSL CHAIN)')
-        subprocess.call(java_command, stdin=None, shell=True)
+        self.gv.saxon.transform(self.gv.settings.args['--chain'], self.gv.nlm_file_path, self.gv.xsl_file_path,
+                                {'autoBlockQuote': 'true'}, java_command)
 
     def run(self):
         self.run_transform()
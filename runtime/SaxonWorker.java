@@ -0,0 +1,112 @@
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.FileDescriptor;
+import java.io.FileOutputStream;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.util.HashMap;
+import java.util.Map;
+
+import javax.xml.transform.stream.StreamSource;
+
+import net.sf.saxon.lib.FeatureKeys;
+import net.sf.saxon.s9api.ItemType;
+import net.sf.saxon.s9api.Processor;
+import net.sf.saxon.s9api.QName;
+import net.sf.saxon.s9api.Serializer;
+import net.sf.saxon.s9api.XdmAtomicValue;
+import net.sf.saxon.s9api.XdmNode;
+import net.sf.saxon.s9api.XsltCompiler;
+import net.sf.saxon.s9api.XsltExecutable;
+import net.sf.saxon.s9api.XsltTransformer;
+
+import org.apache.xml.resolver.tools.CatalogResolver;
+
+/**
+ * A long-lived Saxon process for meTypeset (see bin/saxonworker.py).
+ *
+ * The worker is configured in the same way as the net.sf.saxon.Transform command lines that it replaces (catalog
+ * resolving readers for sources and stylesheets and a catalog URI resolver) and keeps every stylesheet that it has
+ * compiled in memory.
+ *
+ * Requests are read from stdin, one per line, as tab separated fields:
+ *
+ *     key, stylesheet, source, output, name=value, name=value...
+ *
+ * The key identifies the compiled stylesheet. Each request is answered on stdout with "OK" or "ERROR message".
+ * Anything else (xsl:message output, stack traces) goes to stderr.
+ */
+public class SaxonWorker {
+    public static void main(String[] args) throws Exception {
+        Processor processor = new Processor(false);
+        processor.setConfigurationProperty(FeatureKeys.SOURCE_PARSER_CLASS,
+                "org.apache.xml.resolver.tools.ResolvingXMLReader");
+        processor.setConfigurationProperty(FeatureKeys.STYLE_PARSER_CLASS,
+                "org.apache.xml.resolver.tools.ResolvingXMLReader");
+
+        CatalogResolver resolver = new CatalogResolver();
+
+        XsltCompiler compiler = processor.newXsltCompiler();
+        compiler.setURIResolver(resolver);
+
+        Map<String, XsltExecutable> compiled = new HashMap<String, XsltExecutable>();
+
+        BufferedReader in = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        PrintStream replies = new PrintStream(new FileOutputStream(FileDescriptor.out), true, "UTF-8");
+
+        // keep stdout for the protocol
+        System.setOut(System.err);
+
+        String line;
+
+        while ((line = in.readLine()) != null) {
+            if (line.length() == 0) {
+                continue;
+            }
+
+            String[] fields = line.split("\t", -1);
+
+            try {
+                XsltExecutable executable = compiled.get(fields[0]);
+
+                if (executable == null) {
+                    executable = compiler.compile(new StreamSource(new File(fields[1])));
+                    compiled.put(fields[0], executable);
+                }
+
+                // the source is fully built before the output is opened, as some transforms overwrite their input
+                XdmNode source = processor.newDocumentBuilder().build(new File(fields[2]));
+
+                XsltTransformer transformer = executable.load();
+                transformer.setURIResolver(resolver);
+                transformer.setInitialContextNode(source);
+
+                for (int i = 4; i < fields.length; i++) {
+                    int split = fields[i].indexOf('=');
+
+                    transformer.setParameter(new QName(fields[i].substring(0, split)),
+                            new XdmAtomicValue(fields[i].substring(split + 1), ItemType.UNTYPED_ATOMIC));
+                }
+
+                File output = new File(fields[3]);
+                transformer.setBaseOutputURI(output.toURI().toString());
+
+                OutputStream stream = new FileOutputStream(output);
+
+                try {
+                    Serializer serializer = processor.newSerializer(stream);
+                    transformer.setDestination(serializer);
+                    transformer.transform();
+                } finally {
+                    stream.close();
+                }
+
+                replies.println("OK");
+            } catch (Exception e) {
+                e.printStackTrace();
+                replies.println("ERROR " + String.valueOf(e.getMessage()).replace('\n', ' '));
+            }
+        }
+    }
+}